@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+'''Apply a mutation batch saved by map_box_numbers.py or map_green_barcode_box_numbers.py with --save_batch.
+
+Operations are applied by a pool of workers, in order where it matters: an operation waits for the
+creates it refers to, for the operations listed in its `after`, and for the operation before it on the
+same record.  If any of those failed, it's skipped.  Every operation applied is journaled, so an
+interrupted run can be picked up with --resume.  Once all operations are done, records created for
+operations that then failed (a create's `discard_unless`) are deleted again.
+
+Before changing a record, its current json is fetched.  A change that's already there is skipped,
+and one to a record whose lock_version has moved on since the batch was written is refused, so
+applying a batch twice, or after someone else has edited a record, doesn't clobber anything.'''
+from argparse import ArgumentParser
+from types import SimpleNamespace as NS
+
+from asnake.logging import setup_logging, get_logger
+from asnake.aspace import ASpace
+
+from aspace_requests import BoundedExecutor, Scheduler, http_client
+from batch import dependencies, read_batch, resolve
+from instrumentation import Metrics, instrument_client
+from journal import Journal
+from series_index import SeriesIndex
+
+ap = ArgumentParser(description="Apply a batch of changes saved with --save_batch to ASpace")
+ap.add_argument('batch', help='batch file to apply')
+ap.add_argument('--logfile', default='apply_batch.log', help='path to print log to')
+ap.add_argument('--workers', type=int, default=8, help='maximum number of changes to make at once; fewer are made while ASpace is struggling')
+ap.add_argument('--rate', type=float, default=0, help='maximum number of requests to start per second; 0 for no limit')
+ap.add_argument('--target_latency', type=float, help='seconds a request may take before ASpace is taken to be overloaded and fewer are made at once')
+ap.add_argument('--retries', type=int, default=3, help='number of times to retry a request that fails with a transient error')
+ap.add_argument('--journal', default='apply_batch.journal', help='path to record applied changes to')
+ap.add_argument('--resume', action='store_true', help='resume an interrupted run, skipping changes recorded in the journal')
+ap.add_argument('--http_backend', choices=('requests', 'aiohttp'), default='requests', help='HTTP client to talk to ASpace with; aiohttp gives all workers one shared pool of connections')
+ap.add_argument('--connections', type=int, default=100, help='maximum number of requests in flight at once with the aiohttp backend')
+ap.add_argument('--metrics', default='apply_batch.metrics.json', help='path to write timing, request and query metrics to')
+ap.add_argument('--series_index', default='series_index.sqlite', help='SQLite file of the highest box number in each series, to count the box numbers of containers created in')
+
+def request(method, uri, **kwargs):
+    return scheduler.request(getattr(aspace.client, method), uri, **kwargs)
+
+def contains(have, want):
+    '''True if have has everything in want, e.g. an instance ASpace has filled in has the instance we asked for'''
+    if isinstance(want, dict):
+        return isinstance(have, dict) and all(k in have and contains(have[k], v) for k, v in want.items())
+    if isinstance(want, list):
+        return isinstance(have, list) and all(any(contains(h, w) for h in have) for w in want)
+    return have == want
+
+def applied(op, uri=None):
+    journal.record('applied', key=op['key'], uri=uri)
+    log.info('applied', key=op['key'], op=op['op'], uri=uri or op['uri'])
+
+def lock_version_moved(op, record):
+    if op.get('lock_version') is not None and record['lock_version'] != op['lock_version']:
+        log.error('FAIL lock_version_conflict', key=op['key'], uri=op['uri'],
+                  expected=op['lock_version'], lock_version=record['lock_version'])
+        return True
+    return False
+
+def create(op):
+    res = request('post', op['uri'], json=resolve(op['json'], uris))
+    if res.status_code != 200:
+        log.error('FAIL create', key=op['key'], uri=op['uri'], status_code=res.status_code, result=res.json())
+        return False
+    uris[op['key']] = res.json()['uri']
+    applied(op, uris[op['key']])
+    return True
+
+def change(op):
+    '''Apply an update or append'''
+    res = request('get', op['uri'])
+    if res.status_code != 200:
+        log.error('FAIL fetch_record', key=op['key'], uri=op['uri'], status_code=res.status_code)
+        return False
+    record = res.json()
+    if op['op'] == 'update':
+        fields = resolve(op['fields'], uris)
+        done = all(record.get(field) == value for field, value in fields.items())
+    else:
+        values = resolve(op['values'], uris)
+        done = contains(record.get(op['field'], []), values)
+    if done:
+        log.info('SKIP already_applied', key=op['key'], uri=op['uri'])
+        applied(op)
+        return True
+    if lock_version_moved(op, record):
+        return False
+
+    if op['op'] == 'update':
+        record.update(fields)
+    else:
+        for field in op.get('unset', ()):
+            record.pop(field, None)
+        record.setdefault(op['field'], []).extend(values)
+    res = request('post', op['uri'], json=record)
+    if res.status_code != 200:
+        log.error('FAIL ' + op['op'], key=op['key'], uri=op['uri'], status_code=res.status_code, result=res.json())
+        return False
+    applied(op)
+    return True
+
+def delete(op):
+    res = request('get', op['uri'])
+    if res.status_code == 404:
+        log.info('SKIP already_deleted', key=op['key'], uri=op['uri'])
+        applied(op)
+        return True
+    if res.status_code != 200:
+        log.error('FAIL fetch_record', key=op['key'], uri=op['uri'], status_code=res.status_code)
+        return False
+    if lock_version_moved(op, res.json()):
+        return False
+    res = request('delete', op['uri'])
+    if res.status_code != 200:
+        log.error('FAIL delete', key=op['key'], uri=op['uri'], status_code=res.status_code, result=res.json())
+        return False
+    applied(op)
+    return True
+
+APPLY = {'create': create, 'update': change, 'append': change, 'delete': delete}
+
+def apply(op, waits):
+    '''Apply op once the operations it waits on are done, returning whether it succeeded'''
+    if not all(wait.result() for wait in waits):
+        log.warning('SKIP dependency_failed', key=op['key'], uri=op['uri'])
+        return False
+    if op['key'] in done:
+        log.info('SKIP applied_in_earlier_run', key=op['key'])
+        return True
+    try:
+        return APPLY[op['op']](op)
+    except Exception as e:
+        log.error('FAIL apply', key=op['key'], uri=op['uri'], error=repr(e))
+        return False
+
+def submit_batch(ops, pool):
+    '''Submit ops to pool, each waiting on what it depends on.  Returns a dict of key:future of
+whether the op succeeded, one of key:series_indicators of creates of numbered containers,
+and one of key:discard_unless of creates that are discarded if other operations fail.'''
+    futures = {}
+    # the last operation on each existing record, so changes to a record are made one at a time, in order
+    last_on_record = {}
+    numbered = {}
+    discardable = {}
+    for op in ops:
+        waits = [futures[key] for key in dependencies(op) if key in futures]
+        if op['op'] != 'create' and op['uri'] in last_on_record:
+            waits.append(last_on_record[op['uri']])
+        futures[op['key']] = pool.submit(apply, op, waits)
+        if op['op'] != 'create':
+            last_on_record[op['uri']] = futures[op['key']]
+        if op.get('series_indicators'):
+            numbered[op['key']] = op['series_indicators']
+        if op.get('discard_unless'):
+            discardable[op['key']] = op['discard_unless']
+        metrics.count()
+    return futures, numbered, discardable
+
+def discard_unused(discardable, futures):
+    '''Delete the records created by the batch that operations in their discard_unless failed without,
+returning the uris of any that couldn't be deleted, which are journaled and logged as orphaned'''
+    orphaned = []
+    for key, needed_by in discardable.items():
+        if not futures[key].result() or all(futures[k].result() for k in needed_by if k in futures):
+            continue
+        uri = uris[key]
+        try:
+            res = request('delete', uri)
+        except Exception as e:
+            res = NS(status_code=None, json=lambda: {'error': repr(e)})
+        if res.status_code in (200, 404):
+            journal.record('discarded', key=key, uri=uri)
+            log.info('discarded', key=key, uri=uri)
+        else:
+            journal.record('orphaned', key=key, uri=uri)
+            log.error('FAIL discard', key=key, uri=uri, status_code=res.status_code, result=res.json())
+            orphaned.append(uri)
+    return orphaned
+
+def created_indicators(numbered, futures):
+    '''The highest box number used in each series by the creates in numbered that succeeded;
+only the numbers of containers that were actually created are used up'''
+    new_indicators = {}
+    for key, series_indicators in numbered.items():
+        if futures[key].result():
+            for series, indicator in series_indicators.items():
+                new_indicators[series] = max(new_indicators.get(series, 0), indicator)
+    return new_indicators
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    if not args.resume and not Journal.completed(args.journal):
+        ap.error("{} is from a run that didn't finish; pass --resume to pick up where it left off, or remove it".format(args.journal))
+    setup_logging(filename=args.logfile)
+    log = get_logger('apply_batch')
+    metrics = Metrics()
+
+    log.info('start', batch=args.batch)
+    metrics.phase('connect')
+
+    aspace = ASpace()
+    aspace.client = http_client(aspace.client, args.http_backend, args.connections)
+    instrument_client(aspace.client, metrics)
+    log.info('aspace_connect')
+    scheduler = Scheduler(args.workers, rate=args.rate, retries=args.retries, target_latency=args.target_latency, log=log)
+
+    journal = Journal(args.journal, resume=args.resume)
+    done = set()
+    # key:uri of records created, for resolving refs to them
+    uris = {}
+    for entry in journal.entries:
+        if entry['event'] == 'applied':
+            done.add(entry['key'])
+            if entry.get('uri'):
+                uris[entry['key']] = entry['uri']
+        elif entry['event'] == 'discarded':
+            # deleted again, so it's created afresh
+            done.discard(entry['key'])
+            uris.pop(entry['key'], None)
+    if args.resume:
+        log.info('replay_journal', journal=args.journal, applied=len(done))
+        if journal.unreadable:
+            log.warning('WARN unreadable_journal_entries', journal=args.journal, lines=journal.unreadable)
+
+    log.info('apply_batch')
+    metrics.phase('apply_batch')
+    # Tasks only ever wait on tasks submitted before them, which the pool has already started, so they can't deadlock
+    with BoundedExecutor(max_workers=args.workers) as pool:
+        futures, numbered, discardable = submit_batch(read_batch(args.batch), pool)
+    orphaned = discard_unused(discardable, futures)
+
+    failed = [key for key, future in futures.items() if not future.result()]
+    new_indicators = created_indicators(numbered, futures)
+    if new_indicators:
+        series_index = SeriesIndex(args.series_index)
+        series_index.save(new_indicators)
+        series_index.close()
+        log.info('series_index_saved', series_index=args.series_index, series=len(new_indicators))
+    journal.record('run_complete')
+    journal.close()
+    log.info('end', operations=len(futures), failed=len(failed), orphaned=orphaned)
+    metrics.report(args.metrics)
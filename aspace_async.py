@@ -0,0 +1,124 @@
+'''aiohttp-based HTTP backend for ArchivesSpace API requests.
+
+AsyncClient runs an event loop on a background thread, with a single pooled, keep-alive aiohttp
+session, and offers the get/post/put/delete methods of the ArchivesSnake client, returning responses
+with status_code, content, text and json().  Those calls block the calling thread as usual, so the
+scripts' worker pools work unchanged while sharing one connection pool; submit() returns a future
+instead, for overlapping many requests from one thread.
+
+At most `limit` requests are in flight at once.  A request refused with a 403 is retried once after
+logging in again, as ArchivesSnake does, and connection errors are raised as requests' ConnectionError
+(ConnectTimeout if the connection couldn't be made at all), so with_retries treats them the same
+whichever backend is in use.'''
+import asyncio, atexit, json, threading
+from urllib.parse import quote
+
+import aiohttp
+from requests.exceptions import ConnectionError, ConnectTimeout
+
+from asnake.client.web_client import ASnakeAuthError
+
+class Response:
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+def query_params(params):
+    '''params as (name, value) pairs, with the name[] convention ASpace uses for lists, as ArchivesSnake does'''
+    pairs = []
+    for name, value in (params or {}).items():
+        if isinstance(value, (list, tuple, set)):
+            pairs.extend((name if name.endswith('[]') else name + '[]', str(v),) for v in value)
+        else:
+            pairs.append((name, str(value).lower() if isinstance(value, bool) else str(value),))
+    return pairs
+
+class AsyncClient:
+    def __init__(self, config, session_token=None, limit=100):
+        '''Client for the ASpace instance in ArchivesSnake config, starting with session_token if given'''
+        self.config = config
+        self.session_token = session_token
+        self.limit = limit
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self._run(self._open())
+        atexit.register(self.close)
+
+    @classmethod
+    def from_client(cls, client, limit=100):
+        '''AsyncClient sharing the config and session of an authorized ArchivesSnake client'''
+        return cls(client.config, client.session.headers.get(client.config['session_header_name']), limit)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _open(self):
+        # created on the loop's thread, so they belong to the right loop
+        self.slots = asyncio.Semaphore(self.limit)
+        self.auth_lock = asyncio.Lock()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60))
+
+    def url(self, url):
+        return "/".join([self.config['baseurl'].rstrip("/"), url.lstrip("/")])
+
+    async def authorize(self, stale_token=None):
+        async with self.auth_lock:
+            # another request may have logged in again while this one waited
+            if self.session_token != stale_token:
+                return
+            username = self.config.get('username')
+            if not username:
+                raise ASnakeAuthError("Session expired, and no username and password are configured to log in again")
+            login = self.url('users/{}/login'.format(quote(username)))
+            async with self.session.post(login, data={'password': self.config.get('password'), 'expiring': 'false'}) as res:
+                if res.status != 200:
+                    raise ASnakeAuthError("Failed to authorize with status: {}".format(res.status))
+                self.session_token = json.loads(await res.text())['session']
+
+    async def request(self, method, url, params=None, json=None, data=None):
+        for attempt in range(2):
+            token = self.session_token
+            headers = {self.config['session_header_name']: token} if token else {}
+            try:
+                async with self.slots:
+                    async with self.session.request(method, self.url(url), params=query_params(params),
+                                                    json=json, data=data, headers=headers) as res:
+                        content = await res.read()
+            except aiohttp.ClientConnectorError as e:
+                # nothing was sent, which requests signals with a ConnectTimeout
+                raise ConnectTimeout(str(e)) from e
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                raise ConnectionError(str(e)) from e
+            if res.status == 403 and attempt == 0 and self.config['retry_with_auth']:
+                await self.authorize(token)
+                continue
+            return Response(res.status, content, res.headers)
+
+    def submit(self, method, url, **kwargs):
+        '''Start a request, returning a concurrent.futures.Future of its response'''
+        return asyncio.run_coroutine_threadsafe(self.request(method.upper(), url, **kwargs), self.loop)
+
+    def get(self, url, **kwargs):
+        return self.submit('GET', url, **kwargs).result()
+
+    def post(self, url, **kwargs):
+        return self.submit('POST', url, **kwargs).result()
+
+    def put(self, url, **kwargs):
+        return self.submit('PUT', url, **kwargs).result()
+
+    def delete(self, url, **kwargs):
+        return self.submit('DELETE', url, **kwargs).result()
+
+    def close(self):
+        if not self.session.closed:
+            self._run(self.session.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
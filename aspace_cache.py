@@ -0,0 +1,57 @@
+'''Persistent on-disk cache of ArchivesSpace record jsons.
+
+Records are kept in a SQLite file keyed by jsonmodel type and id, alongside the
+lock_version and system_mtime they were fetched at.  Since ASpace bumps lock_version
+on every update, comparing it against the database tells us which cached records
+are still current, so only missing or stale records need to be refetched.'''
+import json, sqlite3
+
+from more_itertools import chunked
+
+class RecordCache:
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS record (
+                             jsonmodel_type TEXT NOT NULL,
+                             id INTEGER NOT NULL,
+                             lock_version INTEGER NOT NULL,
+                             system_mtime TEXT,
+                             json TEXT NOT NULL,
+                             PRIMARY KEY (jsonmodel_type, id))''')
+
+    def get_current(self, jsonmodel_type, versions):
+        '''Return dict of id:json for cached records whose lock_version matches the one in `versions`, a dict of id:lock_version'''
+        current = {}
+        for chunk in chunked(versions, 500):
+            for record_id, lock_version, data in self.db.execute(
+                    '''SELECT id, lock_version, json FROM record
+                        WHERE jsonmodel_type = ? AND id IN ({})'''.format(','.join('?' * len(chunk))),
+                    (jsonmodel_type, *chunk,)):
+                if lock_version == versions[record_id]:
+                    current[record_id] = json.loads(data)
+        return current
+
+    def put(self, jsonmodel_type, jsons):
+        '''Store (or replace) record jsons'''
+        with self.db:
+            self.db.executemany(
+                '''INSERT OR REPLACE INTO record (jsonmodel_type, id, lock_version, system_mtime, json)
+                   VALUES (?, ?, ?, ?, ?)''',
+                ((jsonmodel_type,
+                  int(record['uri'][record['uri'].rfind('/') + 1:]),
+                  record['lock_version'],
+                  record.get('system_mtime'),
+                  json.dumps(record),) for record in jsons))
+
+    def close(self):
+        self.db.close()
+
+def current_versions(cursor, jsonmodel_type, ids):
+    '''Look up current lock_versions in the ASpace database, returning dict of id:lock_version.
+
+jsonmodel_type is used as the table name, so must be a trusted value like 'archival_object'.'''
+    versions = {}
+    for chunk in chunked(sorted(ids), 1000):
+        cursor.execute('SELECT id, lock_version FROM {} WHERE id IN %s'.format(jsonmodel_type), (chunk,))
+        versions.update((row['id'], row['lock_version'],) for row in cursor.fetchall())
+    return versions
@@ -0,0 +1,181 @@
+'''Shared queries against the ArchivesSpace database.
+
+Rather than building JSON in SQL with GROUP_CONCAT (which truncates at group_concat_max_len
+and breaks on quotes and backslashes), these stream flat rows ordered by container and group
+them in Python.  With an unbuffered cursor, only one group is held in memory at a time.'''
+from argparse import ArgumentTypeError
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+
+# A slice of a repository: either the resources with ids first..last, or the records whose id mod n is k
+Partition = namedtuple('Partition', 'spec kind first last k n')
+
+def partition(spec):
+    '''Parse a partition spec, either `resources:FIRST-LAST` or `hash:K/N`.  For use as an argparse type.'''
+    kind, _, value = spec.partition(':')
+    try:
+        if kind == 'resources':
+            first, last = map(int, value.split('-'))
+            return Partition(spec, kind, first, last, None, None)
+        if kind == 'hash':
+            k, n = map(int, value.split('/'))
+            if 0 <= k < n:
+                return Partition(spec, kind, None, None, k, n)
+    except ValueError:
+        pass
+    raise ArgumentTypeError('partition must be resources:FIRST-LAST or hash:K/N with 0 <= K < N, not {!r}'.format(spec))
+
+def container_partition(partition):
+    '''SQL condition on top containers (as tc) and its params, selecting those in partition.
+
+By resources, a container belongs to the lowest-numbered resource it has AOs in, so that a
+container shared between resources lands in exactly one partition.'''
+    if partition is None:
+        return 'TRUE', ()
+    if partition.kind == 'hash':
+        return 'MOD(tc.id, %s) = %s', (partition.n, partition.k,)
+    return '''tc.id IN (SELECT ptclr.top_container_id
+                       FROM top_container_link_rlshp ptclr
+                       JOIN sub_container ps ON ps.id = ptclr.sub_container_id
+                       JOIN instance pi ON pi.id = ps.instance_id
+                       JOIN archival_object pao ON pao.id = pi.archival_object_id
+                       GROUP BY ptclr.top_container_id
+                       HAVING MIN(pao.root_record_id) BETWEEN %s AND %s)''', (partition.first, partition.last,)
+
+def changed_since(since):
+    '''SQL condition on top containers (as tc) and its params, selecting those changed at or after since,
+or linked to archival objects that were (which is also how newly linked ones show up)'''
+    return '''(tc.system_mtime >= %s
+               OR tc.id IN (SELECT ctclr.top_container_id
+                            FROM top_container_link_rlshp ctclr
+                            JOIN sub_container cs ON cs.id = ctclr.sub_container_id
+                            JOIN instance ci ON ci.id = cs.instance_id
+                            JOIN archival_object cao ON cao.id = ci.archival_object_id
+                            WHERE cao.system_mtime >= %s))''', (since, since,)
+
+def latest_system_mtime(cursor):
+    '''Latest system_mtime of any top container or archival object.  As it's taken from the data rather
+than the clock, it's comparable with system_mtimes whatever time zone ASpace writes them in.'''
+    cursor.execute('''SELECT (SELECT MAX(system_mtime) FROM top_container) AS container_mtime,
+                             (SELECT MAX(system_mtime) FROM archival_object) AS ao_mtime''')
+    row = cursor.fetchone()
+    return max((mtime for mtime in (row['container_mtime'], row['ao_mtime']) if mtime), default=None)
+
+def resource_partition(partition):
+    '''SQL condition on resources (as r) and its params, selecting those in partition.  Hash partitions
+go by resource id, so that everything within a resource lands in the same partition.'''
+    if partition is None:
+        return 'TRUE', ()
+    if partition.kind == 'hash':
+        return 'MOD(r.id, %s) = %s', (partition.n, partition.k,)
+    return 'r.id BETWEEN %s AND %s', (partition.first, partition.last,)
+
+CONTAINER_AOS = '''SELECT tc.id AS container_id,
+                          tc.indicator,
+                          tc.barcode,
+                          tc.lock_version,
+                          ao.id AS ao_id,
+                          ao.component_id,
+                          ao.root_record_id,
+                          ao.lock_version AS ao_lock_version,
+                          ao.title AS ao_title
+                   FROM top_container tc
+                   JOIN top_container_link_rlshp tclr
+                     ON tclr.top_container_id = tc.id
+                   JOIN sub_container s
+                     ON s.id = tclr.sub_container_id
+                   JOIN instance i
+                     ON s.instance_id = i.id
+                   JOIN archival_object ao
+                     ON ao.id = i.archival_object_id
+                   WHERE {where}
+                   ORDER BY tc.id, ao.component_id'''
+
+def container_ids(cursor, where, params=None):
+    '''Ids of the top containers matching `where` (a trusted SQL condition on tc), in order'''
+    cursor.execute('SELECT tc.id FROM top_container tc WHERE {where} ORDER BY tc.id'.format(where=where), params)
+    return [row['id'] for row in cursor.fetchall()]
+
+def container_aos(cursor, where, params=None):
+    '''Run query for top containers matching `where` (a trusted SQL condition on tc/ao), returning an
+iterator of a dict per container, with the component_ids, ids, lock_versions and titles of its AOs and
+the number of resources it's attached to.'''
+    cursor.execute(CONTAINER_AOS.format(where=where), params)
+    return _group_container_aos(cursor)
+
+def _group_container_aos(cursor):
+    for container_id, rows in groupby(cursor, key=itemgetter('container_id')):
+        rows = list(rows)
+        yield {'container_id': container_id,
+               'indicator': rows[0]['indicator'],
+               'barcode': rows[0]['barcode'],
+               'lock_version': rows[0]['lock_version'],
+               # AOs without component ids are left out, as GROUP_CONCAT used to do
+               'component_ids': [row['component_id'] for row in rows if row['component_id'] is not None],
+               'ao_ids': [row['ao_id'] for row in rows],
+               'ao_lock_versions': [row['ao_lock_version'] for row in rows],
+               'ao_titles': [row['ao_title'] for row in rows],
+               'resources_attached_to': len({row['root_record_id'] for row in rows})}
+
+def series_max_indicators(cursor, where='TRUE', params=None):
+    '''Run query for the highest numeric indicator of the containers in each series of each resource
+(series as taken from their AOs' component_ids), returning a list of dicts of resource id (`id`),
+series and max_indicator.  `where` is a trusted SQL condition on r/ao/tc.'''
+    cursor.execute('''SELECT r.id,
+                             substr(ao.component_id, 7, 3) as series,
+                             max(CAST(regexp_substr(tc.indicator, '[0123456789]+$') AS SIGNED INTEGER)) AS max_indicator
+                       FROM resource r
+                       JOIN archival_object ao ON ao.root_record_id = r.id
+                       JOIN instance i ON i.archival_object_id = ao.id
+                       JOIN sub_container sc ON i.id = sc.instance_id
+                       JOIN top_container_link_rlshp tclr ON tclr.sub_container_id = sc.id
+                       JOIN top_container tc ON tc.id = tclr.top_container_id
+                       WHERE tc.indicator REGEXP '[0123456789]+$'
+                       AND tc.indicator REGEXP '^[0123456789;, -]+$'
+                       AND {where}
+                       GROUP BY r.id, series
+                       HAVING max_indicator > 0
+                       ORDER BY r.id'''.format(where=where), params)
+    return cursor.fetchall()
+
+CONTAINER_SERIES = '''FROM resource r
+                      JOIN archival_object ao ON ao.root_record_id = r.id
+                      JOIN instance i ON i.archival_object_id = ao.id
+                      JOIN sub_container sc ON i.id = sc.instance_id
+                      JOIN top_container_link_rlshp tclr ON tclr.sub_container_id = sc.id
+                      JOIN top_container tc ON tc.id = tclr.top_container_id'''
+
+def duplicate_indicators(cursor, where='TRUE', params=None):
+    '''Run query for containers that share an indicator within a resource and series (as taken from
+their AOs' component_ids), returning an iterator of lists of them.  Each container is a dict of
+resource id (`id`), series, indicator, container_id and barcode.  `where` is a trusted SQL condition
+on r/ao/tc to restrict the resources and containers considered.
+
+The duplicated (resource, series, indicator)s are found in SQL, so only their containers are sent back.'''
+    params = tuple(params or ())
+    cursor.execute('''SELECT r.id,
+                             substr(ao.component_id, 7, 3) as series,
+                             tc.indicator,
+                             tc.id AS container_id,
+                             tc.barcode
+                       {container_series}
+                       JOIN (SELECT r.id,
+                                    substr(ao.component_id, 7, 3) as series,
+                                    tc.indicator
+                             {container_series}
+                             WHERE {where}
+                             GROUP BY r.id, series, tc.indicator
+                             HAVING count(DISTINCT tc.id) > 1) dupes
+                         ON dupes.id = r.id AND dupes.series = substr(ao.component_id, 7, 3) AND dupes.indicator = tc.indicator
+                       WHERE {where}
+                       GROUP BY r.id, series, tc.id
+                       ORDER BY r.id, series, tc.indicator, tc.id'''.format(container_series=CONTAINER_SERIES, where=where),
+                   (*params, *params,))
+    return _group_duplicates(cursor)
+
+def _group_duplicates(cursor):
+    for key, group in groupby(cursor, key=itemgetter('id', 'series', 'indicator')):
+        containers = list(group)
+        if len(containers) > 1:
+            yield containers
@@ -0,0 +1,252 @@
+'''Helpers for making ArchivesSpace API requests with retries, bounded concurrency and rate limits.'''
+import random, threading, time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+
+from more_itertools import chunked
+from requests.exceptions import ConnectionError, ConnectTimeout
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+# Statuses worth sending a GET or DELETE again for.
+# 500 is deliberately left out, since ASpace may have done (part of) the work before failing.
+RETRY_STATUSES = {429, 502, 503, 504}
+# Statuses where a POST can be assumed not to have been processed, so it's safe to send it again.
+# A 502 or 504 comes from a proxy that may have given up on ASpace while it was still creating the record.
+POST_RETRY_STATUSES = {429, 503}
+
+def idempotent(request):
+    '''Whether request, a client method, is safe to send twice; only POSTs aren't'''
+    return getattr(request, '__name__', None) in ('get', 'put', 'delete')
+
+def not_sent(error):
+    '''Whether a ConnectionError happened while connecting, before anything could have reached ASpace,
+rather than e.g. a connection reset after the request was sent'''
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+def retryable(request, error=None, res=None):
+    '''Whether request can be sent again after failing with error or returning res'''
+    if error is not None:
+        return idempotent(request) or not_sent(error)
+    return res.status_code in (RETRY_STATUSES if idempotent(request) else POST_RETRY_STATUSES)
+
+def retry_delay(attempt, backoff, res=None):
+    '''Seconds to wait before retrying after attempt number `attempt` (from 0): what the server
+asked for in a Retry-After header if it sent one, otherwise backoff * 2 ** attempt, less a random
+up-to-half of it, so that requests which failed together don't all come back together.'''
+    retry_after = res.headers.get('Retry-After') if res is not None and getattr(res, 'headers', None) else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass # an HTTP date; ASpace doesn't send these, so just back off as usual
+    delay = backoff * 2 ** attempt
+    return random.uniform(delay / 2, delay)
+
+def with_retries(request, *args, retries=3, backoff=0.5, **kwargs):
+    '''Call request(*args, **kwargs), retrying with jittered exponential backoff on connection
+errors and on responses with a status in RETRY_STATUSES.  POSTs, which may create records, are
+only retried on a status in POST_RETRY_STATUSES or a failure to connect.  The last response
+is returned regardless of status; the last connection error is raised.'''
+    for attempt in range(retries + 1):
+        res = None
+        try:
+            res = request(*args, **kwargs)
+        except ConnectionError as e:
+            if attempt == retries or not retryable(request, error=e):
+                raise
+        else:
+            if attempt == retries or not retryable(request, res=res):
+                return res
+        time.sleep(retry_delay(attempt, backoff, res))
+
+class BoundedExecutor:
+    '''Thread pool whose submit blocks while `max_pending` tasks are queued or running,
+so that producers can't run arbitrarily far ahead of the workers.
+
+Exceptions raised by tasks are collected, and the first one is re-raised on exit.'''
+    def __init__(self, max_workers, max_pending=None):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending or max_workers * 4)
+        self.errors = []
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception():
+            self.errors.append(future.exception())
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool.shutdown(wait=True)
+        if self.errors and not exc_info[0]:
+            raise self.errors[0]
+
+class RateLimiter:
+    '''Token bucket: calls to wait() return at most `rate` times per second on average, across threads,
+with up to `burst` returning at once after a quiet spell.  A rate of 0 or None means no limit.
+pause(seconds) holds every caller back for a while, e.g. when the server has asked for it.'''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = self.paused_until = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.paused_until - now
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # take a token even if there isn't one yet, and wait for it to be earned
+                self.tokens -= 1
+                delay = max(delay, -self.tokens / self.rate)
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class Scheduler:
+    '''Shared gate for a script's API requests, which backs off when ASpace is struggling and
+speeds back up when it recovers.
+
+Requests are started at most `rate` a second (see RateLimiter; bursts of up to max_concurrency),
+and at most `concurrency` are in flight at once.  concurrency starts at max_concurrency and is
+adjusted the way TCP adjusts its congestion window: it's halved when a request fails with a 429 or
+5xx or a connection error, or takes longer than `target_latency` seconds, and otherwise grows by one
+for each `concurrency` requests that go well, back up to max_concurrency.  Requests already in
+flight when it's halved don't halve it again, so one bad moment only counts once.
+
+Transient failures are retried as in with_retries, except that a Retry-After from the server
+pauses all requests, not just the one that was refused.'''
+    def __init__(self, max_concurrency, rate=0, retries=3, backoff=0.5, target_latency=None, log=None):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.concurrency = self.max_concurrency
+        self.limiter = RateLimiter(rate, burst=self.max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.target_latency = target_latency
+        self.log = log
+        self.slots = threading.Condition()
+        self.in_flight = 0
+        self.decreased_at = time.monotonic()
+
+    def _acquire(self):
+        with self.slots:
+            while self.in_flight >= int(self.concurrency):
+                self.slots.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def _release(self, started, overloaded):
+        with self.slots:
+            self.in_flight -= 1
+            before = int(self.concurrency)
+            if not overloaded:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            elif started >= self.decreased_at:
+                self.concurrency = max(1, self.concurrency / 2)
+                self.decreased_at = time.monotonic()
+            after = int(self.concurrency)
+            self.slots.notify_all()
+        if self.log and after != before:
+            self.log.info('concurrency_change', concurrency=after, reason='overloaded' if overloaded else 'recovered')
+
+    def request(self, request, *args, **kwargs):
+        '''Call request(*args, **kwargs) when there's room, retrying transient failures;
+returns the last response, or raises the last connection error, as with_retries does'''
+        for attempt in range(self.retries + 1):
+            self.limiter.wait()
+            started = self._acquire()
+            res = None
+            try:
+                res = request(*args, **kwargs)
+            except ConnectionError as e:
+                self._release(started, overloaded=True)
+                if attempt == self.retries or not retryable(request, error=e):
+                    raise
+            except BaseException:
+                self._release(started, overloaded=False)
+                raise
+            else:
+                slow = self.target_latency and time.monotonic() - started > self.target_latency
+                self._release(started, overloaded=res.status_code == 429 or res.status_code >= 500 or slow)
+                if attempt == self.retries or not retryable(request, res=res):
+                    return res
+            delay = retry_delay(attempt, self.backoff, res)
+            if res is not None and res.headers.get('Retry-After'):
+                self.limiter.pause(delay)
+            if self.log:
+                self.log.warning('WARN request_retry', status_code=getattr(res, 'status_code', None), attempt=attempt + 1, delay=round(delay, 3))
+            time.sleep(delay)
+
+def http_client(client, backend='requests', connections=100):
+    '''client itself, or with backend 'aiohttp', an AsyncClient sharing its config and session
+that allows up to `connections` requests in flight.  aiohttp is only needed if it's asked for.'''
+    if backend == 'aiohttp':
+        from aspace_async import AsyncClient
+        return AsyncClient.from_client(client, limit=connections)
+    return client
+
+def id_from_uri(uri):
+    return int(uri[uri.rfind('/') + 1:])
+
+# number of missing ids fetch_id_set logs
+MISSING_SAMPLE = 20
+
+def fetch_id_set(client, uri, ids, log, chunk_size=250, parallelism=4, retries=3, store=None, scheduler=None):
+    '''Fetch records from an index endpoint (e.g. 'repositories/2/archival_objects') by id_set,
+with up to `parallelism` chunks in flight at once.  Returns a dict of id:json, or if given,
+`store` (any dict-like, e.g. a records.JSONStore) with the records added to it.
+
+Each chunk is retried as per with_retries, or by `scheduler` if one is given.  A chunk that
+still fails is split in half and the halves are requested separately, down to single ids,
+so one bad record or an oversized request can't sink the rest of its chunk.  That's the only
+way chunk size changes: chunks don't grow again, and the next chunk starts at chunk_size.
+The number of requested ids actually returned is logged, with a sample of those missing.'''
+    ids = sorted(set(ids))
+    fetched = store if store is not None else {}
+    request = scheduler.request if scheduler else partial(with_retries, retries=retries)
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        def submit(chunk):
+            pending[pool.submit(request, client.get, uri, params={'id_set': chunk})] = chunk
+
+        pending = {}
+        for chunk in chunked(ids, chunk_size):
+            submit(chunk)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                res = None if future.exception() else future.result()
+                if res is not None and res.status_code == 200:
+                    log.info('fetch_chunk_complete', uri=uri, chunk="{}-{}".format(chunk[0], chunk[-1]))
+                    for record in res.json():
+                        fetched[id_from_uri(record['uri'])] = record
+                elif len(chunk) > 1:
+                    log.warning('WARN fetch_chunk_split', uri=uri, chunk="{}-{}".format(chunk[0], chunk[-1]),
+                                status_code=getattr(res, 'status_code', None), error=repr(future.exception()))
+                    half = len(chunk) // 2
+                    submit(chunk[:half])
+                    submit(chunk[half:])
+                else:
+                    log.error('FAIL fetch_chunk', uri=uri, id=chunk[0],
+                              status_code=getattr(res, 'status_code', None), error=repr(future.exception()))
+
+    missing = [i for i in ids if i not in fetched]
+    log.info('fetch_id_set_complete', uri=uri, requested=len(ids), returned=len(ids) - len(missing),
+             missing=len(missing), missing_sample=missing[:MISSING_SAMPLE])
+    return fetched
@@ -0,0 +1,87 @@
+'''Mutation batches: ordered files of changes to make through the ArchivesSpace API, written by
+scripts run with --save_batch and applied later by apply_batch.py.
+
+A batch is JSON Lines, one operation per line, each with a unique `key` and the `uri` it acts on:
+
+- create: POST `json` to uri
+- update: set `fields` of the record at uri
+- append: add `values` to the list `field` of the record at uri, first removing any fields in `unset`
+- delete: delete the record at uri
+
+update, append and delete can carry the `lock_version` the record had when the batch was written,
+and a create of a top container can carry `series_indicators`, the box number it takes in each series
+as a dict of "resource_id.series":indicator, to be saved to the series index once it's created.
+A create can also carry `discard_unless`, the keys of operations the record is no use without; if any
+of them fails, the record is deleted again rather than left orphaned.
+A value of the form {"$ref": key} stands for the uri of the record created by the create operation
+with that key, and `after` lists the keys of other operations that have to succeed first.'''
+import json, os
+
+def ref(key):
+    return {'$ref': key}
+
+def refs(value):
+    '''Keys of the creates value refers to'''
+    if isinstance(value, dict):
+        if '$ref' in value:
+            yield value['$ref']
+        else:
+            for v in value.values():
+                yield from refs(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from refs(v)
+
+def resolve(value, uris):
+    '''value with refs replaced by the uris of the records created, from uris, a dict of key:uri'''
+    if isinstance(value, dict):
+        if '$ref' in value:
+            return uris[value['$ref']]
+        return {k: resolve(v, uris) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve(v, uris) for v in value]
+    return value
+
+def dependencies(op):
+    '''Keys of the operations op has to wait for'''
+    return {*refs(op.get('json')), *refs(op.get('values')), *refs(op.get('fields')), *op.get('after', ())}
+
+def read_batch(filename):
+    with open(filename) as f:
+        for line in f:
+            yield json.loads(line)
+
+class BatchWriter:
+    '''Writes a batch, which only appears under its name once closed'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename + '.tmp', 'w')
+        self.count = 0
+
+    def write(self, op, key, uri, after=(), **fields):
+        entry = {'op': op, 'key': key, 'uri': uri, **{k: v for k, v in fields.items() if v is not None}}
+        if after:
+            entry['after'] = list(after)
+        self.f.write(json.dumps(entry) + '\n')
+        self.count += 1
+        return key
+
+    def create(self, key, uri, json, after=(), series_indicators=None, discard_unless=()):
+        '''Write a create, returning a ref to the record it'll create'''
+        self.write('create', key, uri, after, json=json, series_indicators=series_indicators,
+                   discard_unless=list(discard_unless) or None)
+        return ref(key)
+
+    def update(self, key, uri, fields, lock_version=None, after=()):
+        return self.write('update', key, uri, after, fields=fields, lock_version=lock_version)
+
+    def append(self, key, uri, field, values, lock_version=None, unset=(), after=()):
+        return self.write('append', key, uri, after, field=field, values=values, lock_version=lock_version,
+                          unset=list(unset) or None)
+
+    def delete(self, key, uri, lock_version=None, after=()):
+        return self.write('delete', key, uri, after, lock_version=lock_version)
+
+    def close(self):
+        self.f.close()
+        os.replace(self.filename + '.tmp', self.filename)
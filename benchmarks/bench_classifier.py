@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+'''Compare component_ids.sniff_box_number against the original three-pattern implementation
+on a synthetic corpus of component IDs, checking that both give identical results.'''
+import os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from argparse import ArgumentParser
+
+import regex as re
+
+from component_ids import sniff_box_number, sniff_box_numbers
+
+ap = ArgumentParser(description="Micro-benchmark for component ID classification")
+ap.add_argument('--count', type=int, default=3000000, help='number of component IDs in corpus')
+ap.add_argument('--distinct', type=float, default=0.4, help='fraction of the corpus that is distinct IDs, the rest being repeats')
+ap.add_argument('--seed', type=int, default=1, help='random seed for corpus generation')
+
+# Original implementation, as it was in map_box_numbers.py
+normal = re.compile(r'^(?P<coll_id>[^.]{5})\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<box_no>\d{3})\.\d{5}(?:\.\d{5})?$')
+box_level = re.compile(r'^(?P<coll_id>[^.]{5})\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<penultimate>\d{3})\.(?P<last>\d{3})$')
+weird_MS004 = re.compile(r'^(?P<coll_id>MS004)\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<box_no>\d{3})\.\d{4}\.\d{2}.\d{4}$')
+def reference_sniff_box_number(component_id):
+    if '-' in component_id:
+        return {"box_no": "Green Barcode"}
+    m = normal.match(component_id) or\
+        box_level.match(component_id) or\
+        weird_MS004.match(component_id)
+    if m:
+        return m.groupdict()
+
+    return {"box_no": "Cannot Assign"}
+
+def random_component_id(rand):
+    '''Component ID in one of the shapes seen in Tufts data, weighted roughly as they occur'''
+    coll_id = rand.choice(['MS001', 'MS004', 'UA021', 'MS123', 'PB004'])
+    series = '.'.join('{:03}'.format(rand.randint(1, 20)) for _ in range(rand.choice([1, 1, 1, 2, 3])))
+    box = '{:03}'.format(rand.randint(1, 300))
+    shape = rand.random()
+    if shape < 0.70:
+        return '{}.{}.{}.{:05}'.format(coll_id, series, box, rand.randint(1, 99999))
+    elif shape < 0.75:
+        return '{}.{}.{}.{:05}.{:05}'.format(coll_id, series, box, rand.randint(1, 99999), rand.randint(1, 99999))
+    elif shape < 0.85:
+        return '{}.{}.{}.{:03}'.format(coll_id, series, box, rand.choice([1, 1, rand.randint(1, 999)]))
+    elif shape < 0.88:
+        return 'MS004.{}.{}.{:04}.{:02}.{:04}'.format(series, box, rand.randint(1, 9999), rand.randint(1, 99), rand.randint(1, 9999))
+    elif shape < 0.93:
+        return '{}-{:05}'.format(coll_id, rand.randint(1, 99999))
+    else:
+        return '{}.{}'.format(coll_id, rand.randint(1, 99999))
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    print('{:<40}{:>8.2f}s'.format(label, time.perf_counter() - start))
+    return result
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    rand = random.Random(args.seed)
+
+    distinct = [random_component_id(rand) for _ in range(int(args.count * args.distinct))]
+    corpus = distinct + [rand.choice(distinct) for _ in range(args.count - len(distinct))]
+    rand.shuffle(corpus)
+    print('{} component IDs, {} distinct'.format(len(corpus), len(set(corpus))))
+
+    expected = timed('reference (three patterns)', lambda: [reference_sniff_box_number(cid) for cid in corpus])
+    sniff_box_number.cache_clear()
+    actual = timed('combined pattern, cold cache', lambda: sniff_box_numbers(corpus))
+    timed('combined pattern, warm cache', lambda: sniff_box_numbers(corpus))
+
+    # reference groupdicts include groups that didn't participate as None, so compare without them
+    mismatches = [(cid, e, a) for cid, e, a in zip(corpus, expected, actual)
+                  if {k:v for k,v in e.items() if v is not None} != a]
+    if mismatches:
+        print('{} mismatches, e.g. {}'.format(len(mismatches), mismatches[:5]))
+        sys.exit(1)
+    print('results identical')
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+'''Generate a synthetic ArchivesSpace dataset for benchmarking.
+
+Writes, into an output directory:
+  aspace.sql         schema for the tables the scripts query, plus data, to load into a scratch MySQL database
+  records.json       API jsons for archival objects and top containers, keyed by uri, for stub_server.py
+  green_barcodes.xlsx    pseudo-location barcodes, for map_green_barcode_box_numbers.py
+  barcode_source.xlsx    new barcodes, for map_green_barcode_box_numbers.py'''
+import json, os, random
+from argparse import ArgumentParser
+from datetime import datetime
+
+from openpyxl import Workbook
+
+ap = ArgumentParser(description="Generate synthetic ArchivesSpace data for benchmarks")
+ap.add_argument('output_dir', help='directory to write data into')
+ap.add_argument('--resources', type=int, default=50, help='number of resources')
+ap.add_argument('--max_series', type=int, default=4, help='maximum number of series per resource')
+ap.add_argument('--boxes_per_series', type=int, default=20, help='average number of boxes per series')
+ap.add_argument('--aos_per_box', type=int, default=15, help='average number of archival objects per box')
+ap.add_argument('--seed', type=int, default=1, help='random seed')
+
+SCHEMA = '''
+DROP TABLE IF EXISTS resource, archival_object, instance, sub_container, top_container_link_rlshp, top_container, location;
+CREATE TABLE resource (id INT PRIMARY KEY, repo_id INT NOT NULL DEFAULT 2, identifier VARCHAR(255), ead_id VARCHAR(255), lock_version INT NOT NULL DEFAULT 0, system_mtime DATETIME NOT NULL);
+CREATE TABLE archival_object (id INT PRIMARY KEY, repo_id INT NOT NULL DEFAULT 2, root_record_id INT, component_id VARCHAR(255), position INT, title VARCHAR(8704),
+                              lock_version INT NOT NULL DEFAULT 0, system_mtime DATETIME NOT NULL,
+                              KEY (root_record_id), KEY (component_id), KEY (system_mtime));
+CREATE TABLE instance (id INT PRIMARY KEY, archival_object_id INT, KEY (archival_object_id));
+CREATE TABLE sub_container (id INT PRIMARY KEY, instance_id INT, KEY (instance_id));
+CREATE TABLE top_container_link_rlshp (id INT PRIMARY KEY, top_container_id INT, sub_container_id INT,
+                                       KEY (top_container_id), KEY (sub_container_id));
+CREATE TABLE top_container (id INT PRIMARY KEY, repo_id INT NOT NULL DEFAULT 2, barcode VARCHAR(255), indicator VARCHAR(255),
+                            lock_version INT NOT NULL DEFAULT 0, system_mtime DATETIME NOT NULL,
+                            KEY (barcode), KEY (indicator), KEY (system_mtime));
+CREATE TABLE location (id INT PRIMARY KEY, barcode VARCHAR(255), building VARCHAR(255), KEY (barcode));
+'''
+
+# Proportions of each kind of container generated, the remainder being ordinary boxes
+CONTAINER_KINDS = [('volume', 0.05), ('dgb', 0.03), ('green', 0.05), ('shared', 0.03), ('series_shared', 0.03), ('numbered', 0.08)]
+
+class Dataset:
+    def __init__(self, rand):
+        self.rand = rand
+        self.now = datetime(2019, 6, 1, 12, 0, 0)
+        self.tables = {name:[] for name in ('resource', 'archival_object', 'instance', 'sub_container',
+                                            'top_container_link_rlshp', 'top_container', 'location')}
+        self.records = {}
+        self.barcode_seq = 30000000000000
+        self.green_barcodes = []
+
+    def next_id(self, table):
+        return len(self.tables[table]) + 1
+
+    def barcode(self, suffix=''):
+        self.barcode_seq += 1
+        return '{}{}'.format(self.barcode_seq, suffix)
+
+    def resource(self, coll_id):
+        rid = self.next_id('resource')
+        self.tables['resource'].append({'id': rid, 'identifier': json.dumps([coll_id, None, None, None]),
+                                        'ead_id': coll_id.lower(), 'lock_version': 0, 'system_mtime': self.now})
+        return rid
+
+    def container(self, barcode, indicator=None):
+        tc_id = self.next_id('top_container')
+        indicator = indicator or 'data_value_missing_{}'.format(tc_id)
+        self.tables['top_container'].append({'id': tc_id, 'barcode': barcode, 'indicator': indicator,
+                                             'lock_version': 0, 'system_mtime': self.now})
+        uri = '/repositories/2/top_containers/{}'.format(tc_id)
+        self.records[uri] = {'jsonmodel_type': 'top_container', 'uri': uri, 'id': tc_id, 'type': 'box',
+                             'barcode': barcode, 'indicator': indicator, 'lock_version': 0,
+                             'system_mtime': self.now.isoformat() + 'Z', 'container_locations': []}
+        return tc_id
+
+    def ao(self, resource_id, component_id, tc_id):
+        ao_id = self.next_id('archival_object')
+        title = 'Folder {}'.format(component_id)
+        self.tables['archival_object'].append({'id': ao_id, 'root_record_id': resource_id, 'component_id': component_id,
+                                               'position': ao_id, 'title': title, 'lock_version': 0, 'system_mtime': self.now})
+        instance_id = self.next_id('instance')
+        self.tables['instance'].append({'id': instance_id, 'archival_object_id': ao_id})
+        sub_container_id = self.next_id('sub_container')
+        self.tables['sub_container'].append({'id': sub_container_id, 'instance_id': instance_id})
+        self.tables['top_container_link_rlshp'].append({'id': self.next_id('top_container_link_rlshp'),
+                                                        'top_container_id': tc_id, 'sub_container_id': sub_container_id})
+        uri = '/repositories/2/archival_objects/{}'.format(ao_id)
+        self.records[uri] = {'jsonmodel_type': 'archival_object', 'uri': uri, 'title': title, 'component_id': component_id,
+                             'position': ao_id, 'lock_version': 0, 'system_mtime': self.now.isoformat() + 'Z',
+                             'resource': {'ref': '/repositories/2/resources/{}'.format(resource_id)},
+                             'instances': [{'jsonmodel_type': 'instance', 'instance_type': 'mixed_materials',
+                                            'sub_container': {'jsonmodel_type': 'sub_container',
+                                                              'top_container': {'ref': '/repositories/2/top_containers/{}'.format(tc_id)}}}]}
+        return ao_id
+
+    def location(self, barcode):
+        self.tables['location'].append({'id': self.next_id('location'), 'barcode': barcode, 'building': 'Tisch/DCA'})
+
+def container_kind(rand):
+    roll = rand.random()
+    for kind, proportion in CONTAINER_KINDS:
+        if roll < proportion:
+            return kind
+        roll -= proportion
+    return 'box'
+
+def generate(args):
+    rand = random.Random(args.seed)
+    data = Dataset(rand)
+    resources = [('MS{:03}'.format(n), data.resource('MS{:03}'.format(n)),) for n in range(1, args.resources + 1)]
+
+    for coll_id, resource_id in resources:
+        series_count = rand.randint(1, args.max_series)
+        for series in range(1, series_count + 1):
+            for box in range(1, max(1, int(rand.gauss(args.boxes_per_series, args.boxes_per_series / 4))) + 1):
+                kind = container_kind(rand)
+                folders = max(1, int(rand.gauss(args.aos_per_box, args.aos_per_box / 3)))
+                prefix = '{}.{:03}.{:03}'.format(coll_id, series, box)
+                if kind == 'volume':
+                    tc_id = data.container(data.barcode('b'))
+                    data.ao(resource_id, '{}.001'.format(prefix), tc_id)
+                elif kind == 'dgb':
+                    tc_id = data.container('DGB{:06}'.format(data.next_id('top_container')))
+                    data.ao(resource_id, '{}.00001'.format(prefix), tc_id)
+                elif kind == 'green':
+                    barcode = data.barcode()
+                    data.green_barcodes.append(barcode)
+                    if rand.random() < 0.5:
+                        data.location(barcode)
+                    tc_id = data.container(barcode + rand.choice('gG'))
+                    for n in range(1, folders + 1):
+                        # a share of green barcode AOs have non-normative component ids
+                        if rand.random() < 0.2:
+                            data.ao(resource_id, '{}-{:05}'.format(coll_id, rand.randint(1, 99999)), tc_id)
+                        else:
+                            data.ao(resource_id, '{}.{:05}'.format(prefix, n), tc_id)
+                elif kind == 'shared':
+                    tc_id = data.container(data.barcode())
+                    other_coll_id, other_resource_id = rand.choice(resources)
+                    data.ao(resource_id, '{}.00001'.format(prefix), tc_id)
+                    data.ao(other_resource_id, '{}.001.{:03}.00001'.format(other_coll_id, box), tc_id)
+                elif kind == 'series_shared':
+                    tc_id = data.container(data.barcode())
+                    data.ao(resource_id, '{}.00001'.format(prefix), tc_id)
+                    data.ao(resource_id, '{}.{:03}.{:03}.00001'.format(coll_id, series + 1, box), tc_id)
+                else:
+                    # numbered boxes already have indicators, some of them duplicated within their series
+                    indicator = str(rand.choice([box, box, box, max(1, box - 1)])) if kind == 'numbered' else None
+                    tc_id = data.container(data.barcode(), indicator)
+                    for n in range(1, folders + 1):
+                        data.ao(resource_id, '{}.{:05}'.format(prefix, n), tc_id)
+    return data
+
+def sql_value(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, datetime):
+        value = value.strftime('%Y-%m-%d %H:%M:%S')
+    return "'{}'".format(str(value).replace('\\', '\\\\').replace("'", "\\'"))
+
+def write_sql(data, f):
+    f.write(SCHEMA)
+    for table, rows in data.tables.items():
+        for start in range(0, len(rows), 1000):
+            batch = rows[start:start + 1000]
+            f.write('INSERT INTO {} ({}) VALUES\n'.format(table, ', '.join(batch[0])))
+            f.write(',\n'.join('({})'.format(', '.join(sql_value(v) for v in row.values())) for row in batch))
+            f.write(';\n')
+
+def write_barcodes(barcodes, filename):
+    wb = Workbook()
+    for barcode in barcodes:
+        wb.active.append([barcode])
+    wb.save(filename)
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+    data = generate(args)
+
+    with open(os.path.join(args.output_dir, 'aspace.sql'), 'w') as f:
+        write_sql(data, f)
+    with open(os.path.join(args.output_dir, 'records.json'), 'w') as f:
+        json.dump(data.records, f)
+    # green script reads pseudo-location barcodes without a header, and takes the rest from the database
+    write_barcodes(data.green_barcodes[::2], os.path.join(args.output_dir, 'green_barcodes.xlsx'))
+    write_barcodes((data.barcode() for _ in range(len(data.tables['top_container']))), os.path.join(args.output_dir, 'barcode_source.xlsx'))
+
+    print(', '.join('{} {}'.format(len(rows), table) for table, rows in data.tables.items()))
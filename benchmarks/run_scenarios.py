@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+'''Run timed benchmark scenarios for the scripts against a scratch MySQL database loaded with
+generate_data.py's aspace.sql, and a fresh stub_server.py per scenario.
+
+Each scenario's wall time, peak RSS and API request counts are printed, and appended as a
+JSON line to --results, so runs can be compared between releases.'''
+import json, os, subprocess, sys, tempfile, time
+from argparse import ArgumentParser
+from datetime import datetime
+
+from stub_server import serve
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ap = ArgumentParser(description="Run benchmark scenarios against synthetic data")
+ap.add_argument('data_dir', help='directory produced by generate_data.py, with aspace.sql already loaded into --database')
+ap.add_argument('--host', default='localhost', help="host of scratch MySQL database")
+ap.add_argument('--user', default='root', help='MySQL user for scratch database')
+ap.add_argument('--password', default='', help='MySQL password for scratch database')
+ap.add_argument('--database', default='aspace_bench', help='name of scratch MySQL database')
+ap.add_argument('--latency', type=float, default=0.02, help='seconds of latency for the stub API to add to each request')
+ap.add_argument('--results', default='bench_results.jsonl', help='file to append results to')
+ap.add_argument('scenarios', nargs='*', help='scenarios to run (default: all)')
+
+def scenarios(data_dir):
+    '''name: argument list, for each scenario'''
+    return {
+        'map_box_numbers_dry_run': ['map_box_numbers.py'],
+        'map_box_numbers_commit': ['map_box_numbers.py', '--commit'],
+        'map_box_numbers_stream_commit': ['map_box_numbers.py', '--commit', '--stream'],
+        'map_green_barcode_box_numbers': ['map_green_barcode_box_numbers.py',
+                                          os.path.join(data_dir, 'green_barcodes.xlsx'),
+                                          os.path.join(data_dir, 'barcode_source.xlsx')],
+        'report_duplicates': ['report_duplicates.py'],
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(name, argv, args, records):
+    server, stub = serve(records, latency=args.latency)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            config = os.path.join(workdir, 'archivessnake.yml')
+            with open(config, 'w') as f:
+                f.write('baseurl: http://127.0.0.1:{}\nusername: admin\npassword: admin\n'.format(server.server_address[1]))
+
+            command = [sys.executable, os.path.join(REPO, argv[0]), *argv[1:],
+                       '--host', args.host, '--user', args.user, '--database', args.database]
+            # Run in a new session, so getpass has no terminal and reads the password from stdin
+            start = time.perf_counter()
+            proc = subprocess.Popen(command, cwd=workdir, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                    env={**os.environ, 'ASNAKE_CONFIG_FILE': config},
+                                    start_new_session=True)
+            proc.stdin.write((args.password + '\n').encode('utf-8'))
+            proc.stdin.close()
+            stderr = proc.stderr.read()
+            _, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {'scenario': name,
+            'revision': git_revision(),
+            'timestamp': datetime.now().isoformat(),
+            'latency': args.latency,
+            'exit_code': proc.returncode,
+            'seconds': round(elapsed, 3),
+            # ru_maxrss is in kilobytes on Linux
+            'max_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+            'requests': sum(stub.stats.values()),
+            'requests_by_endpoint': dict(stub.stats),
+            'stderr': stderr.decode('utf-8', 'replace')[-2000:] if proc.returncode else None}
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    with open(os.path.join(args.data_dir, 'records.json')) as f:
+        records_json = f.read()
+
+    available = scenarios(os.path.abspath(args.data_dir))
+    for name in args.scenarios or available:
+        result = run(name, available[name], args, json.loads(records_json))
+        print('{:<35}{:>9.2f}s{:>9.1f}MB{:>8} requests{}'.format(
+            name, result['seconds'], result['max_rss_mb'], result['requests'],
+            '' if result['exit_code'] == 0 else '  FAILED ({})'.format(result['exit_code'])))
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result) + '\n')
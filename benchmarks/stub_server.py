@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+'''Minimal stand-in for the ArchivesSpace backend API, serving records.json from generate_data.py.
+
+Supports the requests the scripts make: login, version, fetching records singly or by id_set,
+updating records (bumping lock_version, and refusing stale ones with 409), creating top
+containers, digital objects and locations, and deleting records.  Every request is delayed
+by --latency seconds (plus up to --jitter more), and counted per endpoint; GET /_stats returns
+the counts.'''
+import json, random, re, threading, time
+from argparse import ArgumentParser
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+ap = ArgumentParser(description="Stub ArchivesSpace API server for benchmarks")
+ap.add_argument('records', help='records.json produced by generate_data.py')
+ap.add_argument('--port', type=int, default=4567, help='port to listen on')
+ap.add_argument('--latency', type=float, default=0.02, help='seconds to delay each request')
+ap.add_argument('--jitter', type=float, default=0.0, help='maximum additional random delay per request')
+
+# collection uris new records can be POSTed to, and the record type they create
+CREATABLE = {'/repositories/2/top_containers': 'top_container',
+             '/repositories/2/digital_objects': 'digital_object',
+             '/locations': 'location'}
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def endpoint(path):
+    '''Path with ids replaced, for grouping request counts'''
+    return re.sub(r'/\d+', '/:id', path)
+
+class StubASpace:
+    def __init__(self, records, latency=0.0, jitter=0.0):
+        self.records = records
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.next_id = max((int(uri.rsplit('/', 1)[1]) for uri in records), default=0) + 1
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, body):
+                data = body.encode('utf-8') if isinstance(body, str) else json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def handle_method(self, method):
+                url = urlsplit(self.path)
+                path = '/' + url.path.strip('/')
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if path != '/_stats':
+                    with stub.lock:
+                        stub.stats['{} {}'.format(method, endpoint(path))] += 1
+                    time.sleep(stub.latency + random.random() * stub.jitter)
+                status, response = stub.dispatch(method, path, parse_qs(url.query), body)
+                self.respond(status, response)
+
+            def do_GET(self):
+                self.handle_method('GET')
+
+            def do_POST(self):
+                self.handle_method('POST')
+
+            def do_DELETE(self):
+                self.handle_method('DELETE')
+
+        return Handler
+
+    def dispatch(self, method, path, query, body):
+        if path == '/_stats':
+            return 200, dict(self.stats)
+        if method == 'POST' and re.match(r'^/users/[^/]+/login$', path):
+            return 200, {'session': 'stub-session'}
+        if path == '/version':
+            return 200, 'ArchivesSpace (v2.5.1)'
+
+        with self.lock:
+            if method == 'GET':
+                if 'id_set[]' in query:
+                    return 200, [self.records[uri] for uri in ('{}/{}'.format(path, i) for i in query['id_set[]']) if uri in self.records]
+                if path in self.records:
+                    return 200, self.records[path]
+                return 404, {'error': 'Record not found'}
+
+            if method == 'DELETE':
+                if self.records.pop(path, None) is None:
+                    return 404, {'error': 'Record not found'}
+                return 200, {'status': 'Deleted', 'uri': path}
+
+            record = json.loads(body or b'{}')
+            if path in CREATABLE:
+                new_id = self.next_id
+                self.next_id += 1
+                uri = '{}/{}'.format(path, new_id)
+                self.records[uri] = {**record, 'uri': uri, 'id': new_id, 'lock_version': 0, 'jsonmodel_type': CREATABLE[path]}
+                return 200, {'status': 'Created', 'id': new_id, 'uri': uri, 'lock_version': 0}
+            if path in self.records:
+                current = self.records[path]
+                if record.get('lock_version', current['lock_version']) != current['lock_version']:
+                    return 409, {'error': {'lock_version': ['conflict']}}
+                self.records[path] = {**record, 'uri': path, 'lock_version': current['lock_version'] + 1}
+                return 200, {'status': 'Updated', 'id': int(path.rsplit('/', 1)[1]), 'uri': path,
+                             'lock_version': current['lock_version'] + 1}
+            return 404, {'error': 'Record not found'}
+
+def serve(records, port=0, latency=0.0, jitter=0.0):
+    '''Start a stub server in a background thread, returning (server, stub).  Port 0 picks a free port.'''
+    stub = StubASpace(records, latency, jitter)
+    server = ThreadingHTTPServer(('127.0.0.1', port), stub.handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stub
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    with open(args.records) as f:
+        records = json.load(f)
+    server, stub = serve(records, args.port, args.latency, args.jitter)
+    print('Serving {} records on http://127.0.0.1:{}'.format(len(records), server.server_address[1]))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print(json.dumps(dict(stub.stats), indent=2))
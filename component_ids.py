@@ -0,0 +1,33 @@
+'''Classification of Tufts component IDs by the box number information they carry.'''
+from functools import lru_cache
+
+import regex as re
+
+# The three recognized shapes of component ID, tried in this order:
+#   normal:      coll_id.series[.subseries...].box_no.#####[.#####]
+#   box_level:   coll_id.series[.subseries...].penultimate.last
+#   weird_MS004: MS004.series[.subseries...].box_no.####.##.####
+# Each alternative carries its own anchors and prefix, so the engine exhausts one before trying
+# the next, giving the same result as matching the patterns one at a time.
+component_id_pattern = re.compile(r'''
+    ^(?:
+        (?P<coll_id>[^.]{5})\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<box_no>\d{3})\.\d{5}(?:\.\d{5})?
+      | (?P<coll_id>[^.]{5})\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<penultimate>\d{3})\.(?P<last>\d{3})
+      | (?P<coll_id>MS004)\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<box_no>\d{3})\.\d{4}\.\d{2}.\d{4}
+    )$''', re.VERBOSE)
+
+@lru_cache(maxsize=2**20)
+def sniff_box_number(component_id):
+    '''Return dict of the parts of component_id relevant to box numbers, or a dict with a box_no
+of "Green Barcode" or "Cannot Assign".  Results are cached and shared, so must not be modified.'''
+    if '-' in component_id:
+        return {"box_no": "Green Barcode"}
+    m = component_id_pattern.match(component_id)
+    if m:
+        return {k:v for k,v in m.groupdict().items() if v is not None}
+
+    return {"box_no": "Cannot Assign"}
+
+def sniff_box_numbers(component_ids):
+    '''Classify a list of component IDs, as per sniff_box_number'''
+    return [sniff_box_number(cid) for cid in component_ids]
@@ -1,10 +1,10 @@
 import json
 from argparse import ArgumentParser
+from contextlib import closing
 from getpass import getpass
 
 import pymysql
 
-from openpyxl import load_workbook
 from more_itertools import first
 
 from asnake.aspace import ASpace
@@ -12,53 +12,74 @@ from asnake.logging import setup_logging, get_logger
 from asnake.aspace import ASpace
 from asnake.jsonmodel import JM
 
+from aspace_requests import BoundedExecutor, Scheduler, http_client
+from instrumentation import Metrics, instrument_client, instrument_cursor
+from spreadsheets import sheet_rows
+
 ap = ArgumentParser(description="Script to create locations from spreadsheet")
-ap.add_argument('spreadsheet', type=load_workbook, help="Spreadsheet of location attrs")
+ap.add_argument('spreadsheet', help="Spreadsheet (Excel, CSV or TSV) of location attrs")
 ap.add_argument('--host', default='localhost', help="host of ASpace database")
 ap.add_argument('--user', default='pobocks', help='MySQL user to run as when connecting to ASpace database')
 ap.add_argument('--database', default='tuftschivesspace', help="Name of MySQL database")
 ap.add_argument('--logfile', default='create_locations.log', help='path to print log to')
+ap.add_argument('--workers', type=int, default=4, help='maximum number of locations to create at once; fewer are created while ASpace is struggling')
+ap.add_argument('--retries', type=int, default=3, help='number of times to retry a request that fails with a transient error')
+ap.add_argument('--rate', type=float, default=0, help='maximum number of requests to ASpace to start per second; 0 for no limit')
+ap.add_argument('--target_latency', type=float, help='seconds a request may take before ASpace is taken to be overloaded and fewer are made at once')
+ap.add_argument('--http_backend', choices=('requests', 'aiohttp'), default='requests', help='HTTP client to talk to ASpace with; aiohttp gives all workers one shared pool of connections')
+ap.add_argument('--connections', type=int, default=100, help='maximum number of requests in flight at once with the aiohttp backend')
+ap.add_argument('--metrics', default='create_locations.metrics.json', help='path to write timing, request and query metrics to')
+
+def create_location(location):
+    log.info('create_start', barcode=location['barcode'])
+    res = scheduler.request(aspace.client.post, 'locations', json=location)
+    if res.status_code == 200:
+        log.info('create_success', result=res.json())
+    else:
+        log.info('create_error', result=res.json(), status_code=res.status_code)
 
 if __name__ == "__main__":
     args = ap.parse_args()
     setup_logging(filename=args.logfile)
     log = get_logger('create_locations')
+    metrics = Metrics()
 
     log.info('start')
+    metrics.phase('connect')
 
     aspace = ASpace()
+    aspace.client = http_client(aspace.client, args.http_backend, args.connections)
+    instrument_client(aspace.client, metrics)
     log.info('aspace_connect')
-
-    log.info('process_spreadsheet')
-    rows = args.spreadsheet.worksheets[0].values
-    headers = dict(enumerate(first(rows)))
-    JSONS = []
+    scheduler = Scheduler(args.workers, rate=args.rate, retries=args.retries, target_latency=args.target_latency, log=log)
 
     conn = pymysql.connect(host=args.host, user=args.user, database=args.database, cursorclass=pymysql.cursors.DictCursor,
                            password=getpass("Please enter MySQL password for {}: ".format(args.user)))
     log.info('mysql_connect')
 
-    for row in rows:
-        row_dict = {headers[idx]:str(field) for idx, field in enumerate(row)}
-        profile_uri = row_dict.pop('location_profile_URI')
-        row_dict['location_profile'] = {'ref': '/' + profile_uri }
-        JSONS.append(row_dict)
-
-
-        with conn:
-            db = conn.cursor()
-            db.execute('SELECT DISTINCT barcode FROM location')
-            existing_barcodes = set(row['barcode'] for row in db.fetchall())
+    metrics.phase('load_existing_barcodes')
+    with conn:
+        db = instrument_cursor(conn.cursor(), metrics)
+        db.execute('SELECT DISTINCT barcode FROM location')
+        existing_barcodes = set(row['barcode'] for row in db.fetchall())
+    log.info('got_existing_barcodes', count=len(existing_barcodes))
 
     log.info('create_locations')
-    for location in JSONS:
-        log.info('create_start', barcode=location['barcode'])
-        if location['barcode'] in existing_barcodes:
-            log.info('location_already_exists', barcode=location['barcode'])
-            continue
-        res = aspace.client.post('locations', json=location)
-        if res.status_code == 200:
-            log.info('create_success', result=res.json())
-        else:
-            log.info('create_error', result=res.json(), status_code=res.status_code)
+    metrics.phase('create_locations')
+    # rows are streamed, and the workbook closed once they've all been read
+    with closing(sheet_rows(args.spreadsheet)) as rows, BoundedExecutor(max_workers=args.workers) as creates:
+        headers = dict(enumerate(first(rows)))
+        for row in rows:
+            location = {headers[idx]:str(field) for idx, field in enumerate(row)}
+            profile_uri = location.pop('location_profile_URI')
+            location['location_profile'] = {'ref': '/' + profile_uri }
+
+            if location['barcode'] in existing_barcodes:
+                log.info('location_already_exists', barcode=location['barcode'])
+                continue
+            # so that a barcode repeated in the spreadsheet is only created once
+            existing_barcodes.add(location['barcode'])
+            creates.submit(create_location, location)
+            metrics.count()
     log.info('end')
+    metrics.report(args.metrics)
@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
-import json, csv, sys
+import json, csv, re, sys
 from collections import Counter
-from itertools import chain
-from more_itertools import peekable
+from multiprocessing import Pool
+from more_itertools import peekable, chunked
 from argparse import ArgumentParser, FileType
+from getpass import getpass
+
+import pymysql
+
+from aspace_db import container_aos
 
 csv.field_size_limit(sys.maxsize)
 
 ap = ArgumentParser(description="Parse output of 'container_id_and_barcode2component_identifiers.sql' into a report on patterns found")
-ap.add_argument('input_file', type=FileType('r'), help='Tab delimited CSV of: component ids, barcodes, and JSON arrays of component identifiers')
+ap.add_argument('input_file', nargs='?', type=FileType('r'), help='Tab delimited CSV of: component ids, barcodes, and JSON arrays of component identifiers')
+ap.add_argument('--from_database', action='store_true', help='read component identifiers from the ASpace database rather than from input_file')
+ap.add_argument('--host', default='localhost', help="host of ASpace database")
+ap.add_argument('--user', default='pobocks', help='MySQL user to run as when connecting to ASpace database')
+ap.add_argument('--database', default='tuftschivesspace', help="Name of MySQL database")
+ap.add_argument('--repository', type=int, default=2, help='id of ASpace repository to report on, with --from_database')
+ap.add_argument('--chunk_size', type=int, default=10000, help='number of containers to count at a time')
+ap.add_argument('--processes', type=int, default=1, help='number of processes to count chunks in')
 
 def countify(pattern):
     '''Turn pattern into regexp'''
@@ -29,18 +41,69 @@ def countify(pattern):
             output += r'\d{{{}}}'.format(count)
     return output
 
+DIGIT_RUN = re.compile('[0-9]+')
+NON_ASCII = re.compile('[^\x00-\x7f]')
+
+def digit_run(match):
+    # countify has always counted a run of n digits as \d{n+1}; kept so reports stay comparable
+    return r'\d{{{}}}'.format(match.end() - match.start() + 1)
+
+def shape(component_id):
+    '''Same as countify(component_id), a regex at a time rather than a character at a time'''
+    # isdigit is true of more than 0-9 outside of ASCII, so those are left to countify
+    if NON_ASCII.search(component_id):
+        return countify(component_id)
+    return DIGIT_RUN.sub(digit_run, component_id).replace('.', '\.')
+
+# Only the lengths of runs of digits matter to a pattern, so ids are counted with every digit as 0
+ZEROED = str.maketrans('0123456789', '0000000000')
+
+def census(id_lists):
+    '''Count patterns of the component ids in id_lists.  Ids are counted by shape (digits zeroed),
+and each shape is only turned into a pattern once.  Patterns are counted in the order they're
+first seen, as countify-ing ids in order would.'''
+    shapes = Counter(cid.translate(ZEROED) for cids in id_lists for cid in cids)
+    report = Counter()
+    for zeroed, count in shapes.items():
+        report[shape(zeroed)] += count
+    return report
+
+def census_json(json_arrays):
+    return census(json.loads(a) for a in json_arrays)
+
+def database_id_lists(args):
+    conn = pymysql.connect(host=args.host, user=args.user, database=args.database, cursorclass=pymysql.cursors.SSDictCursor,
+                           password=getpass("Please enter MySQL password for {}: ".format(args.user)))
+    with conn:
+        # the same containers container_id_and_barcode2component_identifiers.sql dumps
+        for container in container_aos(conn.cursor(), "tc.indicator LIKE 'data_value_missing%%' AND tc.repo_id = %s", (args.repository,)):
+            yield container['component_ids']
+
 if __name__ == '__main__':
     args = ap.parse_args()
+    if args.from_database == bool(args.input_file):
+        ap.error('give either input_file or --from_database')
     report = Counter()
     out = csv.writer(sys.stdout, dialect='excel-tab')
-    with args.input_file as f:
-        aos = chain(*(json.loads(a[2]) for a in csv.reader(f, dialect='excel-tab')))
-        for x in aos:
-            report[countify(x)] += 1
-        total = sum(report.values())
-        rows = sorted(report.items(), key=lambda pair: pair[1])
-
-        out.writerow(['component_id pattern', 'count', '% matching'])
-        for row in rows:
-            percent = "{:.1%}".format(report[row[0]]/total)
-            out.writerow((row[0].replace('.', '\.'), *row[1:], percent,))
+
+    if args.from_database:
+        chunks, count = chunked(database_id_lists(args), args.chunk_size), census
+    else:
+        chunks, count = chunked((a[2] for a in csv.reader(args.input_file, dialect='excel-tab')), args.chunk_size), census_json
+
+    # chunks are added up in order, so patterns with equal counts sort as they would counted in one go
+    if args.processes > 1:
+        with Pool(args.processes) as pool:
+            for chunk_report in pool.imap(count, chunks):
+                report.update(chunk_report)
+    else:
+        for chunk_report in map(count, chunks):
+            report.update(chunk_report)
+
+    total = sum(report.values())
+    rows = sorted(report.items(), key=lambda pair: pair[1])
+
+    out.writerow(['component_id pattern', 'count', '% matching'])
+    for row in rows:
+        percent = "{:.1%}".format(report[row[0]]/total)
+        out.writerow((row[0].replace('.', '\.'), *row[1:], percent,))
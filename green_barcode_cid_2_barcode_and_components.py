@@ -11,58 +11,49 @@ import pymysql
 
 from asnake.logging import setup_logging, get_logger
 
+from aspace_db import container_aos
+from instrumentation import Metrics, instrument_cursor
+
 ap = ArgumentParser(description="Script to report out green barcode container ids, barcode, and component identifiers")
 ap.add_argument('--host', default='localhost', help="host of ASpace database")
 ap.add_argument('--user', default='pobocks', help='MySQL user to run as when connecting to ASpace database')
 ap.add_argument('--database', default='tuftschivesspace', help="Name of MySQL database")
 ap.add_argument('--logfile', default='green_barcode_cid_2_barcode_and_components.log', help='path to print log to')
 ap.add_argument('--green_containers', help="Excel file with container barcodes of interest")
+ap.add_argument('--metrics', default='green_barcode_cid_2_barcode_and_components.metrics.json', help='path to write timing and query metrics to')
+
+fields = ['container_id', 'indicator', 'barcode', 'component_ids', 'ao_ids', 'resources_attached_to']
 
 def top_container_barcodes(excel_filename):
     xl = load_workbook(excel_filename)
     rows = iter(xl.worksheets[0])
     next(rows) # skip header
-    return ",".join(f"'{row[0].value}'" for row in rows)
+    return [str(row[0].value) for row in rows]
 
 if __name__ == '__main__':
     args = ap.parse_args()
     setup_logging(filename=args.logfile)
     log = get_logger('green_barcodes_cid2bc_and_components')
+    metrics = Metrics()
 
     log.info('start')
+    metrics.phase('connect')
 
     conn = pymysql.connect(host=args.host, user=args.user, database=args.database, cursorclass=pymysql.cursors.DictCursor,
                 password=getpass("Please enter MySQL password for {}: ".format(args.user)))
     log.info('mysql_connect')
 
     with open('green_cid2bc_and_components.csv', 'w') as gc2bac_report, conn:
-        db = conn.cursor()
-
-        db.execute('''SET group_concat_max_len=995000''')
-        db.execute(f'''
-SELECT tc.id,
-       tc.indicator,
-       tc.barcode,
-       concat('[', group_concat(concat('"', ao.component_id, '"')), ']') as component_ids,
-       concat('[', group_concat(ao.id), ']') as ao_ids,
-       count(DISTINCT ao.root_record_id) as resources_attached_to
-FROM top_container tc
-JOIN top_container_link_rlshp tclr
-  ON tclr.top_container_id = tc.id
-JOIN sub_container s
-  ON s.id = tclr.sub_container_id
-JOIN instance i
-  ON s.instance_id = i.id
-JOIN archival_object ao
-  ON ao.id = i.archival_object_id
-WHERE tc.barcode IN ({top_container_barcodes(args.green_containers)})
-GROUP BY tc.id
-ORDER BY tc.id, tc.barcode, ao.component_id
-        ''')
+        metrics.phase('write_report')
+        db = instrument_cursor(conn.cursor(), metrics)
 
-        data = db.fetchall()
-        writer = csv.DictWriter(gc2bac_report, fieldnames=data[0].keys(), dialect='excel-tab')
-        for row in data:
-            writer.writerow(row)
+        # container_aos gives more than is reported on, e.g. lock_versions
+        writer = csv.DictWriter(gc2bac_report, fieldnames=fields, dialect='excel-tab', extrasaction='ignore')
+        for row in container_aos(db, 'tc.barcode IN %s', (top_container_barcodes(args.green_containers),)):
+            writer.writerow({**row,
+                             'component_ids': json.dumps(row['component_ids']),
+                             'ao_ids': json.dumps(row['ao_ids'])})
+            metrics.count()
 
     log.info('end')
+    metrics.report(args.metrics)
@@ -0,0 +1,184 @@
+'''Timing and request/query metrics for the scripts.
+
+A Metrics object collects:
+  - wall time per phase, where phases run one after another and each call to phase() ends the last;
+    phases entered more than once (e.g. once per window) have their times added up
+  - count, latency histogram and bytes per ASpace endpoint, via instrument_client
+  - count, time and rows per SQL query, via instrument_cursor
+  - items processed per phase, via count()
+
+report() prints a summary table to stderr and writes the metrics as JSON.'''
+import json, re, sys, threading, time
+from collections import defaultdict
+from functools import wraps
+
+# upper bounds of latency histogram buckets, in milliseconds
+BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+def endpoint(method, url):
+    '''Method and url with ids replaced, e.g. "POST /repositories/:id/top_containers/:id"'''
+    return '{} /{}'.format(method.upper(), re.sub(r'/\d+', '/:id', '/' + url.lstrip('/')).lstrip('/'))
+
+def query_label(query):
+    '''Whitespace-collapsed start of query, to group timings by'''
+    return ' '.join(query.split())[:100]
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.current = None
+        self.http = defaultdict(lambda: {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0,
+                                         'histogram_ms': [0] * len(BUCKETS_MS)})
+        self.sql = defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'rows': 0})
+
+    def _end_phase(self, now):
+        if self.current:
+            name, started = self.current
+            self.phases[name]['seconds'] += now - started
+
+    def phase(self, name):
+        '''End the current phase, if any, and start a new one'''
+        now = time.perf_counter()
+        with self.lock:
+            self._end_phase(now)
+            self.phases.setdefault(name, {'phase': name, 'runs': 0, 'seconds': 0.0, 'items': 0})['runs'] += 1
+            self.current = (name, now,)
+
+    def count(self, n=1):
+        '''Count items processed in current phase'''
+        with self.lock:
+            if self.current:
+                self.phases[self.current[0]]['items'] += n
+
+    def record_request(self, method, url, seconds, status_code, size):
+        with self.lock:
+            stats = self.http[endpoint(method, url)]
+            stats['count'] += 1
+            stats['errors'] += 0 if status_code == 200 else 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += size
+            stats['histogram_ms'][next(i for i, bound in enumerate(BUCKETS_MS) if seconds * 1000 <= bound)] += 1
+
+    def record_query(self, query, seconds, rows=0, executed=True):
+        '''Record time spent on query, either executing it or (if not executed) fetching rows'''
+        with self.lock:
+            stats = self.sql[query_label(query)]
+            stats['count'] += 1 if executed else 0
+            stats['seconds'] += seconds
+            stats['rows'] += rows
+
+    def as_dict(self):
+        now = time.perf_counter()
+        with self.lock:
+            self._end_phase(now)
+            phases = [dict(p) for p in self.phases.values()]
+            self.current = self.current and (self.current[0], now,)
+        for p in phases:
+            p['items_per_second'] = round(p['items'] / p['seconds'], 1) if p['seconds'] and p['items'] else None
+        return {'total_seconds': now - self.start,
+                'phases': phases,
+                'http': {'histogram_buckets_ms': [str(b) for b in BUCKETS_MS], **self.http},
+                'sql': dict(self.sql)}
+
+    def report(self, filename):
+        '''Print summary table to stderr, and write metrics as JSON to filename'''
+        metrics = self.as_dict()
+        out = sys.stderr
+        print('\n{:<50}{:>10}{:>10}{:>12}'.format('phase', 'seconds', 'items', 'items/sec'), file=out)
+        for p in metrics['phases']:
+            print('{:<50}{:>10.2f}{:>10}{:>12}'.format(p['phase'], p['seconds'], p['items'] or '', p['items_per_second'] or ''), file=out)
+        if self.http:
+            print('\n{:<50}{:>10}{:>10}{:>12}{:>12}'.format('endpoint', 'requests', 'errors', 'mean ms', 'max ms'), file=out)
+            for name, stats in sorted(self.http.items()):
+                print('{:<50}{:>10}{:>10}{:>12.1f}{:>12.1f}'.format(name, stats['count'], stats['errors'],
+                                                                    stats['seconds'] / stats['count'] * 1000,
+                                                                    stats['max_seconds'] * 1000), file=out)
+        if self.sql:
+            print('\n{:<50}{:>10}{:>10}{:>12}'.format('query', 'count', 'seconds', 'rows'), file=out)
+            for name, stats in sorted(self.sql.items(), key=lambda item: -item[1]['seconds']):
+                print('{:<50}{:>10}{:>10.2f}{:>12}'.format(name[:48], stats['count'], stats['seconds'], stats['rows']), file=out)
+        print('\ntotal {:.2f}s, metrics written to {}'.format(metrics['total_seconds'], filename), file=out)
+
+        with open(filename, 'w') as f:
+            json.dump(metrics, f, indent=2)
+
+def instrument_client(client, metrics):
+    '''Wrap client's HTTP methods so that each request is recorded in metrics'''
+    def wrap(method):
+        request = getattr(client, method)
+        @wraps(request)
+        def instrumented(url, *args, **kwargs):
+            start = time.perf_counter()
+            res = request(url, *args, **kwargs)
+            metrics.record_request(method, url, time.perf_counter() - start, res.status_code, len(res.content))
+            return res
+        return instrumented
+
+    for method in ('get', 'post', 'put', 'delete'):
+        setattr(client, method, wrap(method))
+    return client
+
+class InstrumentedCursor:
+    '''Proxy for a pymysql cursor that records time spent in and rows returned by each query.
+
+For unbuffered cursors, time spent fetching rows is counted as it happens.'''
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._query = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        return result, time.perf_counter() - start
+
+    def execute(self, query, args=None):
+        self._query = query
+        result, seconds = self._timed(self._cursor.execute, query, args)
+        # buffered cursors have all rows by now; unbuffered ones count rows as they're fetched
+        self._metrics.record_query(query, seconds, 0 if self._unbuffered else max(result or 0, 0))
+        return result
+
+    @property
+    def _unbuffered(self):
+        return hasattr(self._cursor, 'read_next')
+
+    def fetchall(self):
+        rows, seconds = self._timed(self._cursor.fetchall)
+        if self._unbuffered:
+            self._metrics.record_query(self._query, seconds, len(rows), executed=False)
+        return rows
+
+    def fetchone(self):
+        row, seconds = self._timed(self._cursor.fetchone)
+        if self._unbuffered:
+            self._metrics.record_query(self._query, seconds, 1 if row is not None else 0, executed=False)
+        return row
+
+    def __iter__(self):
+        if not self._unbuffered:
+            yield from self._cursor
+            return
+        # time and count unbuffered rows in batches, rather than recording every row separately
+        rows, seconds = 0, 0.0
+        while True:
+            start = time.perf_counter()
+            row = self._cursor.fetchone()
+            seconds += time.perf_counter() - start
+            if row is None:
+                break
+            rows += 1
+            yield row
+            if rows % 1000 == 0:
+                self._metrics.record_query(self._query, seconds, rows, executed=False)
+                rows, seconds = 0, 0.0
+        self._metrics.record_query(self._query, seconds, rows, executed=False)
+
+def instrument_cursor(cursor, metrics):
+    return InstrumentedCursor(cursor, metrics)
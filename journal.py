@@ -0,0 +1,55 @@
+'''Durable journal of completed mutations, so that interrupted runs can be resumed.
+
+The journal is a JSON Lines file with one entry per completed mutation; each entry is flushed
+and fsynced before record() returns, so anything in the journal is known to have happened.'''
+import json, os, threading
+from datetime import datetime
+
+class Journal:
+    def __init__(self, filename, resume=False):
+        '''Open journal at filename.  If resume, existing entries are loaded and new ones appended;
+otherwise the journal is started afresh.'''
+        self.entries = []
+        # line numbers of entries that couldn't be parsed, which are skipped
+        self.unreadable = []
+        if resume and os.path.exists(filename):
+            with open(filename, 'rb+') as f:
+                data = f.read()
+                # a partial last line means we died mid-write, so that entry never completed;
+                # cut it off, so the next entry starts on a line of its own
+                end = data.rfind(b'\n') + 1
+                f.truncate(end)
+            for number, line in enumerate(data[:end].decode('utf-8', 'replace').splitlines(), 1):
+                try:
+                    self.entries.append(json.loads(line))
+                except ValueError:
+                    self.unreadable.append(number)
+        self.lock = threading.Lock()
+        self.f = open(filename, 'a' if resume else 'w')
+
+    @staticmethod
+    def completed(filename):
+        '''True if journal at filename doesn't exist, or belongs to a run that finished'''
+        if not os.path.exists(filename):
+            return True
+        last = None
+        with open(filename, errors='replace') as f:
+            for last in f:
+                pass
+        if last is None:
+            return True
+        try:
+            return last.endswith('\n') and json.loads(last)['event'] == 'run_complete'
+        except ValueError:
+            return False
+
+    def record(self, event, **data):
+        entry = {'event': event, 'timestamp': datetime.now().isoformat(), **data}
+        with self.lock:
+            self.f.write(json.dumps(entry) + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.entries.append(entry)
+
+    def close(self):
+        self.f.close()
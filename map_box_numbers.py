@@ -2,8 +2,9 @@
 import csv, json, sys, os
 csv.field_size_limit(sys.maxsize)
 
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser, ArgumentTypeError, FileType
 from collections import defaultdict, OrderedDict
+from datetime import datetime
 from getpass import getpass
 from itertools import chain, islice
 from types import SimpleNamespace as NS
@@ -12,55 +13,100 @@ import regex as re
 import pymysql
 
 from more_itertools import peekable, one, chunked
-from openpyxl import load_workbook
 
 from asnake.logging import setup_logging, get_logger
 from asnake.aspace import ASpace
 from asnake.jsonmodel import JM
 
-def manual_mappings(filename):
-    sheet = iter(one(load_workbook(os.path.expanduser(filename))))
-    next(sheet) # skip headers
-    return {str(row[0].value):str(row[1].value) for row in sheet if row[0].value}
-
-def omissions(filename):
-    sheet = iter(one(load_workbook(os.path.expanduser(filename))))
-    next(sheet) # skip headers
-    return {row[0].value for row in sheet if row[0].value}
+from aspace_cache import RecordCache, current_versions
+from aspace_db import changed_since, container_aos, container_ids, container_partition, latest_system_mtime, partition
+from aspace_requests import BoundedExecutor, Scheduler, fetch_id_set, http_client
+from batch import BatchWriter
+from component_ids import sniff_box_numbers
+from instrumentation import Metrics, instrument_client, instrument_cursor
+from journal import Journal
+from records import CacheWriter, ContainerRow, JSONStore, load_cache
+from spreadsheets import barcode_mapping, barcode_set
+
+def since(value):
+    if value == 'last':
+        return value
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ArgumentTypeError('--since must be "last" or a date/time like 2019-06-01 or 2019-06-01 12:00:00, not {!r}'.format(value))
 
 ap = ArgumentParser(description="Script to map box numbers to containers based on AO component names")
 ap.add_argument('--host', default='localhost', help="host of ASpace database")
 ap.add_argument('--user', default='pobocks', help='MySQL user to run as when connecting to ASpace database')
 ap.add_argument('--database', default='tuftschivesspace', help="Name of MySQL database")
-ap.add_argument('--omissions', type=omissions, default=set(), help="Single column Excel file with list of container barcodes to ignore")
-ap.add_argument('--manual_mappings', type=manual_mappings, default={}, help='two column Excel file with mapping from barcode to indicator')
+ap.add_argument('--repository', type=int, default=2, help='id of ASpace repository to process')
+ap.add_argument('--partition', type=partition, help='only process part of the repository, either resources:FIRST-LAST (by lowest resource id a container has AOs in) or hash:K/N (containers whose id mod N is K)')
+ap.add_argument('--save_shared_numbers', type=FileType('w'), help='number shared boxes for the whole repository from the database alone, save the numbers to this file, and exit')
+ap.add_argument('--shared_numbers', type=FileType('r'), help='shared box numbers saved by --save_shared_numbers, to use rather than numbering as containers are processed, so that partitions number consistently')
+ap.add_argument('--omissions', type=barcode_set, default=set(), help="Single column Excel (or CSV/TSV) file with list of container barcodes to ignore")
+ap.add_argument('--manual_mappings', type=barcode_mapping, default={}, help='two column Excel (or CSV/TSV) file with mapping from barcode to indicator')
 ap.add_argument('--commit', action='store_true', help='actually make changes to ASpace')
+ap.add_argument('--save_plan', help='work out every change from the database alone, without touching the API, write the reports and save the changes to this file, and exit')
+ap.add_argument('--plan', help='make the changes in a plan saved by --save_plan, rather than working them out again')
+ap.add_argument('--save_batch', help='as --save_plan, but save the changes as a batch of API operations for apply_batch.py; can be given along with --save_plan')
 ap.add_argument('--logfile', default='map_box_numbers.log', help='path to print log to')
-ap.add_argument('--cached_aos', type=FileType('r'), help='source of cached archival object jsons')
-ap.add_argument('--cached_aos_save', type=FileType('w'), help='place to store cached archival object jsons')
-ap.add_argument('--cached_containers', type=FileType('r'), help='source of cached container jsons')
-ap.add_argument('--cached_containers_save', type=FileType('w'), help='place to store cached container jsons')
-
-normal = re.compile(r'^(?P<coll_id>[^.]{5})\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<box_no>\d{3})\.\d{5}(?:\.\d{5})?$')
-box_level = re.compile(r'^(?P<coll_id>[^.]{5})\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<penultimate>\d{3})\.(?P<last>\d{3})$')
-weird_MS004 = re.compile(r'^(?P<coll_id>MS004)\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<box_no>\d{3})\.\d{4}\.\d{2}.\d{4}$')
-def sniff_box_number(component_id):
-    if '-' in component_id:
-        return {"box_no": "Green Barcode"}
-    m = normal.match(component_id) or\
-        box_level.match(component_id) or\
-        weird_MS004.match(component_id)
-    if m:
-        return m.groupdict()
-
-    return {"box_no": "Cannot Assign"}
+ap.add_argument('--workers', type=int, default=4, help='number of concurrent requests to make to ASpace when committing')
+ap.add_argument('--retries', type=int, default=3, help='number of times to retry a request that fails with a transient error')
+ap.add_argument('--rate', type=float, default=0, help='maximum number of requests to ASpace to start per second; 0 for no limit')
+ap.add_argument('--target_latency', type=float, help='seconds a request may take before ASpace is taken to be overloaded and fewer are made at once')
+ap.add_argument('--fetch_parallelism', type=int, default=4, help='number of chunks of archival objects or containers to fetch from ASpace at once')
+ap.add_argument('--http_backend', choices=('requests', 'aiohttp'), default='requests', help='HTTP client to talk to ASpace with; aiohttp gives all workers one shared pool of connections')
+ap.add_argument('--connections', type=int, default=100, help='maximum number of requests in flight at once with the aiohttp backend')
+ap.add_argument('--chunk_size', type=int, default=250, help='number of archival objects or containers to request per chunk')
+ap.add_argument('--stream', action='store_true', help='stream containers from the database and process them in windows, rather than loading everything up front')
+ap.add_argument('--window_size', type=int, default=1000, help='number of containers to fetch and process at a time when streaming')
+ap.add_argument('--journal', default='map_box_numbers.journal', help='path to record completed changes to when committing')
+ap.add_argument('--resume', action='store_true', help='resume an interrupted commit run, skipping changes recorded in the journal')
+ap.add_argument('--since', type=since, help='only look at containers that changed, or whose archival objects changed, at or after this date/time; "last" uses the watermark saved by the last commit run to complete without failures')
+ap.add_argument('--watermark', default='map_box_numbers.watermark', help='file to keep the --since last watermark in; updated by every commit run that completes without failures')
+ap.add_argument('--cache', help='SQLite file to keep archival object and container jsons in between runs; only missing or changed records are fetched')
+ap.add_argument('--cached_aos', help='source of cached archival object jsons, saved by --cached_aos_save')
+ap.add_argument('--cached_aos_save', help='place to store cached archival object jsons, written as they are fetched')
+ap.add_argument('--cached_containers', help='source of cached container jsons, saved by --cached_containers_save')
+ap.add_argument('--cached_containers_save', help='place to store cached container jsons, written as they are fetched')
+ap.add_argument('--metrics', default='map_box_numbers.metrics.json', help='path to write timing, request and query metrics to')
 
 def split(string, sep="."):
     return str.split(string, sep)
 
+# proposed box numbers that don't lead to a change
+UNASSIGNED = {'Green Barcode', 'Cannot Assign', 'Omitted'}
+
 shared_idx = 1
-def box_no_or_bust(row):
+SHARED_INDICATOR = re.compile(r'^(?:(?P<coll_id>\S+) )?Shared (?P<idx>\d+)$')
+# containers whose changes failed, so that --since doesn't move past them
+failed_containers = set()
+# container_id:indicator of every container given a Shared number so far
+numbered_shared = {}
+def shared_number(row, coll_id=None):
+    '''Next Shared number, for a container shared between resources, or (with coll_id) between series of a resource.
+
+With --shared_numbers, the number planned for the container is used instead.'''
     global shared_idx
+    if shared_numbers is not None:
+        if row['container_id'] not in shared_numbers:
+            log.warning('WARN unplanned_shared_number', container_id=row['container_id'], coll_id=coll_id)
+            return 'Cannot Assign'
+        return shared_numbers[row['container_id']]
+
+    if coll_id:
+        indicator = "{coll_id} Shared {coll_idx}".format(coll_id=coll_id, coll_idx=coll_shared_box_idxs[coll_id])
+        coll_shared_box_idxs[coll_id] += 1
+    else:
+        indicator = "Shared {shared_idx}".format(shared_idx=shared_idx)
+        shared_idx += 1
+    numbered_shared[row['container_id']] = indicator
+    return indicator
+
+def box_no_or_bust(row):
     if row['barcode'] in args.omissions:
         return 'Omitted'
     if row['barcode'] in args.manual_mappings:
@@ -70,23 +116,17 @@ def box_no_or_bust(row):
     if row['barcode'].endswith('g'):
         return 'Green Barcode'
     if row['shared']:
-        indicator = "Shared {shared_idx}".format(shared_idx=shared_idx)
-        shared_idx += 1
-        return indicator
+        return shared_number(row)
     if row['barcode'].endswith('b'):
         indicator_prefix = 'Volume '
 
-    sniffed = [sniff_box_number(cid) for cid in  row['component_ids']]
+    sniffed = sniff_box_numbers(row['component_ids'])
     try:
         # boxes shared by _series_
         if all('series' in mdict for mdict in sniffed) and\
            len({mdict["series"] for mdict in sniffed}) > 1:
             coll_id = one({mdict['coll_id'] for mdict in sniffed})
-            box_no = "{coll_id} Shared {coll_idx}".format(
-                coll_id=coll_id,
-                coll_idx=coll_shared_box_idxs[coll_id])
-            coll_shared_box_idxs[coll_id] += 1
-            return box_no
+            return shared_number(row, coll_id)
 
 
         # normal, green bc dashes, or cannot assign
@@ -106,18 +146,13 @@ def box_no_or_bust(row):
     except ValueError:
         return "Cannot Assign"
 
-def convert_container_to_digital_object(container_info):
-    '''Take a row representing a DGB (Digital Green Barcode) container and it's archival objects
-and transform it into a digital object linked to the correct AO.'''
+def digital_object_json(container_info, title):
+    '''Digital object for a DGB container, linked to its AO'''
     ao_id = one(container_info['ao_ids'])
     cid = one(container_info['component_ids'])
-
-    ao = ao_jsons[ao_id]
-    del ao['position'] # updating AO with position set causes issues
-
-    digital_object = JM.digital_object(
+    return JM.digital_object(
         digital_object_id = 'tufts:{cid}'.format(cid=cid),
-        title= ao['title'],
+        title= title,
         file_versions = [JM.file_version(
             file_uri='example://no-url-available',
             publish=True
@@ -126,70 +161,118 @@ and transform it into a digital object linked to the correct AO.'''
             string_1 = 'Digital object location',
             text_1 = container_info['barcode']
         ),
-        linked_instances = [{'ref': '/repositories/2/archival_objects/{ao_id}'.format(ao_id=ao_id)}]
+        linked_instances = [{'ref': '/repositories/{repo}/archival_objects/{ao_id}'.format(repo=args.repository, ao_id=ao_id)}]
+    )
+
+def digital_object_instance(do_uri):
+    return JM.instance(
+        instance_type='digital_object',
+        digital_object={'ref': do_uri},
+        is_representative=False
     )
+
+def discard_digital_object(container_info, do_uri):
+    '''Delete a digital object its AO couldn't be linked to, so it isn't left orphaned.  One that can't
+be deleted is journaled as orphaned, with its uri, so it can be removed by hand; --resume links it up.'''
+    try:
+        del_res = scheduler.request(aspace.client.delete, do_uri)
+    except Exception as e:
+        del_res = NS(status_code=None, json=lambda: {'error': repr(e)})
+    if del_res.status_code == 200:
+        log.info('digital_object_cleanup', deleted=do_uri)
+        journal.record('digital_object_cleanup', container_id=container_info['container_id'])
+    else:
+        log.error('FAIL digital_object_cleanup', deleted=do_uri, result=del_res.json())
+        journal.record('orphaned_digital_object', container_id=container_info['container_id'], digital_object_uri=do_uri)
+
+def convert_container_to_digital_object(container_info, ao, progress=None):
+    '''Take a row representing a DGB (Digital Green Barcode) container and the json of its archival object
+and transform it into a digital object linked to the correct AO.
+
+When resuming, progress is the journaled state of a conversion an earlier run got partway through,
+and steps already done are skipped.'''
+    progress = progress or {}
+    cid = one(container_info['component_ids'])
+
+    del ao['position'] # updating AO with position set causes issues
+
+    digital_object = digital_object_json(container_info, ao['title'])
     log.info('create_digital_obj', digital_object=digital_object)
-    if args.commit:
-        d_obj_res = aspace.client.post('repositories/2/digital_objects', json=digital_object)
+    if 'digital_object_uri' in progress:
+        log.info('SKIP create_digital_obj', component_id=cid, digital_object_uri=progress['digital_object_uri'], message='created in an earlier run')
+        d_obj_res = NS(status_code=200, json = lambda: {'uri': progress['digital_object_uri']})
+    elif args.commit:
+        d_obj_res = scheduler.request(aspace.client.post, 'repositories/{}/digital_objects'.format(args.repository), json=digital_object)
     else: d_obj_res = NS(status_code=200, json = lambda: {'uri': 'PLACEHOLDER'}) # mock object if dry-run
     if d_obj_res.status_code == 200:
         do_uri = d_obj_res.json()['uri']
         log.info('created_digital_object', component_id=cid, digital_object_uri=do_uri, for_real=args.commit)
-        instance = JM.instance(
-            instance_type='digital_object',
-            digital_object={'ref': do_uri},
-            is_representative=False
-        )
-        ao['instances'].append(instance)
+        if args.commit and 'digital_object_uri' not in progress:
+            journal.record('created_digital_object', container_id=container_info['container_id'], digital_object_uri=do_uri)
+        ao['instances'].append(digital_object_instance(do_uri))
         if args.commit:
-            ao_res = aspace.client.post(ao['uri'], json=ao)
+            if progress.get('ao_updated'):
+                log.info('SKIP updated_ao', component_id=cid, message='updated in an earlier run')
+                ao_res = NS(status_code=200)
+            else:
+                try:
+                    ao_res = scheduler.request(aspace.client.post, ao['uri'], json=ao)
+                except Exception as e:
+                    ao_res = NS(status_code=None, json=lambda: {'error': repr(e)})
             if ao_res.status_code == 200:
                 log.info('updated_ao', component_id=cid, ao=ao['uri'], digital_object_uri=do_uri)
-                del_res = aspace.client.delete('/repositories/2/top_containers/{}'.format(container_info['container_id']))
+                journal.record('updated_ao', container_id=container_info['container_id'])
+                del_res = scheduler.request(aspace.client.delete, '/repositories/{}/top_containers/{}'.format(args.repository, container_info['container_id']))
                 if del_res.status_code == 200:
                     log.info('cleanup_dgb_container', **container_info)
+                    journal.record('cleanup_dgb_container', container_id=container_info['container_id'])
                 else:
                     log.error('FAIL cleanup_dgb_container', result=del_res.json(), **container_info)
+                    failed_containers.add(container_info['container_id'])
             else:
                 log.error('FAIL updated_ao', component_id=cid, digital_object_uri=do_uri, result=ao_res.json())
-                del_res = aspace.client.delete(do_uri)
-                if del_res.status_code == 200:
-                    log.info('digital_object_cleanup', deleted=do_uri)
-                else:
-                    log.error('FAIL digital_object_cleanup', deleted=do_uri, result=del_res.json())
+                failed_containers.add(container_info['container_id'])
+                discard_digital_object(container_info, do_uri)
         else:
             log.info('SKIP updated_ao', component_id=cid, message='Since this is a dry run, we shan\'t update the AO')
 
     else:
         log.error('FAIL created_digital_object', component_id=cid, result=d_obj_res.json())
+        failed_containers.add(container_info['container_id'])
 
-def reindicate_container(row, new_indicator):
-    '''Change indicator for container'''
+def reindicate_container(row, new_indicator, container, planned_indicator=None):
+    '''Change indicator for container.  With planned_indicator, the indicator it had when the change
+was planned, the container is left alone if it's been changed since.'''
     # container SHOULD be in jsons, but fallback to individual fetch if it's not for some reason?
-    container = container_jsons.get(row['container_id'], None)
     if not container:
         log.warning('WARN single_container_fetch', container_id = row['container_id'])
-        c_res = aspace.client.get('repositories/2/top_containers/{}'.format(row['container_id']))
+        c_res = scheduler.request(aspace.client.get, 'repositories/{}/top_containers/{}'.format(args.repository, row['container_id']))
         if c_res.status_code == 200:
             container = c_res.json()
             log.info('single_container_fetch', container_id = row['container_id'])
         else:
             log.error('FAIL single_container_fetch', container_id = row['container_id'])
+    if planned_indicator is not None and container['indicator'] != planned_indicator:
+        log.warning('SKIP changed_since_plan', container_id=row['container_id'], planned_indicator=planned_indicator, indicator=container['indicator'])
+        return
     old_indicator = container['indicator']
     container['indicator'] = new_indicator
-    container_res = aspace.client.post(container['uri'], json=container)
+    container_res = scheduler.request(aspace.client.post, container['uri'], json=container)
     if container_res.status_code == 200:
         log.info('updated_container', new_indicator=new_indicator, old_indicator=old_indicator, container_id=row['container_id'])
+        journal.record('updated_container', container_id=row['container_id'], new_indicator=new_indicator, old_indicator=old_indicator)
     else:
         log.info('FAIL updated_container', container_id=row['container_id'], data=row, error=container_res.json())
+        failed_containers.add(row['container_id'])
+
+def container_row(container):
+    '''Pick out the columns we report on from a container_aos result, and flag containers shared between resources'''
+    return ContainerRow(container['container_id'], container['barcode'], container['component_ids'],
+                        container['ao_ids'], container['resources_attached_to'] > 1)
 
-def map_rows(cursor):
-    '''Transform JSON columns and boolean columns in resultset from MySQL'''
-    for row in cursor:
-        row['component_ids'] = json.loads(row['component_ids'])
-        row['ao_ids'] = json.loads(row['ao_ids'])
-        row['shared'] = True if row['shared'] > 1 else False
-        yield row
+def map_rows(containers):
+    for container in containers:
+        yield container_row(container)
 
 def unmap_row(row):
     '''Transform python -> JSON for aggregate columns'''
@@ -199,121 +282,433 @@ def chain_aos(for_aos):
     for row in for_aos:
         yield from row['ao_ids']
 
+def fetch_ao_jsons(ao_ids):
+    '''Fetch archival object jsons by id in chunks, returning a JSONStore of id:json'''
+    return fetch_id_set(aspace.client, 'repositories/{}/archival_objects'.format(args.repository), ao_ids, log,
+                        chunk_size=args.chunk_size, parallelism=args.fetch_parallelism, store=JSONStore(),
+                        scheduler=scheduler)
+
+def fetch_container_jsons(container_ids):
+    '''Fetch top container jsons by id in chunks, returning a JSONStore of id:json'''
+    return fetch_id_set(aspace.client, 'repositories/{}/top_containers'.format(args.repository), container_ids, log,
+                        chunk_size=args.chunk_size, parallelism=args.fetch_parallelism, store=JSONStore(),
+                        scheduler=scheduler)
+
+def load_jsons(jsonmodel_type, ids, fetch):
+    '''Get jsons for ids from the record cache if they're still current, fetching and caching the rest'''
+    versions = current_versions(version_db, jsonmodel_type, ids)
+    jsons = JSONStore(record_cache.get_current(jsonmodel_type, versions))
+    missing = versions.keys() - jsons.keys()
+    log.info('record_cache', jsonmodel_type=jsonmodel_type, hits=len(jsons), misses=len(missing))
+    fetched = fetch(missing)
+    record_cache.put(jsonmodel_type, fetched.values())
+    jsons.update(fetched)
+    return jsons
+
+def continue_shared_numbering(indicator):
+    '''Move shared box counters past indicator, if it's a Shared number'''
+    global shared_idx
+    m = SHARED_INDICATOR.match(indicator)
+    if m and m.group('coll_id'):
+        coll_shared_box_idxs[m.group('coll_id')] = max(coll_shared_box_idxs.get(m.group('coll_id'), 1), int(m.group('idx')) + 1)
+    elif m:
+        shared_idx = max(shared_idx, int(m.group('idx')) + 1)
+
+def replay_journal(entries):
+    '''Rebuild per-container progress and shared box counters from the entries of an earlier run's journal'''
+    progress = defaultdict(dict)
+    for entry in entries:
+        container_id = entry.get('container_id')
+        if entry['event'] == 'created_digital_object':
+            progress[container_id]['digital_object_uri'] = entry['digital_object_uri']
+        elif entry['event'] == 'updated_ao':
+            progress[container_id]['ao_updated'] = True
+        elif entry['event'] == 'digital_object_cleanup':
+            # conversion was rolled back, so it starts over
+            progress.pop(container_id, None)
+        elif entry['event'] in {'updated_container', 'cleanup_dgb_container'}:
+            progress[container_id]['complete'] = True
+
+        if entry['event'] == 'updated_container':
+            # containers numbered in the earlier run no longer show up, so continue on from their Shared numbers
+            continue_shared_numbering(entry['new_indicator'])
+    return progress
+
+def load_coll_shared_box_idxs(db):
+    '''Series-shared box counters, starting at 1 for each collection'''
+    db.execute('''SELECT identifier FROM resource''')
+    return {json.loads(row["identifier"])[0]:1 for row in db.fetchall()}
+
+def load_shared_numbering(db):
+    '''Set up shared box counters, starting after the Shared numbers already in the repository so that
+runs over part of the backlog (e.g. with --since) don't reuse them'''
+    global shared_idx, coll_shared_box_idxs
+    shared_idx = 1
+    coll_shared_box_idxs = load_coll_shared_box_idxs(db)
+    db.execute('SELECT indicator FROM top_container WHERE repo_id = %s AND indicator LIKE %s', (args.repository, '%Shared %'))
+    for row in db.fetchall():
+        continue_shared_numbering(row['indicator'])
+
+def unmapped_containers(partition, since=None):
+    '''SQL condition and params for containers in the repository (and partition, if any) still needing
+box numbers, optionally only those changed since a system_mtime'''
+    condition, params = container_partition(partition)
+    where, params = 'tc.repo_id = %s AND tc.indicator LIKE %s AND ' + condition, (args.repository, 'data_value_missing%', *params,)
+    if since:
+        condition, since_params = changed_since(since)
+        where, params = where + ' AND ' + condition, (*params, *since_params,)
+    return where, params
+
+def read_watermark(filename):
+    '''system_mtime the last commit run to complete without failures started from, if there was one'''
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return datetime.strptime(json.load(f)['system_mtime'], '%Y-%m-%d %H:%M:%S')
+
+def write_watermark(filename, system_mtime):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump({'system_mtime': system_mtime.strftime('%Y-%m-%d %H:%M:%S')}, f)
+    # replaced in one go, so an interrupted write can't lose the last watermark
+    os.replace(filename + '.tmp', filename)
+
+def plan_shared_numbers(conn, since=None):
+    '''Number every shared box in the repository, in the same order a single whole-repository run would'''
+    load_shared_numbering(instrument_cursor(conn.cursor(), metrics))
+    db = instrument_cursor(conn.cursor(pymysql.cursors.SSDictCursor), metrics)
+    for row in map_rows(container_aos(db, *unmapped_containers(None, since))):
+        # DGB containers become digital objects rather than getting numbers
+        if not row['barcode'].startswith('DGB'):
+            box_no_or_bust(row)
+        metrics.count()
+    return numbered_shared
+
+def plan_changes(conn, since, f=None, batch=None):
+    '''Work out every change a commit run would make from the database alone, writing the reports as a dry
+run would.  If given, the changes are written to f as JSON Lines: a header, then an update_indicator or
+convert_to_digital_object change per container, with the container's row (and for update_indicator, its
+current indicator); and to batch, a BatchWriter, as the API operations that make them.
+Returns the number of changes.'''
+    load_shared_numbering(instrument_cursor(conn.cursor(), metrics))
+    watermark = latest_system_mtime(instrument_cursor(conn.cursor(), metrics))
+    if f:
+        f.write(json.dumps({'repository': args.repository,
+                            'partition': args.partition and args.partition.spec,
+                            'watermark': watermark and watermark.strftime('%Y-%m-%d %H:%M:%S')}) + '\n')
+    changes = 0
+    db = instrument_cursor(conn.cursor(pymysql.cursors.SSDictCursor), metrics)
+    for container in container_aos(db, *unmapped_containers(args.partition, since)):
+        row = container_row(container)
+        if row['barcode'].startswith('DGB'):
+            w_dgb.writerow(unmap_row(row))
+            change = {'action': 'convert_to_digital_object', **dict(row.items())}
+        else:
+            new_indicator = row['proposed_box_number'] = box_no_or_bust(row)
+            w_pbn.writerow(unmap_row(row))
+            change = None
+            if new_indicator not in UNASSIGNED:
+                change = {'action': 'update_indicator', **dict(row.items()), 'old_indicator': container['indicator']}
+        if change:
+            if f:
+                f.write(json.dumps(change) + '\n')
+            if batch:
+                batch_change(batch, change, container)
+            changes += 1
+        metrics.count()
+    return changes
+
+def batch_change(batch, change, container):
+    '''Write the API operations for a planned change to batch'''
+    cid = change['container_id']
+    container_uri = '/repositories/{}/top_containers/{}'.format(args.repository, cid)
+    if change['action'] == 'update_indicator':
+        batch.update('indicator:{}'.format(cid), container_uri, {'indicator': change['proposed_box_number']},
+                     lock_version=container['lock_version'])
+    else:
+        # the digital object is deleted again if its AO can't be linked to it, rather than left orphaned
+        do = batch.create('digital_object:{}'.format(cid), 'repositories/{}/digital_objects'.format(args.repository),
+                          digital_object_json(change, one(container['ao_titles'])),
+                          discard_unless=['digital_object_instance:{}'.format(cid)])
+        # updating AO with position set causes issues
+        linked = batch.append('digital_object_instance:{}'.format(cid),
+                              '/repositories/{}/archival_objects/{}'.format(args.repository, one(change['ao_ids'])),
+                              'instances', [digital_object_instance(do)],
+                              lock_version=one(container['ao_lock_versions']), unset=['position'])
+        # no lock_version, since linking the AO to its digital object may well touch the container too
+        batch.delete('cleanup_dgb_container:{}'.format(cid), container_uri, after=[linked])
+
+def read_plan(filename):
+    '''Header of a plan saved by --save_plan, and an iterator of rows for its changes.  Fills in
+planned_indicators as rows are read.  Raises ValueError if the file has no complete header.'''
+    f = open(filename)
+    try:
+        header = json.loads(next(f))
+    except StopIteration:
+        f.close()
+        raise ValueError('{} is an empty plan file'.format(filename))
+    except ValueError:
+        f.close()
+        raise ValueError("{} doesn't start with a plan header; it may be truncated".format(filename))
+    def rows():
+        with f:
+            for line in f:
+                change = json.loads(line)
+                row = ContainerRow(change['container_id'], change['barcode'], change['component_ids'],
+                                   change['ao_ids'], change['shared'])
+                if change['action'] == 'update_indicator':
+                    row['proposed_box_number'] = change['proposed_box_number']
+                    planned_indicators[row['container_id']] = change['old_indicator']
+                yield row
+    return header, rows()
+
+# container_id:indicator when planned, of containers whose changes come from a plan
+planned_indicators = {}
+
+def process_rows(rows, writes):
+    '''Write report rows and submit ASpace writes for a batch of rows.
+
+Jsons are handed to the writes as they're submitted, so that in streaming mode a window's
+jsons can be dropped as soon as its writes are done.'''
+    for row in rows:
+        if progress.get(row['container_id'], {}).get('complete'):
+            log.info('SKIP completed_in_earlier_run', container_id=row['container_id'])
+            continue
+        if row['barcode'].startswith('DGB'):
+            log.info('process_digital_barcode')
+            # handle things that ought to be digital barcodes
+            w_dgb.writerow(unmap_row(row))
+            writes.submit(convert_container_to_digital_object, row, ao_jsons[one(row['ao_ids'])], progress.get(row['container_id']))
+        else:
+            log.info('process_real_container')
+            # rows from a plan come with their box numbers
+            new_indicator = row['proposed_box_number'] = row.get('proposed_box_number') or box_no_or_bust(row)
+
+            w_pbn.writerow(unmap_row(row))
+            if args.commit and new_indicator not in UNASSIGNED:
+                # do the dang thing for common case
+                writes.submit(reindicate_container, row, new_indicator, container_jsons.get(row['container_id']),
+                              planned_indicators.get(row['container_id']))
+
 if __name__ == '__main__':
     args = ap.parse_args()
+    if args.resume and not args.commit:
+        ap.error('--resume can only be used with --commit')
+    if args.commit and not args.resume and not Journal.completed(args.journal):
+        ap.error("{} is from a run that didn't finish; pass --resume to pick up where it left off, or remove it".format(args.journal))
+    if args.save_shared_numbers and args.partition:
+        ap.error('--save_shared_numbers numbers the whole repository, and cannot be used with --partition')
+    if (args.commit or args.save_plan or args.save_batch) and args.partition and not args.shared_numbers and not args.plan:
+        ap.error('--partition needs --shared_numbers when committing or planning, so that shared boxes are numbered consistently across partitions')
+    if (args.save_plan or args.save_batch) and args.commit:
+        ap.error('--save_plan and --save_batch only plan changes, and cannot be used with --commit; commit a plan afterwards with --plan, or a batch with apply_batch.py')
+    if args.plan and (args.since or args.partition):
+        ap.error('--plan already says which containers to change, and cannot be used with --since or --partition')
 
     setup_logging(filename=args.logfile)
     log = get_logger('map_box_numbers')
+    metrics = Metrics()
 
     log.info('start')
+    metrics.phase('connect')
 
-    aspace = ASpace()
-    log.info('aspace_connect')
+    # planning only needs the database
+    if not (args.save_plan or args.save_batch or args.save_shared_numbers):
+        aspace = ASpace()
+        aspace.client = http_client(aspace.client, args.http_backend, args.connections)
+        instrument_client(aspace.client, metrics)
+        log.info('aspace_connect')
+    scheduler = Scheduler(max(args.workers, args.fetch_parallelism), rate=args.rate, retries=args.retries,
+                          target_latency=args.target_latency, log=log)
 
     # note: fields match up to fields in MySQL query plus additional field for
     in_fields = ['container_id', 'barcode', 'component_ids', 'ao_ids', 'shared']
     out_fields = (*in_fields[0:2], 'proposed_box_number', *in_fields[2:],)
 
+    password = getpass("Please enter MySQL password for {}: ".format(args.user))
     conn = pymysql.connect(host=args.host, user=args.user, database=args.database, cursorclass=pymysql.cursors.DictCursor,
-                           password=getpass("Please enter MySQL password for {}: ".format(args.user)))
+                           password=password)
     log.info('mysql_connect')
 
-    with open('proposed_box_numbers.csv', 'w') as pbn,\
-         open('digital_object_conversion.csv', 'w') as dgb:
+    if args.cache:
+        record_cache = RecordCache(args.cache)
+        # separate connection, since the main one may be busy streaming
+        version_db = instrument_cursor(pymysql.connect(host=args.host, user=args.user, database=args.database,
+                                                       cursorclass=pymysql.cursors.DictCursor, password=password).cursor(), metrics)
+        log.info('record_cache_open', cache=args.cache)
+
+    since = read_watermark(args.watermark) if args.since == 'last' else args.since
+    if args.since:
+        log.info('since', since=since and since.isoformat(), watermark=args.watermark if args.since == 'last' else None)
+
+    coll_shared_box_idxs = {}
+    shared_numbers = None
+    if args.save_shared_numbers:
+        log.info('plan_shared_numbers')
+        metrics.phase('plan_shared_numbers')
+        with conn, args.save_shared_numbers as f:
+            json.dump(plan_shared_numbers(conn, since), f, indent=4)
+        log.info('saved_shared_numbers', count=len(numbered_shared))
+        log.info('end')
+        metrics.report(args.metrics)
+        sys.exit()
+    if args.shared_numbers:
+        log.info('load_shared_numbers')
+        with args.shared_numbers as f:
+            shared_numbers = {int(k):v for k,v in json.load(f).items()}
 
-        w_pbn = csv.DictWriter(pbn, dialect='excel-tab', fieldnames=out_fields)
-        w_pbn.writeheader()
+    journal = Journal(args.journal, resume=args.resume) if args.commit else None
+    progress = {}
 
-        w_dgb = csv.DictWriter(dgb, dialect='excel-tab', fieldnames=in_fields)
-        w_dgb.writeheader()
+    # when resuming, add on to the reports from the interrupted run
+    report_mode = 'a' if args.resume else 'w'
+    with open('proposed_box_numbers.csv', report_mode) as pbn,\
+         open('digital_object_conversion.csv', report_mode) as dgb:
 
-        shared_idx = 1
-        log.info('load_coll_shared_box_idxs')
-        with conn:
-            db = conn.cursor()
-            db.execute('''SELECT identifier FROM resource''')
-            coll_shared_box_idxs = {json.loads(row["identifier"])[0]:1 for row in db.fetchall()}
-
-            log.info('load_data')
-            db.execute('''SET group_concat_max_len=995000''')
-            db.execute(
-                '''SELECT tc.id as container_id,
-                          tc.barcode as barcode,
-                          concat('[', group_concat(concat('"', ao.component_id, '"')), ']') as component_ids,
-                          concat('[', group_concat(ao.id), ']') as ao_ids,
-                          count(DISTINCT ao.root_record_id) as shared
-                   FROM top_container tc
-                   JOIN top_container_link_rlshp tclr
-                     ON tclr.top_container_id = tc.id
-                   JOIN sub_container s
-                     ON s.id = tclr.sub_container_id
-                   JOIN instance i
-                     ON s.instance_id = i.id
-                   JOIN archival_object ao
-                     ON ao.id = i.archival_object_id
-                   WHERE tc.indicator LIKE 'data_value_missing%'
-                   GROUP BY tc.indicator
-                   ORDER BY tc.id, tc.barcode, ao.component_id''')
-            data = list(map_rows(db))
-        log.info('load_data_complete')
-
-        log.info('fetch_ao_jsons')
-        ao_jsons = {}
+        w_pbn = csv.DictWriter(pbn, dialect='excel-tab', fieldnames=out_fields)
+        w_dgb = csv.DictWriter(dgb, dialect='excel-tab', fieldnames=in_fields)
+        if not args.resume:
+            w_pbn.writeheader()
+            w_dgb.writeheader()
+
+        if args.save_plan or args.save_batch:
+            log.info('plan_changes')
+            metrics.phase('plan_changes')
+            f = args.save_plan and open(args.save_plan + '.tmp', 'w')
+            batch = args.save_batch and BatchWriter(args.save_batch)
+            with conn:
+                changes = plan_changes(conn, since, f, batch)
+            if f:
+                f.close()
+                # replaced in one go, so a plan is never left half written
+                os.replace(args.save_plan + '.tmp', args.save_plan)
+            if batch:
+                batch.close()
+            log.info('saved_plan', plan=args.save_plan, batch=args.save_batch, changes=changes, operations=batch and batch.count)
+            log.info('end')
+            metrics.report(args.metrics)
+            sys.exit()
+
+        ao_jsons = JSONStore()
         if args.cached_aos:
             log.info('load_aos_from_cache')
-            with args.cached_aos as f:
-                ao_jsons = {int(k):v for k,v in json.load(f).items()}
-        else:
-            for chunk in chunked(sorted(chain_aos(data)), 250):
-                log.info('fetch_ao_chunk', chunk=chunk)
-                ao_res = aspace.client.get('repositories/2/archival_objects', params={'id_set': chunk})
-                if ao_res.status_code == 200:
-                    log.info('fetch_chunk_complete', chunk="{}-{}".format(chunk[0], chunk[-1]))
-                    for ao in ao_res.json():
-                        ao_id = int(ao['uri'][ao['uri'].rfind('/') + 1:])
-                        ao_jsons[ao_id] = ao
-            if args.cached_aos_save:
-                log.info('save_aos_to_cache')
-                with args.cached_aos_save as f:
-                    json.dump(ao_jsons, f, indent=4)
-        log.info('fetch_ao_jsons_complete')
-
-        log.info('load_containers')
+            metrics.phase('load_aos_from_cache')
+            ao_jsons = load_cache(args.cached_aos)
+
+        container_jsons = JSONStore()
         if args.cached_containers:
             log.info('load_containers_from_cache')
-            with args.cached_containers as f:
-                container_jsons = {int(k):v for k,v in json.load(f).items()}
-        else:
-            container_jsons = {}
-            for chunk in chunked(sorted(row['container_id'] for row in data), 250):
-                log.info('fetch_container_chunk', chunk=chunk)
-                c_res = aspace.client.get('repositories/2/top_containers', params={'id_set': chunk})
-                if c_res.status_code == 200:
-                    log.info('fetch_chunk_complete', chunk="{}-{}".format(chunk[0], chunk[-1]))
-                    for c in c_res.json():
-                        c_id = int(c['uri'][c['uri'].rfind('/') + 1:])
-                        container_jsons[c_id] = c
-            if args.cached_containers_save:
-                log.info('save_containers_to_cache')
-                with args.cached_containers_save as f:
-                    json.dump(container_jsons, f, indent=4)
-
-        log.info('load_containers_complete')
-        log.info('data_retrieved')
-
-        for row in data:
-            if row['barcode'].startswith('DGB'):
-                log.info('process_digital_barcode')
-                # handle things that ought to be digital barcodes
-                w_dgb.writerow(unmap_row(row))
-                convert_container_to_digital_object(row)
-            else:
-                log.info('process_real_container')
-                new_indicator = row['proposed_box_number'] = box_no_or_bust(row)
+            metrics.phase('load_containers_from_cache')
+            container_jsons = load_cache(args.cached_containers)
+
+        # written a window at a time as jsons are fetched, so they can be saved when streaming too
+        aos_save = args.cached_aos_save and CacheWriter(args.cached_aos_save)
+        containers_save = args.cached_containers_save and CacheWriter(args.cached_containers_save)
 
-                w_pbn.writerow(unmap_row(row))
-                if args.commit and new_indicator not in {'Green Barcode', 'Cannot Assign', 'Omitted'}:
-                    # do the dang thing for common case
-                    reindicate_container(row, new_indicator)
+        log.info('load_shared_numbering')
+        metrics.phase('load_shared_numbering')
+        with conn:
+            db = instrument_cursor(conn.cursor(), metrics)
+            load_shared_numbering(db)
+            # taken before looking for containers, so anything changed while we work is picked up next time
+            watermark = latest_system_mtime(db)
+
+            if args.resume:
+                log.info('replay_journal', journal=args.journal, entries=len(journal.entries))
+                if journal.unreadable:
+                    log.warning('WARN unreadable_journal_entries', journal=args.journal, lines=journal.unreadable)
+                progress = replay_journal(journal.entries)
 
+            log.info('load_data')
+            metrics.phase('load_data')
+            if args.plan:
+                try:
+                    header, rows = read_plan(args.plan)
+                except ValueError as e:
+                    log.error('FAIL load_plan', plan=args.plan, message=str(e))
+                    sys.exit('error: {}'.format(e))
+                log.info('load_plan', plan=args.plan, **header)
+                if header['repository'] != args.repository:
+                    log.error('FAIL load_plan', message='plan is for another repository', repository=args.repository)
+                    sys.exit(1)
+                # the plan's changes were worked out from the database as of its watermark, so carry on from there
+                watermark = header['watermark'] and datetime.strptime(header['watermark'], '%Y-%m-%d %H:%M:%S')
+            else:
+                if args.partition:
+                    log.info('partition', partition=args.partition.spec)
+                where, params = unmapped_containers(args.partition, since)
+                if args.stream:
+                    # Only the ids are read up front, and each window's rows are queried as it comes up, rather than
+                    # streaming them all with an unbuffered cursor: while the writes for a window held up reading
+                    # the stream, MySQL could give up on it (net_write_timeout) and silently cut the results short
+                    ids = container_ids(db, where, params)
+                    log.info('load_container_ids', count=len(ids))
+                    rows = (row for window_ids in chunked(ids, args.window_size)
+                            for row in map_rows(container_aos(db, 'tc.id IN %s AND ' + where, (window_ids, *params,))))
+                else:
+                    rows = map_rows(container_aos(db, where, params))
+            if args.stream:
+                windows = chunked(rows, args.window_size)
+            else:
+                windows = [list(rows)]
+                log.info('load_data_complete')
+
+            # CSVs are written in order from this thread; only the ASpace writes are handed off to the pool
+            # On a dry run there's nothing to wait on, so everything runs in order in a single worker
+            with BoundedExecutor(max_workers=args.workers if args.commit else 1) as writes:
+                for window in windows:
+                    if args.stream:
+                        log.info('process_window', first_container_id=window[0]['container_id'], size=len(window))
+
+                    log.info('fetch_ao_jsons')
+                    metrics.phase('fetch_ao_jsons')
+                    if not args.cached_aos:
+                        # only DGB containers' AOs are ever read, when they're converted to digital objects
+                        dgb_rows = [row for row in window if row['barcode'].startswith('DGB')]
+                        # replaced rather than updated, so that when streaming only one window is held at a time
+                        if args.cache:
+                            ao_jsons = load_jsons('archival_object', set(chain_aos(dgb_rows)), fetch_ao_jsons)
+                        else:
+                            ao_jsons = fetch_ao_jsons(chain_aos(dgb_rows))
+                        metrics.count(len(ao_jsons))
+                        if aos_save:
+                            log.info('save_aos_to_cache')
+                            aos_save.write(ao_jsons)
+                    log.info('fetch_ao_jsons_complete')
+
+                    log.info('load_containers')
+                    metrics.phase('load_containers')
+                    # container jsons are only needed to reindicate containers, so a dry run doesn't fetch them
+                    if not args.cached_containers and (args.commit or args.cached_containers_save):
+                        if args.cache:
+                            container_jsons = load_jsons('top_container', {row['container_id'] for row in window}, fetch_container_jsons)
+                        else:
+                            container_jsons = fetch_container_jsons(row['container_id'] for row in window)
+                        metrics.count(len(container_jsons))
+                        if containers_save:
+                            log.info('save_containers_to_cache')
+                            containers_save.write(container_jsons)
+                    log.info('load_containers_complete')
+                    log.info('data_retrieved')
+
+                    metrics.phase('process_rows')
+                    process_rows(window, writes)
+                    metrics.count(len(window))
+                log.info('await_writes')
+                metrics.phase('await_writes')
+
+        for cache in (aos_save, containers_save):
+            if cache:
+                cache.close()
+
+        if args.cache:
+            record_cache.close()
+        if args.commit:
+            if failed_containers:
+                log.warning('WARN watermark_not_advanced', watermark=args.watermark, failed_containers=sorted(failed_containers))
+            elif watermark:
+                write_watermark(args.watermark, watermark)
+                log.info('watermark_advanced', watermark=args.watermark, system_mtime=watermark.isoformat())
+            journal.record('run_complete')
+            journal.close()
         log.info('end')
+        metrics.report(args.metrics)
@@ -6,29 +6,120 @@ from collections import defaultdict
 from datetime import date
 from getpass import getpass
 from itertools import chain, repeat, groupby
+from types import SimpleNamespace as NS
 
 import pymysql
 
-from openpyxl import load_workbook
-from more_itertools import first
+from more_itertools import chunked
 
 from asnake.logging import setup_logging, get_logger
 from asnake.aspace import ASpace
 from asnake.jsonmodel import JM
 
+from aspace_requests import Scheduler, fetch_id_set, http_client
+from batch import BatchWriter
+from instrumentation import Metrics, instrument_client, instrument_cursor
+from series_index import SeriesIndex
+from spreadsheets import first_column
+
 ap = ArgumentParser(description="Script to convert green barcode pseudo-locations (containers) into proper locations, deriving and assigning box numbers.")
-ap.add_argument('spreadsheet', type=load_workbook, help="Spreadsheet of pseudo-location barcodes")
-ap.add_argument('barcode_source', type=load_workbook, help="Spreadsheet of new barcodes to be assigned")
+ap.add_argument('spreadsheet', type=first_column, help="Spreadsheet (Excel, CSV or TSV) of pseudo-location barcodes")
+ap.add_argument('barcode_source', type=first_column, help="Spreadsheet (Excel, CSV or TSV) of new barcodes to be assigned")
 ap.add_argument('--host', default='localhost', help="host of ASpace database")
 ap.add_argument('--user', default='pobocks', help='MySQL user to run as when connecting to ASpace database')
 ap.add_argument('--database', default='tuftschivesspace', help="Name of MySQL database")
 ap.add_argument('--logfile', default='barcodes_report.log', help='path to print log to')
 ap.add_argument('--reportfile', default='barcodes_report.csv', help='path to print CSV report to')
+ap.add_argument('--series_index', default='series_index.sqlite', help='SQLite file to keep the highest box number in each series in between runs, shared with report_duplicates.py')
+ap.add_argument('--rebuild_series_index', action='store_true', help='rebuild --series_index from the database rather than just catching up on changes')
+ap.add_argument('--http_backend', choices=('requests', 'aiohttp'), default='requests', help='HTTP client to talk to ASpace with; aiohttp gives all workers one shared pool of connections')
+ap.add_argument('--connections', type=int, default=100, help='maximum number of requests in flight at once with the aiohttp backend')
+ap.add_argument('--retries', type=int, default=3, help='number of times to retry a request that fails with a transient error')
+ap.add_argument('--rate', type=float, default=0, help='maximum number of requests to ASpace to start per second; 0 for no limit')
+ap.add_argument('--metrics', default='barcodes_report.metrics.json', help='path to write timing, request and query metrics to')
+ap.add_argument('--delete_pseudo_locations', action='store_true', help='delete pseudo-location containers once everything in them has been moved to new containers; otherwise they are left for someone to check and remove')
+ap.add_argument('--save_batch', help='rather than making changes, save them to this file as a batch of API operations for apply_batch.py')
 
 normal_component_id = re.compile(r'^(?P<coll_id>[^.]{5})\.(?P<series>\d{3})(?:\.\d{3})*\.(?P<box_no>\d{3})(?:\.\d{5}){0,2}$')
 
+green_barcode = re.compile(r'^[0-9]+[gG]$')
+
+def barcode_keys(barcode):
+    '''The barcodes a container with this barcode answers to: itself, and without its trailing g/G,
+lowercased, since barcodes are matched regardless of case'''
+    barcode = barcode.lower()
+    return (barcode, barcode[:-1]) if barcode.endswith('g') else (barcode,)
+
+def load_containers_by_barcode(db, barcodes):
+    '''Scan top_container once for green containers and those with barcodes in `barcodes`, returning a dict
+of lowercased barcode:ids of the containers with that barcode, with or without a trailing g/G, and the set
+of barcodes of green containers (digits with a g/G on the end), without the g/G.
+
+Matching here, rather than with REGEXP per barcode, means the table is only read once however many
+barcodes there are.  Barcodes match regardless of case, as they did with REGEXP under MySQL's
+case-insensitive collation, so look them up with .lower().'''
+    barcodes = {barcode.lower() for barcode in barcodes}
+    containers_by_barcode = defaultdict(list)
+    green = set()
+    db.execute("""SELECT id, barcode FROM top_container WHERE barcode IS NOT NULL""")
+    for row in db.fetchall():
+        keys = barcode_keys(row['barcode'])
+        is_green = green_barcode.match(row['barcode'])
+        if is_green:
+            green.add(keys[1])
+        for key in keys:
+            if is_green or key in barcodes:
+                containers_by_barcode[key].append(row['id'])
+    return containers_by_barcode, green
+
+def load_ao_infos(db, barcodes, containers_by_barcode):
+    '''Get info on the AOs in each green barcode's container(s), as dict of barcode:list of ao_infos ordered by component_id.
+
+Containers are looked up by id in containers_by_barcode, as returned by load_containers_by_barcode,
+a chunk of barcodes at a time.'''
+    ao_infos = defaultdict(list)
+    for chunk in chunked(barcodes, 1000):
+        candidates = defaultdict(list)
+        for barcode in chunk:
+            for top_container_id in containers_by_barcode.get(barcode.lower(), ()):
+                candidates[top_container_id].append(barcode)
+        if not candidates:
+            continue
+        # going to the API for this is unexpectedly horrible, so we're cheating and going to the database
+        db.execute('''SELECT ao.id, ao.root_record_id, ao.position, ao.lock_version, r.ead_id, ao.component_id, tc.id AS top_container_id FROM top_container tc
+                        JOIN top_container_link_rlshp tclr ON tclr.top_container_id = tc.id
+                        JOIN sub_container sc ON sc.id = tclr.sub_container_id
+                        JOIN instance i ON i.id = sc.instance_id
+                        JOIN archival_object ao ON ao.id = i.archival_object_id
+                        JOIN resource r ON r.id = ao.root_record_id
+                       WHERE tc.id IN %s AND i.archival_object_id IS NOT NULL
+                       ORDER BY ao.component_id ASC''', (list(candidates),))
+        for row in db.fetchall():
+            for barcode in candidates[row['top_container_id']]:
+                ao_infos[barcode].append(dict(row))
+    return ao_infos
+
+def emptied_containers(db, top_container_ids, moved_ao_ids):
+    '''Of the containers with ids in top_container_ids, those with nothing in them but AOs in moved_ao_ids,
+as a dict of id:lock_version.  A container holding any other AO, or an accession's or resource's
+instance, isn't empty, and is left alone.'''
+    if not top_container_ids:
+        return {}
+    lock_versions = {}
+    held = set()
+    db.execute('''SELECT tc.id, tc.lock_version, tclr.id AS link_id, i.archival_object_id FROM top_container tc
+                    LEFT JOIN top_container_link_rlshp tclr ON tclr.top_container_id = tc.id
+                    LEFT JOIN sub_container sc ON sc.id = tclr.sub_container_id
+                    LEFT JOIN instance i ON i.id = sc.instance_id
+                   WHERE tc.id IN %s''', (list(top_container_ids),))
+    for row in db.fetchall():
+        lock_versions[row['id']] = row['lock_version']
+        if row['link_id'] is not None and row['archival_object_id'] not in moved_ao_ids:
+            held.add(row['id'])
+    return {top_container_id: lock_version for top_container_id, lock_version in lock_versions.items() if top_container_id not in held}
+
 def create_tc(ao_infos, tc_json):
-    global failures, bc_report, log, bc_to_loc, barcode_source
+    global failures, log, barcode_source, pending_instances, new_indicators
 
     try:
         new_barcode = next(barcode_source)
@@ -40,52 +131,123 @@ def create_tc(ao_infos, tc_json):
 
     tc_json['barcode'] = new_barcode
 
-    res = aspace.client.post('repositories/2/top_containers', json=tc_json)
+    # "resource_id.series":indicator for the series the container numbers on, for the series index
+    series_indicators = {}
+    if tc_json['indicator'].isdigit():
+        for ao_info in ao_infos:
+            series_indicators["{}.{}".format(ao_info['root_record_id'], ao_info['component_id'][6:9])] = int(tc_json['indicator'])
+
+    if batch:
+        # the container is created when the batch is applied, so it's referred to by its place in the batch;
+        # apply_batch.py counts its number in the series index once it has been
+        tc_ref = batch.create('top_container:{}'.format(batch.count), 'repositories/2/top_containers', tc_json,
+                              series_indicators=series_indicators or None)
+        res = NS(status_code=200, json=lambda: {'uri': tc_ref, 'id': None})
+    else:
+        res = scheduler.request(aspace.client.post, 'repositories/2/top_containers', json=tc_json)
     if res.status_code == 200:
-        log.info('created_tc', tc=res.json(), indicator=tc_json['indicator'])
-        tc_uri = res.json()['uri']
+        log.info('batched_tc' if batch else 'created_tc', tc=res.json(), indicator=tc_json['indicator'])
+        # counted in the series index at the end, so that later runs number on from here
+        for key, indicator in series_indicators.items():
+            new_indicators[key] = max(new_indicators.get(key, 0), indicator)
+        # AOs are updated later by update_aos, so that all of an AO's new instances go up in one POST
+        for ao_info in ao_infos:
+            pending_instances[ao_info['id']].append({'ao_info': ao_info,
+                                                     'tc_uri': res.json()['uri'],
+                                                     'new_barcode': new_barcode,
+                                                     'new_container_id': res.json()['id'],
+                                                     'box_number': tc_json['indicator']})
+    else:
+        log.info('create_tc_failed', tc=res.json(), status_code=res.status_code)
         for ao_info in ao_infos:
-            ao = aspace.client.get(f"/repositories/2/archival_objects/{ao_info['id']}").json()
-            del ao['position']
+            failures[ao_info['original_barcode']].append(ao_info)
+
+def batch_instances(ao_id, additions):
+    '''Write the AO update update_aos would make to the batch, reporting on it as if it had been made'''
+    instances = [JM.instance(instance_type='mixed_materials',
+                             sub_container=JM.sub_container(top_container=JM.top_container(ref=addition['tc_uri'])))
+                 for addition in additions]
+    key = batch.append('instances:{}'.format(ao_id), '/repositories/2/archival_objects/{}'.format(ao_id), 'instances', instances,
+                       lock_version=additions[0]['ao_info']['lock_version'], unset=['position'])
+    moved_aos.add(ao_id)
+    for addition in additions:
+        ao_info = addition['ao_info']
+        batched_updates[ao_info['original_barcode']].add(key)
+        bc_report.writerow({'original_barcode': ao_info['original_barcode'],
+                            'original_container_id': ao_info['top_container_id'],
+                            'location_id': bc_to_loc.get(ao_info['original_barcode'], 'IN BATCH'),
+                            'new_barcode': addition['new_barcode'],
+                            'new_container_id': 'IN BATCH',
+                            'box_number': addition['box_number'],
+                            'component_id': ao_info['component_id'],
+                            'ao_id': ao_info['id']})
+
+def update_aos():
+    '''Link AOs to the top containers created for them, using prefetched AO jsons and making one POST per AO'''
+    global failures, bc_report, log, bc_to_loc, ao_jsons, pending_instances
+
+    for ao_id, additions in pending_instances.items():
+        if batch:
+            batch_instances(ao_id, additions)
+            continue
+        ao = ao_jsons.get(ao_id)
+        if not ao:
+            log.error('ao_not_fetched', ao_id=ao_id)
+            for addition in additions:
+                failures[addition['ao_info']['original_barcode']].append(addition['ao_info'])
+            continue
+
+        del ao['position']
+        for addition in additions:
             ao['instances'].append(
                 JM.instance(
                     instance_type='mixed_materials',
                     sub_container=JM.sub_container(
                         top_container=JM.top_container(
-                            ref=tc_uri
+                            ref=addition['tc_uri']
                         )
                     )
                 )
             )
-            ao_res = aspace.client.post(ao['uri'], json=ao)
-            if ao_res.status_code == 200:
-                log.info('ao_updated', ao=ao_res.json())
+        ao_res = scheduler.request(aspace.client.post, ao['uri'], json=ao)
+        if ao_res.status_code == 200:
+            log.info('ao_updated', ao=ao_res.json())
+            moved_aos.add(ao_id)
+            for addition in additions:
+                ao_info = addition['ao_info']
+                moved_barcodes.add(ao_info['original_barcode'])
                 bc_report.writerow({'original_barcode': ao_info['original_barcode'],
                                     'original_container_id': ao_info['top_container_id'],
                                     'location_id': bc_to_loc[ao_info['original_barcode']],
-                                    'new_barcode': new_barcode,
-                                    'new_container_id': res.json()['id'],
-                                    'box_number': tc_json['indicator'],
+                                    'new_barcode': addition['new_barcode'],
+                                    'new_container_id': addition['new_container_id'],
+                                    'box_number': addition['box_number'],
                                     'component_id': ao_info['component_id'],
                                     'ao_id': ao_info['id']})
-            else:
-                log.info('ao_update_failed', ao=res.json(), status_code=res.status_code)
-                failures[barcode].append(ao_info)
-    else:
-        log.info('create_tc_failed', tc=res.json(), status_code=res.status_code)
-        for ao_info in ao_infos:
-            failures[barcode].append(ao_info)
+        else:
+            log.info('ao_update_failed', ao=ao_res.json(), status_code=ao_res.status_code)
+            for addition in additions:
+                failures[addition['ao_info']['original_barcode']].append(addition['ao_info'])
 
 
 if __name__ == "__main__":
     args = ap.parse_args()
     setup_logging(filename=args.logfile)
     log = get_logger('barcodes_report')
+    metrics = Metrics()
 
     log.info('start')
-
-    aspace = ASpace()
-    log.info('aspace_connect')
+    metrics.phase('connect')
+
+    # changes saved to a batch are made later by apply_batch.py, so the API isn't needed
+    batch = args.save_batch and BatchWriter(args.save_batch)
+    if not batch:
+        aspace = ASpace()
+        aspace.client = http_client(aspace.client, args.http_backend, args.connections)
+        instrument_client(aspace.client, metrics)
+        log.info('aspace_connect')
+        # other than fetching AO jsons, chunks at a time, requests are made one at a time
+        scheduler = Scheduler(4, rate=args.rate, retries=args.retries, log=log)
 
     bc_csv_fields = [
         'original_barcode',
@@ -102,7 +264,9 @@ if __name__ == "__main__":
 
     # Barcodes expected to be in first column of single-worksheet excel
     # To get the next barcode, we do: next(barcode_source)
-    barcode_source = (str(first(row)) for row in args.barcode_source.worksheets[0].values)
+    barcode_source = (str(barcode) for barcode in args.barcode_source)
+    # Barcodes in the database are strings, but a spreadsheet cell with a barcode of digits in it may well hold a number
+    pseudo_location_barcodes = [str(barcode) for barcode in args.spreadsheet if barcode is not None]
 
     conn = pymysql.connect(host=args.host, user=args.user, database=args.database, cursorclass=pymysql.cursors.DictCursor,
                            password=getpass("Please enter MySQL password for {}: ".format(args.user)))
@@ -122,11 +286,12 @@ if __name__ == "__main__":
                                    dialect='excel-tab',
                                    fieldnames=['barcode', 'location_id'])
 
-        db = conn.cursor()
-        db.execute("""SELECT barcode FROM top_container WHERE barcode REGEXP '^[0-9]+[gG]$'""")
+        metrics.phase('load_data')
+        db = instrument_cursor(conn.cursor(), metrics)
+        containers_by_barcode, green = load_containers_by_barcode(db, pseudo_location_barcodes)
 
         # Green barcodes, either from explicit list OR from matching the "digits with G as last character" format
-        green_barcodes = sorted(set(chain((first(row) for row in args.spreadsheet.worksheets[0].values), (row['barcode'][0:-1] for row in db.fetchall()))))
+        green_barcodes = sorted(set(chain(pseudo_location_barcodes, green)))
         log.info('got_green_barcodes')
 
         # hash of all extant barcodes. Assumes no duplicates which is not safe in principle
@@ -151,33 +316,26 @@ if __name__ == "__main__":
         log.info('got_resource_id_to_series')
 
         # Hash of f"resource_id.series" to maximum indicator in series
-        db.execute('''SET group_concat_max_len=995000''')
-        db.execute('''SELECT r.id,
-                             substr(ao.component_id, 7, 3) as series,
-                             max(CAST(regexp_substr(tc.indicator, '[0123456789]+$') AS SIGNED INTEGER)) AS max_indicator
-                       FROM resource r
-                       JOIN archival_object ao ON ao.root_record_id = r.id
-                       JOIN instance i ON i.archival_object_id = ao.id
-                       JOIN sub_container sc ON i.id = sc.instance_id
-                       JOIN top_container_link_rlshp tclr ON tclr.sub_container_id = sc.id
-                       JOIN top_container tc ON tc.id = tclr.top_container_id
-                       WHERE tc.indicator REGEXP '[0123456789]+$'
-                       AND tc.indicator REGEXP '^[0123456789;, -]+$'
-                       GROUP BY r.id, series
-                       HAVING max_indicator > 0
-                       ORDER BY r.id''')
-
-        series2idx = {"{}.{}".format(el['id'], el['series']):el['max_indicator'] for el in db.fetchall()}
+        series_index = SeriesIndex(args.series_index)
+        series_index.refresh(db, log, rebuild=args.rebuild_series_index)
+        series2idx = series_index.load()
         log.info('got_series_last_index')
 
         log.info('create_missing_locations')
+        metrics.phase('create_missing_locations')
         # create missing locations
         loc_template = JM.location(
             building='Tisch/DCA'
         )
+        # barcode:ref of locations to be created by the batch
+        batched_locations = {}
         for loc_bc in missing_locations:
             log.info('creating_location', barcode=loc_bc)
-            res = aspace.client.post('locations', json={**loc_template, 'barcode': loc_bc})
+            if batch:
+                batched_locations[loc_bc] = batch.create('location:{}'.format(loc_bc), 'locations', {**loc_template, 'barcode': loc_bc})
+                lc_report.writerow({'barcode': loc_bc, 'location_id': 'IN BATCH'})
+                continue
+            res = scheduler.request(aspace.client.post, 'locations', json={**loc_template, 'barcode': loc_bc})
             if res.status_code == 200:
                 log.info('created_location', result=res.json())
                 # add newly created barcode to hash
@@ -186,31 +344,53 @@ if __name__ == "__main__":
             else:
                 log.info('FAILED_create_location', result=res.json(), status_code=res.status_code)
                 lc_report.writerow({'original_barcode': loc_bc, 'location_id': 'FAILED TO CREATE'})
+            metrics.count()
 
         # map of barcode:list of failed ao_infos
         failures = defaultdict(list)
 
+        # map of ao_id:list of instances to add, filled by create_tc and applied by update_aos
+        pending_instances = defaultdict(list)
+
+        # map of "resource_id.series":highest indicator created, for the series index
+        new_indicators = {}
+
+        # map of barcode:keys of the batched AO updates its AOs are moved in
+        batched_updates = defaultdict(set)
+
+        # barcodes some of whose AOs have been moved to new containers
+        moved_barcodes = set()
+
+        # ids of AOs moved to new containers (with --save_batch, batched to be)
+        moved_aos = set()
+
         # Green AO Infos are handled in a second pass due to complexities around ordering them
         green_ao_infos = []
 
+        metrics.phase('load_ao_infos')
+        ao_infos_by_barcode = load_ao_infos(db, green_barcodes, containers_by_barcode)
+        log.info('got_ao_infos')
+
+        if not batch:
+            metrics.phase('fetch_ao_jsons')
+            ao_jsons = fetch_id_set(aspace.client, 'repositories/2/archival_objects',
+                                    (ao_info['id'] for ao_infos in ao_infos_by_barcode.values() for ao_info in ao_infos), log,
+                                    scheduler=scheduler)
+            log.info('got_ao_jsons')
+            metrics.count(len(ao_jsons))
+
+        metrics.phase('create_containers')
+
         # for each green barcode
         for barcode in green_barcodes:
-            # going to the API for this is unexpectedly horrible, so we're cheating and going to the database
-            db.execute('''SELECT ao.id, ao.root_record_id, ao.position, r.ead_id, ao.component_id, tc.id AS top_container_id FROM top_container tc
-                            JOIN top_container_link_rlshp tclr ON tclr.top_container_id = tc.id
-                            JOIN sub_container sc ON sc.id = tclr.sub_container_id
-                            JOIN instance i ON i.id = sc.instance_id
-                            JOIN archival_object ao ON ao.id = i.archival_object_id
-                            JOIN resource r ON r.id = ao.root_record_id
-                           WHERE barcode REGEXP %s AND i.archival_object_id IS NOT NULL
-                           ORDER BY ao.component_id ASC''', (fr'^{barcode}[gG]?$',))
-            ao_infos = list(db.fetchall())
+            ao_infos = ao_infos_by_barcode.get(barcode, [])
+            metrics.count()
 
             if not len(ao_infos):
                 log.error('empty_ao_uris', barcode=barcode)
                 continue
             try:
-                location_uri = f'/locations/{bc_to_loc[barcode]}'
+                location_uri = batched_locations[barcode] if barcode in batched_locations else f'/locations/{bc_to_loc[barcode]}'
             except KeyError as e:
                 log.error('location_barcode_not_in_bc_to_loc', barcode = barcode)
                 continue
@@ -277,23 +457,49 @@ if __name__ == "__main__":
             else:
                 idx = 1
             for ao_info in ao_infos_for_resource:
-                ao = aspace.client.get(f"/repositories/2/archival_objects/{ao_info['id']}").json()
                 tc_json = {**tc_tmpl, "indicator": str(idx)}
                 create_tc([ao_info], tc_json)
                 idx += 1
 
-        # Clean up all psuedo-locations that had no failures and are thus empty
-        for bc, fails in failures.items():
-            if not fails:
-                try:
-                    db.execute('SELECT id FROM top_container WHERE barcode REGEXP %s', (fr'^{bc}[gG]?$',))
-                    top_container_id = db.fetchone()['id']
-                    del_res = aspace.client.delete(f'/repositories/2/top_containers/{top_container_id}')
-                    if del_res.status_code == 200:
-                        log.info('deleted_container', top_container_id=top_container_id)
-                    else:
-                        log.info('failed to delete', top_container_id=top_container_id, del_res=del_res.json(), status_code=del_res.status_code)
-                except Exception as e:
-                    print(e)
+        metrics.phase('update_aos')
+        update_aos()
+        # nothing's been created yet when saving a batch, so the numbers aren't used up until it's applied
+        if not batch:
+            series_index.save(new_indicators)
+        series_index.close()
+        metrics.count(len(pending_instances))
+
+        metrics.phase('cleanup')
+
+        if args.delete_pseudo_locations:
+            # Pseudo-locations are only deleted once all their AOs have been moved to new containers, and only
+            # if nothing else has been put in them; the database is read afresh, not from the snapshot taken so far
+            conn.commit()
+            if batch:
+                # deletes wait for the updates moving the AOs out; the lock_version catches a container changed since
+                after = defaultdict(set)
+                for barcode, keys in batched_updates.items():
+                    if barcode not in failures:
+                        for top_container_id in containers_by_barcode[barcode.lower()]:
+                            after[top_container_id] |= keys
+                for top_container_id, lock_version in sorted(emptied_containers(db, after, moved_aos).items()):
+                    batch.delete('delete_container:{}'.format(top_container_id), f'/repositories/2/top_containers/{top_container_id}',
+                                 lock_version=lock_version, after=sorted(after[top_container_id]))
+            else:
+                candidates = {top_container_id for bc in moved_barcodes - set(failures) for top_container_id in containers_by_barcode[bc.lower()]}
+                for top_container_id in sorted(emptied_containers(db, candidates, moved_aos)):
+                    try:
+                        del_res = scheduler.request(aspace.client.delete, f'/repositories/2/top_containers/{top_container_id}')
+                        if del_res.status_code == 200:
+                            log.info('deleted_container', top_container_id=top_container_id)
+                        else:
+                            log.info('failed to delete', top_container_id=top_container_id, del_res=del_res.json(), status_code=del_res.status_code)
+                    except Exception as e:
+                        log.error('FAIL delete_container', top_container_id=top_container_id, error=repr(e))
+
+        if batch:
+            batch.close()
+            log.info('saved_batch', batch=args.save_batch, operations=batch.count)
 
     log.info('end')
+    metrics.report(args.metrics)
@@ -0,0 +1,152 @@
+'''Compact in-memory representations of container rows and record jsons.
+
+On large repositories, holding every container as a dict of lists and every fetched record as a
+parsed json dict runs to gigabytes.  ContainerRow keeps a container's columns in __slots__, with its
+component ids as a tuple of interned strings (component ids repeat a lot across the rows of a
+report), and JSONStore keeps record jsons compressed, only parsing one when it's asked for.
+
+JSONStores are saved to and loaded from cache files of the compressed records themselves, each
+preceded by its id and length, with an index of where each record is at the end.  Writing a cache
+can happen a store at a time as records are fetched, and loading one just maps the file and reads
+its index, with records decompressed from the file as they're used.'''
+import json, mmap, os, struct, sys, zlib
+from collections.abc import Mapping
+
+class ContainerRow:
+    '''A container and its AOs, as reported on by map_box_numbers.py.
+
+Supports dict-style access to its columns, so it can be used (and logged with **row) like the dicts it replaces.'''
+    __slots__ = ('container_id', 'barcode', 'component_ids', 'ao_ids', 'shared', 'proposed_box_number')
+
+    def __init__(self, container_id, barcode, component_ids, ao_ids, shared):
+        self.container_id = container_id
+        self.barcode = barcode
+        self.component_ids = tuple(sys.intern(cid) for cid in component_ids)
+        self.ao_ids = tuple(ao_ids)
+        self.shared = shared
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key),) for key in self.keys()]
+
+class JSONStore:
+    '''dict-like store of id:json, holding each json zlib-compressed.
+
+Every access parses the json afresh, so callers can change what they get without affecting the store.'''
+    def __init__(self, jsons=(), data=None):
+        '''Store for jsons, a dict or (id, json) pairs; data is the compressed records to start from, if not jsons'''
+        self.data = {} if data is None else data
+        self.update(jsons)
+
+    def __setitem__(self, key, record):
+        self.data[key] = zlib.compress(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+
+    def __getitem__(self, key):
+        return json.loads(zlib.decompress(self.data[key]).decode('utf-8'))
+
+    def get(self, key, default=None):
+        return self[key] if key in self.data else default
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def keys(self):
+        return self.data.keys()
+
+    def items(self):
+        for key in self.data:
+            yield key, self[key]
+
+    def values(self):
+        for key in self.data:
+            yield self[key]
+
+    def update(self, jsons):
+        for key, record in (jsons.items() if hasattr(jsons, 'items') else jsons):
+            self[key] = record
+
+MAGIC = b'ASJSONC1'
+RECORD = struct.Struct('>QI')   # id, length of compressed json
+INDEX = struct.Struct('>QQI')   # id, offset of compressed json, length
+FOOTER = struct.Struct('>Q8s')  # offset of index, MAGIC
+
+class CacheWriter:
+    '''Writes JSONStores to a cache file as they come, for load_cache to read back.
+
+The file only appears under its name once closed, so an interrupted run can't leave a partial cache behind.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename + '.tmp', 'wb')
+        self.f.write(MAGIC)
+        self.index = {}
+
+    def write(self, store):
+        '''Add the records in store; a record already written is replaced'''
+        for key, data in store.data.items():
+            self.f.write(RECORD.pack(key, len(data)))
+            self.index[key] = (self.f.tell(), len(data),)
+            self.f.write(data)
+
+    def close(self):
+        index_offset = self.f.tell()
+        for key, (offset, length) in self.index.items():
+            self.f.write(INDEX.pack(key, offset, length))
+        self.f.write(FOOTER.pack(index_offset, MAGIC))
+        self.f.close()
+        os.replace(self.filename + '.tmp', self.filename)
+
+class MappedRecords(Mapping):
+    '''Read-only mapping of id:compressed json over a memory-mapped cache file'''
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < len(MAGIC) + FOOTER.size:
+            raise ValueError('{} is not a complete cache file'.format(filename))
+        index_offset, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError('{} is not a complete cache file'.format(filename))
+        self.index = {key: (offset, length,) for key, offset, length in
+                      INDEX.iter_unpack(self.map[index_offset:len(self.map) - FOOTER.size])}
+
+    def __getitem__(self, key):
+        offset, length = self.index[key]
+        return self.map[offset:offset + length]
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+def load_cache(filename):
+    '''JSONStore of the records in a cache file.  Caches saved as a single JSON document of id:json
+by earlier versions are read (and parsed) in full.'''
+    with open(filename, 'rb') as f:
+        is_cache_file = f.read(len(MAGIC)) == MAGIC
+    if is_cache_file:
+        return JSONStore(data=MappedRecords(filename))
+    with open(filename) as f:
+        return JSONStore((int(k), v,) for k, v in json.load(f).items())
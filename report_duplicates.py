@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
-import csv, json
+import csv
 
 from argparse import ArgumentParser
-from collections import OrderedDict
 from getpass import getpass
 
 import pymysql
@@ -10,20 +9,37 @@ import pymysql
 from asnake.logging import setup_logging, get_logger
 from asnake.aspace import ASpace
 
+from aspace_db import duplicate_indicators, partition, resource_partition
+from aspace_requests import fetch_id_set, http_client
+from instrumentation import Metrics, instrument_client, instrument_cursor
+from series_index import SeriesIndex
+
 ap = ArgumentParser(description="Script to detect duplicate indicators by series based on AO component names")
 ap.add_argument('--host', default='localhost', help="host of ASpace database")
 ap.add_argument('--user', default='pobocks', help='MySQL user to run as when connecting to ASpace database')
 ap.add_argument('--database', default='tuftschivesspace', help="Name of MySQL database")
+ap.add_argument('--repository', type=int, default=2, help='id of ASpace repository to report on')
+ap.add_argument('--partition', type=partition, help='only report on part of the repository, either resources:FIRST-LAST or hash:K/N (resources whose id mod N is K)')
 ap.add_argument('--logfile', default='dupe_report.log', help='path to print log to')
+ap.add_argument('--verify', action='store_true', help='check indicators of duplicate containers against the API before reporting')
+ap.add_argument('--series_index', default='series_index.sqlite', help='SQLite file to keep the highest box number in each series in between runs, shared with map_green_barcode_box_numbers.py')
+ap.add_argument('--rebuild_series_index', action='store_true', help='rebuild --series_index from the database rather than just catching up on changes')
+ap.add_argument('--http_backend', choices=('requests', 'aiohttp'), default='requests', help='HTTP client to talk to ASpace with; aiohttp gives all workers one shared pool of connections')
+ap.add_argument('--connections', type=int, default=100, help='maximum number of requests in flight at once with the aiohttp backend')
+ap.add_argument('--metrics', default='dupe_report.metrics.json', help='path to write timing, request and query metrics to')
 
 if __name__ == '__main__':
     args = ap.parse_args()
     setup_logging(filename=args.logfile)
     log = get_logger('report_duplicates')
+    metrics = Metrics()
 
     log.info('start')
+    metrics.phase('connect')
 
     aspace = ASpace()
+    aspace.client = http_client(aspace.client, args.http_backend, args.connections)
+    instrument_client(aspace.client, metrics)
     log.info('aspace_connect')
 
     log.info('end')
@@ -33,59 +49,47 @@ if __name__ == '__main__':
     log.info('mysql_connect')
 
     with open('dupe_report.csv', 'w') as dupe_report, conn:
-        db = conn.cursor()
-        db.execute('''SET group_concat_max_len=995000''')
-        db.execute('''SELECT r.id,
-                             substr(ao.component_id, 7, 3) as series,
-                             max(CAST(regexp_substr(tc.indicator, '[0123456789]+$') AS integer)) AS max_indicator
-                       FROM resource r
-                       JOIN archival_object ao ON ao.root_record_id = r.id
-                       JOIN instance i ON i.archival_object_id = ao.id
-                       JOIN sub_container sc ON i.id = sc.instance_id
-                       JOIN top_container_link_rlshp tclr ON tclr.sub_container_id = sc.id
-                       JOIN top_container tc ON tc.id = tclr.top_container_id
-                       WHERE tc.indicator REGEXP '[0123456789]+$'
-                       AND tc.indicator REGEXP '^[0123456789;, -]+$'
-                       GROUP BY r.id, series
-                       HAVING max_indicator > 0
-                       ORDER BY r.id''')
-
-        series2idx = {"{}.{}".format(el['id'], el['series']):el['max_indicator'] for el in db.fetchall()}
-
-        db.execute('''SELECT r.id,
-                              substr(r.identifier, 3, 5) as identifier,
-                              substr(ao.component_id, 7, 3) as series,
-                              tc.indicator,
-                              concat('{', group_concat(DISTINCT concat('"', tc.id, '": "', tc.barcode, '"')), '}') AS id2bc
-                       FROM resource r
-                       JOIN archival_object ao ON ao.root_record_id = r.id
-                       JOIN instance i ON i.archival_object_id = ao.id
-                       JOIN sub_container sc ON i.id = sc.instance_id
-                       JOIN top_container_link_rlshp tclr ON tclr.sub_container_id = sc.id
-                       JOIN top_container tc ON tc.id = tclr.top_container_id
-                       GROUP BY r.id, series, tc.indicator
-                       HAVING count(DISTINCT tc.id) > 1 ORDER BY r.id, series, tc.id''')
+        metrics.phase('load_series2idx')
+        db = instrument_cursor(conn.cursor(), metrics)
+        # duplicates and series numbering are both within a resource, so partitioning by resource keeps them whole
+        condition, params = resource_partition(args.partition)
+        condition, params = 'r.repo_id = %s AND ' + condition, (args.repository, *params,)
+        series_index = SeriesIndex(args.series_index)
+        series_index.refresh(db, log, rebuild=args.rebuild_series_index)
+        series2idx = series_index.load()
+
+        metrics.phase('load_duplicates')
+        dupe_groups = list(duplicate_indicators(db, condition, params))
+        metrics.count(len(dupe_groups))
+        log.info('got_duplicates', groups=len(dupe_groups))
+
+        if args.verify:
+            metrics.phase('verify')
+            # Make sure the database agrees with the API about the indicators we're about to report on
+            fetched = fetch_id_set(aspace.client, 'repositories/{}/top_containers'.format(args.repository),
+                                   (container['container_id'] for containers in dupe_groups for container in containers), log)
+            metrics.count(len(fetched))
+            for containers in dupe_groups:
+                for container in containers:
+                    api_container = fetched.get(container['container_id'])
+                    if not api_container:
+                        log.warning('FAILED to fetch duplicate top container {}'.format(container['container_id']))
+                    elif api_container['indicator'] != container['indicator']:
+                        log.warning('WARN indicator_mismatch', container_id=container['container_id'],
+                                    database_indicator=container['indicator'], api_indicator=api_container['indicator'])
+                        container['indicator'] = api_container['indicator']
 
         w_dupe = csv.DictWriter(dupe_report, dialect='excel-tab', fieldnames=['resource_id', 'identifier_and_series', 'container_id', 'barcode', 'original_box_number', 'suggested_box_number'])
         w_dupe.writeheader()
 
+        metrics.phase('write_report')
         dupe_id2indicator = {}
-        for row in db.fetchall():
-            try:
-                dupes = iter(json.loads(row['id2bc'].replace('\\', '\\\\'), object_pairs_hook=OrderedDict).items())
-            except json.decoder.JSONDecodeError as e:
-                log.error('FAILED to process dupes for resource', data=row)
-                continue
-            for cid, bc in dupes:
-                res = aspace.client.get('repositories/2/top_containers/{}'.format(cid))
-                if res.status_code == 200:
-                    container = res.json()
-                    if not container['indicator'].isnumeric():
-                        log.warning('FAILED duplicate_indicator is not numeric', container_id=cid, indicator=container['indicator'])
-                else:
-                    log.warning('FAILED to fetch duplicate top container {}'.format(cid), status=res.status_code, response=ress.json())
-                    continue
-                s2i_key = "{}.{}".format(row['id'], row['series'])
+        for containers in dupe_groups:
+            for container in containers:
+                cid, bc = container['container_id'], container['barcode']
+                if not container['indicator'].isnumeric():
+                    log.warning('FAILED duplicate_indicator is not numeric', container_id=cid, indicator=container['indicator'])
+                s2i_key = "{}.{}".format(container['id'], container['series'])
                 if not s2i_key in series2idx:
                     log.warning('FAILED to find series2idx', key=s2i_key, container_id=cid, barcode=bc)
                     indicator = "could not find reliable maximum box number, cannot guess"
@@ -95,6 +99,11 @@ if __name__ == '__main__':
                     series2idx[s2i_key] += 1
                     indicator = series2idx[s2i_key]
                 dupe_id2indicator[cid] = indicator
-                w_dupe.writerow({"resource_id": row['id'], "identifier_and_series": s2i_key, "container_id": cid, "barcode": bc, "original_box_number": container['indicator'],  "suggested_box_number": indicator})
+                w_dupe.writerow({"resource_id": container['id'], "identifier_and_series": s2i_key, "container_id": cid, "barcode": bc, "original_box_number": container['indicator'],  "suggested_box_number": indicator})
+                metrics.count()
+
+        # suggestions aren't saved back to the index: only numbers actually given to containers are, so reports stay repeatable
+        series_index.close()
 
         log.info('end')
+        metrics.report(args.metrics)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+'''Run map_box_numbers.py or report_duplicates.py over partitions of a repository in parallel,
+each partition in its own process with its own API session, then merge their reports and logs.
+
+Each partition runs in its own directory under --work_dir, so journals, caches and metrics are
+kept per partition, and a partitioned --commit --resume picks up each partition where it left off.
+
+What has to be shared between partitions is handled here rather than left to each partition: the
+--since last watermark of map_box_numbers.py is kept under --work_dir, read once and handed to every
+partition as a date, and only advanced once all of them have committed without failures; and the
+series index of report_duplicates.py is brought up to date once, before partitions start, and then
+passed to all of them by absolute path.'''
+import csv, heapq, json, os, subprocess, sys
+csv.field_size_limit(sys.maxsize)
+
+from argparse import ArgumentParser, REMAINDER
+from concurrent.futures import ThreadPoolExecutor
+from getpass import getpass
+
+import pymysql
+
+from more_itertools import divide
+
+from asnake.logging import setup_logging, get_logger
+
+from series_index import SeriesIndex
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+# for each script: its default log, and the reports it writes along with the column they're ordered by
+SCRIPTS = {
+    'map_box_numbers.py': {'logfile': 'map_box_numbers.log',
+                           'reports': {'proposed_box_numbers.csv': 'container_id',
+                                       'digital_object_conversion.csv': 'container_id'}},
+    'report_duplicates.py': {'logfile': 'dupe_report.log',
+                             'reports': {'dupe_report.csv': 'resource_id'}},
+}
+
+ap = ArgumentParser(description="Run a script over partitions of a repository in parallel and merge the results")
+ap.add_argument('--host', default='localhost', help="host of ASpace database")
+ap.add_argument('--user', default='pobocks', help='MySQL user to run as when connecting to ASpace database')
+ap.add_argument('--database', default='tuftschivesspace', help="Name of MySQL database")
+ap.add_argument('--repository', type=int, default=2, help='id of ASpace repository to process')
+ap.add_argument('--partitions', type=int, default=4, help='number of partitions to split the repository into')
+ap.add_argument('--by', choices=('hash', 'resources'), default='hash',
+                help='partition by hash of container id (resource id for report_duplicates.py), or by contiguous ranges of resources')
+ap.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of partitions to run at once')
+ap.add_argument('--work_dir', default='partitions', help='directory to run partitions in')
+ap.add_argument('--logfile', default='run_partitions.log', help='path to print log to')
+ap.add_argument('script', choices=sorted(SCRIPTS), help='script to run')
+ap.add_argument('script_args', nargs=REMAINDER, help='further arguments for script')
+
+def partition_specs(args, password):
+    if args.by == 'hash':
+        return ['hash:{}/{}'.format(k, args.partitions) for k in range(args.partitions)]
+
+    conn = pymysql.connect(host=args.host, user=args.user, database=args.database, password=password)
+    with conn:
+        db = conn.cursor()
+        db.execute('SELECT id FROM resource WHERE repo_id = %s ORDER BY id', (args.repository,))
+        resource_ids = [row[0] for row in db.fetchall()]
+    # contiguous ranges with (nearly) the same number of resources in each
+    ranges = [list(ids) for ids in divide(args.partitions, resource_ids)]
+    return ['resources:{}-{}'.format(ids[0], ids[-1]) for ids in ranges if ids]
+
+def option_value(script_args, name):
+    '''Value given for option name in script_args, if any'''
+    for idx, arg in enumerate(script_args):
+        if arg == name and idx + 1 < len(script_args):
+            return script_args[idx + 1]
+        if arg.startswith(name + '='):
+            return arg.split('=', 1)[1]
+    return None
+
+def without_option(script_args, name, takes_value=True):
+    '''script_args with option name (and its value) taken out'''
+    result, skip = [], False
+    for arg in script_args:
+        if skip:
+            skip = False
+        elif arg == name:
+            skip = takes_value
+        elif not arg.startswith(name + '='):
+            result.append(arg)
+    return result
+
+def read_watermark(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)['system_mtime']
+
+def write_watermark(filename, system_mtime):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump({'system_mtime': system_mtime}, f)
+    os.replace(filename + '.tmp', filename)
+
+def partition_dir(args, spec):
+    return os.path.abspath(os.path.join(args.work_dir, spec.replace(':', '-').replace('/', '-of-')))
+
+def share_watermark(args):
+    '''Take --watermark and --since last out of the script's arguments, replacing them with the date in
+the partitioned run's watermark, so every partition starts from the same place however late it starts.
+Returns the watermark's path.'''
+    watermark = os.path.abspath(option_value(args.script_args, '--watermark') or os.path.join(args.work_dir, 'map_box_numbers.watermark'))
+    args.script_args = without_option(args.script_args, '--watermark')
+    if option_value(args.script_args, '--since') == 'last':
+        since = read_watermark(watermark)
+        args.script_args = without_option(args.script_args, '--since') + (['--since', since] if since else [])
+        log.info('since', since=since, watermark=watermark)
+    return watermark
+
+def advance_watermark(watermark, directories):
+    '''Advance watermark to the earliest partition's, if every partition committed without failures and so saved one'''
+    marks = [read_watermark(os.path.join(d, 'map_box_numbers.watermark')) for d in directories]
+    if not all(marks):
+        log.warning('WARN watermark_not_advanced', watermark=watermark, partitions_without=marks.count(None))
+        return
+    # all in the same format, so they sort as they compare
+    write_watermark(watermark, min(marks))
+    log.info('watermark_advanced', watermark=watermark, system_mtime=min(marks))
+
+def share_series_index(args, password):
+    '''Bring the series index up to date once, rather than in every partition at the same time, and pass
+it to every partition by absolute path, resolved from here, where an unpartitioned run would keep it'''
+    filename = os.path.abspath(option_value(args.script_args, '--series_index') or 'series_index.sqlite')
+    rebuild = '--rebuild_series_index' in args.script_args
+    args.script_args = without_option(without_option(args.script_args, '--series_index'), '--rebuild_series_index', takes_value=False)
+    args.script_args += ['--series_index', filename]
+
+    log.info('refresh_series_index', series_index=filename, rebuild=rebuild)
+    conn = pymysql.connect(host=args.host, user=args.user, database=args.database, password=password,
+                           cursorclass=pymysql.cursors.DictCursor)
+    with conn:
+        series_index = SeriesIndex(filename)
+        series_index.refresh(conn.cursor(), log, rebuild=rebuild)
+        series_index.close()
+
+def script_command(args, *extra):
+    # arguments naming files (omissions, mappings, cached jsons) are made absolute, since partitions run in their own directories
+    script_args = [os.path.abspath(arg) if os.path.isfile(arg) else arg for arg in args.script_args]
+    return [sys.executable, os.path.join(REPO, args.script), *script_args,
+            '--host', args.host, '--user', args.user, '--database', args.database,
+            '--repository', str(args.repository), '--logfile', SCRIPTS[args.script]['logfile'], *extra]
+
+def run(command, cwd, password):
+    '''Run command in cwd, returning its exit code.  Output goes to files in cwd.'''
+    os.makedirs(cwd, exist_ok=True)
+    with open(os.path.join(cwd, 'stdout.txt'), 'w') as stdout, open(os.path.join(cwd, 'stderr.txt'), 'w') as stderr:
+        # Run in a new session, so getpass has no terminal and reads the password from stdin
+        proc = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr,
+                                universal_newlines=True, start_new_session=True)
+        proc.communicate(password + '\n')
+    return proc.returncode
+
+def run_partition(args, spec, extra, password):
+    cwd = partition_dir(args, spec)
+    if args.script == 'map_box_numbers.py':
+        # saved by the partition if it commits without failures, for advance_watermark
+        watermark = os.path.join(cwd, 'map_box_numbers.watermark')
+        if os.path.exists(watermark):
+            os.remove(watermark)
+        extra = [*extra, '--watermark', watermark]
+    log.info('partition_start', partition=spec, directory=cwd)
+    returncode = run(script_command(args, '--partition', spec, *extra), cwd, password)
+    if returncode:
+        log.error('FAIL partition', partition=spec, exit_code=returncode, stderr=os.path.join(cwd, 'stderr.txt'))
+    else:
+        log.info('partition_complete', partition=spec)
+    return cwd, returncode
+
+def read_report(filename, key):
+    with open(filename) as f:
+        for row in csv.DictReader(f, dialect='excel-tab'):
+            yield int(row[key]), row
+
+def merge_reports(directories, filename, key):
+    '''Merge a report from each partition into one ordered as an unpartitioned run's would be'''
+    filenames = [os.path.join(d, filename) for d in directories if os.path.exists(os.path.join(d, filename))]
+    if not filenames:
+        return
+    with open(filenames[0]) as f:
+        fieldnames = next(csv.reader(f, dialect='excel-tab'))
+    with open(filename, 'w') as out:
+        writer = csv.DictWriter(out, dialect='excel-tab', fieldnames=fieldnames)
+        writer.writeheader()
+        for _, row in heapq.merge(*(read_report(f, key) for f in filenames), key=lambda item: item[0]):
+            writer.writerow(row)
+
+def read_log(filename, spec):
+    timestamp = ''
+    with open(filename) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = {'event': 'unparsed_log_line', 'line': line.rstrip('\n'), 'timestamp': timestamp}
+            timestamp = entry.get('timestamp', timestamp)
+            yield timestamp, {**entry, 'partition': spec}
+
+def merge_logs(results, filename):
+    '''Interleave partition logs by timestamp, tagging each entry with its partition'''
+    logs = [read_log(os.path.join(d, filename), spec) for spec, (d, _) in results.items()
+            if os.path.exists(os.path.join(d, filename))]
+    with open(filename, 'w') as out:
+        for _, entry in heapq.merge(*logs, key=lambda item: item[0]):
+            out.write(json.dumps(entry) + '\n')
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+    setup_logging(filename=args.logfile)
+    log = get_logger('run_partitions')
+
+    log.info('start', script=args.script, script_args=args.script_args)
+    password = getpass("Please enter MySQL password for {}: ".format(args.user))
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    specs = partition_specs(args, password)
+    log.info('partitions', partitions=specs)
+
+    extra = []
+    if args.script == 'report_duplicates.py':
+        share_series_index(args, password)
+    if args.script == 'map_box_numbers.py':
+        watermark = share_watermark(args)
+        # Shared numbers are counted across the whole repository, so they're worked out once up front.
+        # A resumed run reuses the earlier numbers, since containers already numbered no longer show up.
+        shared_numbers = os.path.abspath(os.path.join(args.work_dir, 'shared_numbers.json'))
+        if '--resume' in args.script_args and os.path.exists(shared_numbers):
+            log.info('reuse_shared_numbers', shared_numbers=shared_numbers)
+        else:
+            log.info('plan_shared_numbers')
+            planning = os.path.join(args.work_dir, 'plan')
+            if run(script_command(args, '--save_shared_numbers', shared_numbers), planning, password):
+                log.error('FAIL plan_shared_numbers', stderr=os.path.join(planning, 'stderr.txt'))
+                sys.exit(1)
+        extra = ['--shared_numbers', shared_numbers]
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {spec: pool.submit(run_partition, args, spec, extra, password) for spec in specs}
+    results = {spec: future.result() for spec, future in futures.items()}
+
+    log.info('merge_outputs')
+    directories = [d for d, _ in results.values()]
+    for report, key in SCRIPTS[args.script]['reports'].items():
+        merge_reports(directories, report, key)
+    merge_logs(results, SCRIPTS[args.script]['logfile'])
+
+    failed = [spec for spec, (_, returncode) in results.items() if returncode]
+    if args.script == 'map_box_numbers.py' and '--commit' in args.script_args and not failed:
+        advance_watermark(watermark, directories)
+    log.info('end', failed=failed)
+    if failed:
+        print('Partitions failed: {}; see {} for details'.format(', '.join(failed), args.logfile), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,62 @@
+'''Local index of the highest numeric indicator in each series of each resource.
+
+Working this out means joining six tables and running regular expressions over every container,
+so rather than doing it on every run, it's done once into a SQLite file.  After that, only
+containers changed since the last refresh (going by system_mtime) are aggregated and merged in,
+and scripts that hand out new indicators save them back, so they count straight away.
+
+The index only ever goes up, so containers renumbered downwards or deleted can leave a series'
+maximum higher than it is in ASpace.  That means a number might be skipped, but never reused;
+rebuilding starts the index over from the database.'''
+import sqlite3
+from datetime import datetime
+
+from aspace_db import changed_since, latest_system_mtime, series_max_indicators
+
+class SeriesIndex:
+    def __init__(self, filename):
+        # partitions of a run share the file, so wait for each other's writes rather than failing
+        self.db = sqlite3.connect(filename, timeout=60)
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS series_max (
+                                 resource_id INTEGER NOT NULL,
+                                 series TEXT NOT NULL,
+                                 max_indicator INTEGER NOT NULL,
+                                 PRIMARY KEY (resource_id, series))''')
+            # system_mtime of the database as of the last refresh
+            self.db.execute('CREATE TABLE IF NOT EXISTS refreshed (system_mtime TEXT NOT NULL)')
+
+    def refresh(self, cursor, log, rebuild=False):
+        '''Bring index up to date with the ASpace database, from scratch if rebuild or it's new'''
+        system_mtime = latest_system_mtime(cursor)
+        last = self.db.execute('SELECT system_mtime FROM refreshed').fetchone()
+        since = None if rebuild or not last else datetime.strptime(last[0], '%Y-%m-%d %H:%M:%S')
+
+        rows = series_max_indicators(cursor, *(changed_since(since) if since else ('TRUE', None,)))
+        with self.db:
+            if since is None:
+                self.db.execute('DELETE FROM series_max')
+            self._merge((row['id'], row['series'], row['max_indicator'],) for row in rows)
+            self.db.execute('DELETE FROM refreshed')
+            if system_mtime:
+                self.db.execute('INSERT INTO refreshed VALUES (?)', (system_mtime.strftime('%Y-%m-%d %H:%M:%S'),))
+        log.info('series_index_refresh', since=since and since.isoformat(), series_updated=len(rows))
+
+    def load(self):
+        '''Return index as dict of "resource_id.series":max_indicator'''
+        return {"{}.{}".format(resource_id, series):max_indicator
+                for resource_id, series, max_indicator in self.db.execute('SELECT resource_id, series, max_indicator FROM series_max')}
+
+    def save(self, series2idx):
+        '''Merge dict of "resource_id.series":indicator into index, keeping the higher of old and new'''
+        with self.db:
+            self._merge((int(key.split('.', 1)[0]), key.split('.', 1)[1], indicator,) for key, indicator in series2idx.items())
+
+    def _merge(self, rows):
+        for row in rows:
+            self.db.execute('INSERT OR IGNORE INTO series_max (resource_id, series, max_indicator) VALUES (?, ?, ?)', row)
+            self.db.execute('''UPDATE series_max SET max_indicator = MAX(max_indicator, ?)
+                                WHERE resource_id = ? AND series = ?''', (row[2], row[0], row[1],))
+
+    def close(self):
+        self.db.close()
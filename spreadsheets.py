@@ -0,0 +1,95 @@
+'''Reading the spreadsheets scripts take as input: barcode lists and barcode mappings.
+
+Spreadsheets can be Excel workbooks, read with openpyxl in read-only mode so rows are streamed
+rather than the whole workbook being loaded, or CSV/TSV files with the same columns.  Only the
+first worksheet of a workbook is read.
+
+What's read from a spreadsheet is cached as JSON under CACHE_DIR, keyed by a hash of the file's
+contents, so a large spreadsheet is only parsed the first time it's used.  The loaders raise
+ArgumentTypeError if the file can't be read, so they can be used as argparse types.'''
+import csv, hashlib, json, os
+from argparse import ArgumentTypeError
+
+from openpyxl import load_workbook
+
+CACHE_DIR = os.path.expanduser('~/.cache/aspace-derive-box-numbers/spreadsheets')
+# bump when what a loader returns changes, so stale cache entries aren't used
+CACHE_VERSION = 1
+
+def sheet_rows(filename):
+    '''Rows of the first sheet of a spreadsheet as tuples of values, with empty cells as None'''
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ('.csv', '.tsv', '.txt'):
+        with open(filename, newline='') as f:
+            for row in csv.reader(f, dialect='excel' if extension == '.csv' else 'excel-tab'):
+                yield tuple(value if value != '' else None for value in row)
+    else:
+        workbook = load_workbook(filename, read_only=True)
+        try:
+            yield from workbook.worksheets[0].values
+        finally:
+            workbook.close()
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def read_cache(path):
+    '''What's cached at path, or None if there's nothing there, or what's there is corrupt or truncated,
+so that it's read afresh and cached again'''
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def cached(read):
+    '''Wrap read(filename) so its result is cached by file contents'''
+    def load(filename):
+        filename = os.path.expanduser(filename)
+        try:
+            path = os.path.join(CACHE_DIR, '{}-{}-{}.json'.format(read.__name__, CACHE_VERSION, file_hash(filename)))
+            cached = read_cache(path)
+            if cached is not None:
+                return cached
+            result = read(filename)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            raise ArgumentTypeError("can't read spreadsheet {}: {}".format(filename, e))
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(result, f)
+            os.replace(path + '.tmp', path)
+        except (OSError, TypeError):
+            pass # caching is only an optimization, and not everything in a workbook is JSON
+        return result
+    load.__name__ = read.__name__
+    return load
+
+@cached
+def first_column(filename):
+    '''Values in the first column of every row, headers and empty cells included'''
+    return [row[0] if row else None for row in sheet_rows(filename)]
+
+@cached
+def _barcodes(filename):
+    rows = sheet_rows(filename)
+    next(rows, None) # skip headers
+    return [str(row[0]) for row in rows if row and row[0]]
+
+@cached
+def _barcode_mappings(filename):
+    rows = sheet_rows(filename)
+    next(rows, None) # skip headers
+    return [(str(row[0]), str(row[1]),) for row in rows if row and row[0]]
+
+def barcode_set(filename):
+    '''Set of barcodes in the first column, below a header row'''
+    return set(_barcodes(filename))
+
+def barcode_mapping(filename):
+    '''dict of barcode:value from the first two columns, below a header row'''
+    return dict(_barcode_mappings(filename))
@@ -0,0 +1,16 @@
+'''Stand-ins shared by the tests'''
+
+class Log:
+    '''Stands in for a structlog logger, keeping (event, fields) for each event logged at any level'''
+    def __init__(self):
+        self.events = []
+
+    def info(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+    warning = error = info
+
+    @property
+    def names(self):
+        '''Just the events logged, in order'''
+        return [event for event, _ in self.events]
@@ -0,0 +1,259 @@
+import threading, time
+from types import SimpleNamespace as NS
+
+import pytest
+from requests.exceptions import ConnectionError, ConnectTimeout
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+import aspace_requests
+from aspace_requests import MISSING_SAMPLE, RateLimiter, Scheduler, fetch_id_set, with_retries
+
+from helpers import Log
+
+def refused():
+    '''The error requests raises when nothing's listening'''
+    return ConnectionError(MaxRetryError(None, '/', reason=NewConnectionError(None, 'Connection refused')))
+
+def reset():
+    '''The error requests raises when the connection drops after the request was sent'''
+    return ConnectionError(ProtocolError('Connection aborted.', ConnectionResetError()))
+
+class Client:
+    '''Stands in for the ASpace client, failing with each of `outcomes` in turn, then succeeding'''
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def respond(self):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else 200
+        if isinstance(outcome, Exception):
+            raise outcome
+        return NS(status_code=outcome, headers={}, content=b'')
+
+    def get(self, uri, **kwargs):
+        return self.respond()
+
+    def post(self, uri, **kwargs):
+        return self.respond()
+
+    def put(self, uri, **kwargs):
+        return self.respond()
+
+    def delete(self, uri, **kwargs):
+        return self.respond()
+
+@pytest.mark.parametrize('status', [429, 502, 503, 504])
+def test_get_retried_on_transient_status(status):
+    client = Client(status, status)
+    assert with_retries(client.get, 'x', backoff=0).status_code == 200
+    assert client.calls == 3
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_post_retried_when_not_processed(status):
+    client = Client(status)
+    assert with_retries(client.post, 'x', backoff=0).status_code == 200
+    assert client.calls == 2
+
+@pytest.mark.parametrize('status', [500, 502, 504])
+def test_post_not_resent_when_maybe_processed(status):
+    client = Client(status)
+    assert with_retries(client.post, 'x', backoff=0).status_code == status
+    assert client.calls == 1
+
+@pytest.mark.parametrize('error', [refused(), ConnectTimeout()])
+def test_post_retried_when_never_sent(error):
+    client = Client(error)
+    assert with_retries(client.post, 'x', backoff=0).status_code == 200
+    assert client.calls == 2
+
+def test_post_not_resent_after_connection_reset():
+    client = Client(reset())
+    with pytest.raises(ConnectionError):
+        with_retries(client.post, 'x', backoff=0)
+    assert client.calls == 1
+
+def test_get_retried_after_connection_reset():
+    client = Client(reset(), reset())
+    assert with_retries(client.get, 'x', backoff=0).status_code == 200
+    assert client.calls == 3
+
+def test_last_response_returned_when_retries_run_out():
+    client = Client(503, 503, 503)
+    assert with_retries(client.delete, 'x', retries=2, backoff=0).status_code == 503
+    assert client.calls == 3
+
+def test_last_error_raised_when_retries_run_out():
+    client = Client(refused(), refused())
+    with pytest.raises(ConnectionError):
+        with_retries(client.post, 'x', retries=1, backoff=0)
+    assert client.calls == 2
+
+def test_unknown_method_treated_as_post():
+    client = Client(504)
+    assert with_retries(lambda uri: client.get(uri), 'x', backoff=0).status_code == 504
+
+def test_instrumented_post_still_recognised():
+    from instrumentation import Metrics, instrument_client
+    client = instrument_client(Client(504), Metrics())
+    assert with_retries(client.post, 'x', backoff=0).status_code == 504
+    assert client.calls == 1
+
+class IndexClient:
+    '''Serves archival objects by id_set, failing any request that includes one of `bad` ids'''
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.requests = []
+
+    def get(self, uri, params=None):
+        ids = params['id_set']
+        self.requests.append(list(ids))
+        if self.bad & set(ids):
+            return NS(status_code=500, headers={}, content=b'', json=lambda: {'error': 'bad record'})
+        return NS(status_code=200, headers={},
+                  json=lambda: [{'uri': '/repositories/2/archival_objects/{}'.format(i)} for i in ids])
+
+def test_fetch_id_set_fetches_in_chunks():
+    client = IndexClient()
+    fetched = fetch_id_set(client, 'repositories/2/archival_objects', [5, 3, 1, 2, 4, 3], Log(), chunk_size=2, parallelism=1)
+    assert sorted(fetched) == [1, 2, 3, 4, 5]
+    assert sorted(client.requests) == [[1, 2], [3, 4], [5]]
+
+def test_fetch_id_set_splits_failing_chunks_down_to_the_bad_id():
+    client, log = IndexClient(bad={6}), Log()
+    fetched = fetch_id_set(client, 'repositories/2/archival_objects', range(1, 9), log, chunk_size=8, parallelism=2, retries=0)
+    assert sorted(fetched) == [1, 2, 3, 4, 5, 7, 8]
+    assert sorted(client.requests, key=lambda ids: (len(ids), ids)) == [[5], [6], [5, 6], [7, 8], [1, 2, 3, 4], [5, 6, 7, 8], list(range(1, 9))]
+    assert ('FAIL fetch_chunk', {'uri': 'repositories/2/archival_objects', 'id': 6, 'status_code': 500, 'error': 'None'}) in log.events
+    assert log.events[-1][1]['missing'] == 1 and log.events[-1][1]['missing_sample'] == [6]
+
+def test_fetch_id_set_samples_missing_ids():
+    log = Log()
+    fetch_id_set(IndexClient(bad=range(100)), 'x', range(100), log, chunk_size=100, retries=0)
+    assert log.events[-1][1]['missing'] == 100
+    assert log.events[-1][1]['missing_sample'] == list(range(MISSING_SAMPLE))
+
+class Clock:
+    '''Stands in for the time module: sleeping moves the clock on rather than waiting'''
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(aspace_requests, 'time', clock)
+    return clock
+
+def test_rate_limiter_without_rate_never_waits(clock):
+    limiter = RateLimiter(0)
+    for _ in range(100):
+        limiter.wait()
+    assert clock.sleeps == []
+
+def test_rate_limiter_allows_a_burst_then_spaces_requests_out(clock):
+    limiter = RateLimiter(10, burst=3)
+    for _ in range(6):
+        limiter.wait()
+    assert clock.sleeps == pytest.approx([0.1, 0.1, 0.1])
+    # a quiet spell earns the burst back, and no more
+    clock.now += 10
+    for _ in range(4):
+        limiter.wait()
+    assert clock.sleeps[3:] == pytest.approx([0.1])
+
+def test_rate_limiter_pause_holds_everyone_back(clock):
+    limiter = RateLimiter(0)
+    limiter.pause(5)
+    limiter.pause(2)
+    limiter.wait()
+    assert clock.sleeps == [5]
+    limiter.wait()
+    assert clock.sleeps == [5]
+
+def test_scheduler_halves_concurrency_when_overloaded_and_recovers(clock):
+    scheduler = Scheduler(8, retries=0, log=Log())
+    scheduler.request(Client(503).get, 'x')
+    assert scheduler.concurrency == 4
+    clock.now += 1
+    scheduler.request(Client(429).get, 'x')
+    assert scheduler.concurrency == 2
+    # growing by one per window of requests that go well, so from 2 to 8 takes about (8**2 - 2**2) / 2
+    for _ in range(25):
+        scheduler.request(Client().get, 'x')
+    assert 6 < scheduler.concurrency < 8
+    for _ in range(10):
+        scheduler.request(Client().get, 'x')
+    assert scheduler.concurrency == 8
+    assert ('concurrency_change', {'concurrency': 4, 'reason': 'overloaded'}) in scheduler.log.events
+
+def test_scheduler_halves_once_for_requests_started_before_the_last_halving(clock):
+    scheduler = Scheduler(8)
+    started = clock.monotonic()
+    clock.now += 1
+    scheduler._acquire()
+    scheduler._release(clock.monotonic(), overloaded=True)
+    scheduler._acquire()
+    scheduler._release(started, overloaded=True)
+    assert scheduler.concurrency == 4
+
+def test_scheduler_counts_slow_requests_as_overloaded(clock):
+    class Slow(Client):
+        def get(self, uri, **kwargs):
+            clock.now += 3
+            return self.respond()
+    scheduler = Scheduler(8, target_latency=2)
+    assert scheduler.request(Slow().get, 'x').status_code == 200
+    assert scheduler.concurrency == 4
+
+def test_scheduler_retries_like_with_retries(clock):
+    scheduler = Scheduler(4)
+    client = Client(504, reset())
+    assert scheduler.request(client.get, 'x').status_code == 200
+    assert client.calls == 3
+    client = Client(504)
+    assert scheduler.request(client.post, 'x').status_code == 504
+    assert client.calls == 1
+    client = Client(refused())
+    assert scheduler.request(client.post, 'x').status_code == 200
+    with pytest.raises(ConnectionError):
+        scheduler.request(Client(reset()).post, 'x')
+
+def test_scheduler_retry_after_pauses_all_requests(clock):
+    class Refusing(Client):
+        def respond(self):
+            self.calls += 1
+            if self.calls == 1:
+                return NS(status_code=429, headers={'Retry-After': '7'}, content=b'')
+            return NS(status_code=200, headers={}, content=b'')
+    scheduler = Scheduler(4)
+    assert scheduler.request(Refusing().get, 'x').status_code == 200
+    assert scheduler.limiter.paused_until == 7
+    assert clock.sleeps == [7]
+
+def test_scheduler_keeps_to_its_concurrency():
+    in_flight, most = 0, 0
+    lock = threading.Lock()
+    def get(uri):
+        nonlocal in_flight, most
+        with lock:
+            in_flight += 1
+            most = max(most, in_flight)
+        time.sleep(0.005)
+        with lock:
+            in_flight -= 1
+        return NS(status_code=200, headers={}, content=b'')
+    scheduler = Scheduler(3)
+    threads = [threading.Thread(target=scheduler.request, args=(get, 'x')) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert most == 3
@@ -0,0 +1,175 @@
+import json, threading, time
+from types import SimpleNamespace as NS
+
+import pytest
+
+import apply_batch
+from aspace_requests import BoundedExecutor, Scheduler
+from batch import BatchWriter, dependencies, read_batch, ref, resolve
+from instrumentation import Metrics
+from journal import Journal
+
+from helpers import Log
+
+def test_batch_only_appears_once_closed(tmp_path):
+    filename = str(tmp_path / 'batch.jsonl')
+    batch = BatchWriter(filename)
+    tc = batch.create('tc1', '/repositories/2/top_containers', {'indicator': '3'}, series_indicators={'1.001': 3})
+    batch.append('ao5', '/repositories/2/archival_objects/5', 'instances', [{'sub_container': {'top_container': tc}}],
+                 lock_version=2, after=['tc1'])
+    batch.create('do1', '/repositories/2/digital_objects', {'title': 'a'}, discard_unless=['ao5'])
+    batch.delete('tc9', '/repositories/2/top_containers/9')
+    assert not (tmp_path / 'batch.jsonl').exists()
+    batch.close()
+    ops = list(read_batch(filename))
+    assert ops == [
+        {'op': 'create', 'key': 'tc1', 'uri': '/repositories/2/top_containers', 'json': {'indicator': '3'},
+         'series_indicators': {'1.001': 3}},
+        {'op': 'append', 'key': 'ao5', 'uri': '/repositories/2/archival_objects/5', 'field': 'instances',
+         'values': [{'sub_container': {'top_container': {'$ref': 'tc1'}}}], 'lock_version': 2, 'after': ['tc1']},
+        {'op': 'create', 'key': 'do1', 'uri': '/repositories/2/digital_objects', 'json': {'title': 'a'},
+         'discard_unless': ['ao5']},
+        {'op': 'delete', 'key': 'tc9', 'uri': '/repositories/2/top_containers/9'},
+    ]
+    assert batch.count == 4
+
+def test_dependencies_and_resolve():
+    op = {'op': 'update', 'key': 'u', 'uri': '/x', 'fields': {'a': ref('c1'), 'b': [ref('c2'), 'plain']}, 'after': ['d']}
+    assert dependencies(op) == {'c1', 'c2', 'd'}
+    assert resolve(op['fields'], {'c1': '/one', 'c2': '/two'}) == {'a': '/one', 'b': ['/two', 'plain']}
+
+class Client:
+    '''A tiny in-memory ASpace: POSTs to a collection create, POSTs to a record update it.
+Creates whose json has "fail" in it are refused.'''
+    def __init__(self, records=()):
+        self.records = {uri: dict(record, lock_version=0) for uri, record in records}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.next_id = 100
+
+    def response(self, status_code, body):
+        return NS(status_code=status_code, headers={}, content=b'', json=lambda: json.loads(json.dumps(body)))
+
+    def get(self, uri, **kwargs):
+        with self.lock:
+            self.calls.append(('get', uri))
+            if uri not in self.records:
+                return self.response(404, {'error': 'Record not found'})
+            return self.response(200, self.records[uri])
+
+    def post(self, uri, json=None, **kwargs):
+        # give anything racing this request time to overtake it
+        time.sleep(0.01)
+        with self.lock:
+            self.calls.append(('post', uri))
+            if uri in self.records:
+                self.records[uri] = dict(json, lock_version=json['lock_version'] + 1)
+                return self.response(200, {'status': 'Updated', 'uri': uri})
+            if 'fail' in json:
+                return self.response(400, {'error': 'invalid'})
+            self.next_id += 1
+            created = '{}/{}'.format(uri, self.next_id)
+            self.records[created] = dict(json, lock_version=0)
+            return self.response(200, {'status': 'Created', 'uri': created})
+
+    def delete(self, uri, **kwargs):
+        with self.lock:
+            self.calls.append(('delete', uri))
+            del self.records[uri]
+            return self.response(200, {'status': 'Deleted'})
+
+@pytest.fixture
+def apply(tmp_path, monkeypatch):
+    '''Apply ops to a Client, returning whether each succeeded, which numbers were used and the log'''
+    def apply(client, ops, done=()):
+        log = Log()
+        for name, value in {'aspace': NS(client=client), 'log': log, 'metrics': Metrics(), 'done': set(done), 'uris': {},
+                            'scheduler': Scheduler(4, retries=0), 'journal': Journal(str(tmp_path / 'journal'))}.items():
+            monkeypatch.setattr(apply_batch, name, value, raising=False)
+        with BoundedExecutor(max_workers=4) as pool:
+            futures, numbered, discardable = apply_batch.submit_batch(ops, pool)
+        log.orphaned = apply_batch.discard_unused(discardable, futures)
+        apply_batch.journal.close()
+        return {key: future.result() for key, future in futures.items()}, apply_batch.created_indicators(numbered, futures), log
+    return apply
+
+AO = '/repositories/2/archival_objects/5'
+TCS = '/repositories/2/top_containers'
+
+def test_changes_to_a_record_are_made_in_order(apply):
+    client = Client([(AO, {'instances': []})])
+    ops = [{'op': 'append', 'key': 'a{}'.format(i), 'uri': AO, 'field': 'instances', 'values': [i]} for i in range(5)]
+    results, _, _ = apply(client, ops)
+    assert all(results.values())
+    assert client.records[AO]['instances'] == [0, 1, 2, 3, 4]
+
+def test_refs_resolved_to_created_records(apply):
+    client = Client([(AO, {'instances': []})])
+    ops = [{'op': 'create', 'key': 'tc', 'uri': TCS, 'json': {'indicator': '1'}},
+           {'op': 'append', 'key': 'ao', 'uri': AO, 'field': 'instances', 'values': [{'ref': ref('tc')}]}]
+    results, _, _ = apply(client, ops)
+    assert results == {'tc': True, 'ao': True}
+    assert client.records[AO]['instances'] == [{'ref': TCS + '/101'}]
+
+def test_op_skipped_when_dependency_fails(apply):
+    client = Client([(AO, {'instances': []}), (TCS + '/9', {})])
+    ops = [{'op': 'create', 'key': 'tc', 'uri': TCS, 'json': {'fail': True}},
+           {'op': 'append', 'key': 'ao', 'uri': AO, 'field': 'instances', 'values': [{'ref': ref('tc')}]},
+           {'op': 'delete', 'key': 'old', 'uri': TCS + '/9', 'after': ['ao']}]
+    results, _, log = apply(client, ops)
+    assert results == {'tc': False, 'ao': False, 'old': False}
+    assert log.names.count('SKIP dependency_failed') == 2
+    assert client.records[AO]['instances'] == [] and TCS + '/9' in client.records
+
+def test_lock_version_conflict_refused(apply):
+    client = Client([(AO, {'title': 'old'})])
+    results, _, log = apply(client, [{'op': 'update', 'key': 'u', 'uri': AO, 'fields': {'title': 'new'}, 'lock_version': 3}])
+    assert results == {'u': False}
+    assert 'FAIL lock_version_conflict' in log.names
+    assert client.records[AO]['title'] == 'old'
+
+def test_applied_in_earlier_run_skipped(apply):
+    client = Client()
+    results, _, _ = apply(client, [{'op': 'delete', 'key': 'd', 'uri': TCS + '/9'}], done={'d'})
+    assert results == {'d': True}
+    assert client.calls == []
+
+def test_only_created_containers_use_up_numbers(apply):
+    client = Client()
+    ops = [{'op': 'create', 'key': 'tc1', 'uri': TCS, 'json': {'indicator': '4'}, 'series_indicators': {'1.001': 4, '1.002': 7}},
+           {'op': 'create', 'key': 'tc2', 'uri': TCS, 'json': {'indicator': '5'}, 'series_indicators': {'1.001': 5}},
+           {'op': 'create', 'key': 'tc3', 'uri': TCS, 'json': {'fail': True}, 'series_indicators': {'1.001': 6, '1.003': 2}}]
+    results, new_indicators, _ = apply(client, ops)
+    assert results == {'tc1': True, 'tc2': True, 'tc3': False}
+    assert new_indicators == {'1.001': 5, '1.002': 7}
+
+DOS = '/repositories/2/digital_objects'
+
+def test_created_record_discarded_when_what_needs_it_fails(apply):
+    client = Client([(AO, {'instances': []})])
+    ops = [{'op': 'create', 'key': 'do', 'uri': DOS, 'json': {'title': 'a'}, 'discard_unless': ['link']},
+           {'op': 'append', 'key': 'link', 'uri': AO, 'field': 'instances', 'values': [{'ref': ref('do')}], 'lock_version': 3}]
+    results, _, log = apply(client, ops)
+    assert results == {'do': True, 'link': False}
+    assert 'discarded' in log.names and log.orphaned == []
+    assert DOS + '/101' not in client.records
+
+def test_created_record_kept_when_what_needs_it_succeeds(apply):
+    client = Client([(AO, {'instances': []})])
+    ops = [{'op': 'create', 'key': 'do', 'uri': DOS, 'json': {'title': 'a'}, 'discard_unless': ['link']},
+           {'op': 'append', 'key': 'link', 'uri': AO, 'field': 'instances', 'values': [{'ref': ref('do')}]}]
+    results, _, log = apply(client, ops)
+    assert results == {'do': True, 'link': True}
+    assert 'discarded' not in log.names
+    assert DOS + '/101' in client.records
+
+def test_record_that_cant_be_discarded_reported_as_orphaned(apply):
+    class Undeletable(Client):
+        def delete(self, uri, **kwargs):
+            return self.response(500, {'error': 'no'})
+    client = Undeletable([(AO, {'instances': []})])
+    ops = [{'op': 'create', 'key': 'do', 'uri': DOS, 'json': {'title': 'a'}, 'discard_unless': ['link']},
+           {'op': 'append', 'key': 'link', 'uri': AO, 'field': 'instances', 'values': [{'ref': ref('do')}], 'lock_version': 3}]
+    _, _, log = apply(client, ops)
+    assert log.orphaned == [DOS + '/101']
+    assert 'FAIL discard' in log.names
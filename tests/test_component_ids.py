@@ -0,0 +1,39 @@
+import random
+
+import pytest
+
+from benchmarks.bench_classifier import random_component_id, reference_sniff_box_number
+from component_ids import sniff_box_number, sniff_box_numbers
+
+def reference(component_id):
+    '''The old three-pattern result, without the groups that didn't take part'''
+    return {k: v for k, v in reference_sniff_box_number(component_id).items() if v is not None}
+
+@pytest.mark.parametrize('component_id', [
+    'MS001.001.002.00003',
+    'MS001.001.002.003.00004.00005',
+    'MS001.001.002.003',
+    'MS001.001.002.003.004',
+    'MS004.001.002.1234.12.1234',
+    # the old weird_MS004 pattern had an unescaped dot before its last part
+    'MS004.001.002.1234.12x1234',
+    # box-level shape, which comes before weird_MS004
+    'MS004.001.002.003',
+    'MS001-00042',
+    'MS001.12345',
+    'MS01.001.002.00003',
+    'MS001.001.002.00003.',
+    '',
+])
+def test_same_as_old_patterns(component_id):
+    assert sniff_box_number(component_id) == reference(component_id)
+
+def test_same_as_old_patterns_on_random_ids():
+    rand = random.Random(2)
+    for component_id in (random_component_id(rand) for _ in range(20000)):
+        assert sniff_box_number(component_id) == reference(component_id), component_id
+
+def test_sniff_box_numbers():
+    assert sniff_box_numbers(['MS001-1', 'MS001.001.002.003']) == [
+        {'box_no': 'Green Barcode'},
+        {'coll_id': 'MS001', 'series': '001', 'penultimate': '002', 'last': '003'}]
@@ -0,0 +1,83 @@
+import json, threading
+
+from journal import Journal
+
+def test_resume_picks_up_entries_and_appends(tmp_path):
+    filename = str(tmp_path / 'journal')
+    journal = Journal(filename)
+    journal.record('applied', key='a')
+    journal.close()
+    assert not Journal.completed(filename)
+
+    journal = Journal(filename, resume=True)
+    assert [entry['key'] for entry in journal.entries] == ['a']
+    journal.record('applied', key='b')
+    journal.record('run_complete')
+    journal.close()
+    assert Journal.completed(filename)
+    with open(filename) as f:
+        assert [json.loads(line)['event'] for line in f] == ['applied', 'applied', 'run_complete']
+
+def test_without_resume_journal_starts_afresh(tmp_path):
+    filename = str(tmp_path / 'journal')
+    Journal(filename).record('applied', key='a')
+    journal = Journal(filename)
+    assert journal.entries == []
+    journal.close()
+    with open(filename) as f:
+        assert f.read() == ''
+
+def test_partial_last_line_never_happened(tmp_path):
+    filename = str(tmp_path / 'journal')
+    journal = Journal(filename)
+    journal.record('applied', key='a')
+    journal.close()
+    with open(filename, 'a') as f:
+        f.write('{"event": "run_compl')
+    assert not Journal.completed(filename)
+    assert [entry['key'] for entry in Journal(filename, resume=True).entries] == ['a']
+
+def test_completed_when_missing_or_empty(tmp_path):
+    assert Journal.completed(str(tmp_path / 'missing'))
+    (tmp_path / 'empty').write_text('')
+    assert Journal.completed(str(tmp_path / 'empty'))
+
+def test_concurrent_records_kept_whole(tmp_path):
+    filename = str(tmp_path / 'journal')
+    journal = Journal(filename)
+    threads = [threading.Thread(target=lambda n=n: [journal.record('applied', key='{}.{}'.format(n, i)) for i in range(50)])
+               for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    journal.close()
+    assert len(Journal(filename, resume=True).entries) == 200
+
+def test_torn_write_cut_off_on_resume(tmp_path):
+    filename = str(tmp_path / 'journal')
+    journal = Journal(filename)
+    journal.record('updated_container', key='a')
+    journal.close()
+    with open(filename, 'a') as f:
+        f.write('{"event": "upd')
+
+    journal = Journal(filename, resume=True)
+    journal.record('updated_container', key='b')
+    journal.close()
+    journal = Journal(filename, resume=True)
+    assert [entry['key'] for entry in journal.entries] == ['a', 'b']
+    assert journal.unreadable == []
+    journal.record('run_complete')
+    journal.close()
+    assert Journal.completed(filename)
+
+def test_unreadable_entries_skipped_and_reported(tmp_path):
+    filename = tmp_path / 'journal'
+    filename.write_text('{"event": "applied", "key": "a"}\nnot json\n{"event": "applied", "key": "b"}\n')
+    journal = Journal(str(filename), resume=True)
+    assert [entry['key'] for entry in journal.entries] == ['a', 'b']
+    assert journal.unreadable == [2]
+    journal.close()
+    filename.write_text('{"event": "applied", "key": "a"}\n{"event": "run_compl{"event": "run_complete"}\n')
+    assert not Journal.completed(str(filename))
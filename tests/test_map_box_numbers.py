@@ -0,0 +1,25 @@
+import json
+
+import pytest
+
+import map_box_numbers
+from map_box_numbers import read_plan
+
+def test_read_plan(tmp_path):
+    plan = tmp_path / 'plan.jsonl'
+    plan.write_text('\n'.join(json.dumps(line) for line in [
+        {'repository': 2, 'watermark': None},
+        {'action': 'update_indicator', 'container_id': 7, 'barcode': '123', 'component_ids': ['MS001.001.002.00003'],
+         'ao_ids': [10], 'shared': False, 'proposed_box_number': '2', 'old_indicator': '1'}]) + '\n')
+    header, rows = read_plan(str(plan))
+    assert header == {'repository': 2, 'watermark': None}
+    rows = list(rows)
+    assert [(row['container_id'], row['proposed_box_number']) for row in rows] == [(7, '2')]
+    assert map_box_numbers.planned_indicators[7] == '1'
+
+@pytest.mark.parametrize('content, message', [('', 'empty plan file'), ('{"repository": 2, "wat', 'truncated')])
+def test_plan_without_header_refused(tmp_path, content, message):
+    plan = tmp_path / 'plan.jsonl'
+    plan.write_text(content)
+    with pytest.raises(ValueError, match=message):
+        read_plan(str(plan))
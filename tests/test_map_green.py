@@ -0,0 +1,60 @@
+from map_green_barcode_box_numbers import barcode_keys, emptied_containers, load_ao_infos, load_containers_by_barcode
+
+class Cursor:
+    '''Stands in for a DictCursor, answering each query with the next of `results` and keeping the queries'''
+    def __init__(self, *results):
+        self.results = list(results)
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+TOP_CONTAINERS = [{'id': 1, 'barcode': '123G'}, {'id': 2, 'barcode': '123'}, {'id': 3, 'barcode': '456g'},
+                  {'id': 4, 'barcode': 'AB77'}, {'id': 5, 'barcode': 'ab77g'}, {'id': 6, 'barcode': '99999'}]
+
+def test_barcode_keys():
+    assert barcode_keys('123G') == ('123g', '123')
+    assert barcode_keys('AB77') == ('ab77',)
+
+def test_containers_matched_with_or_without_g_regardless_of_case():
+    containers_by_barcode, green = load_containers_by_barcode(Cursor(TOP_CONTAINERS), ['Ab77', '123'])
+    assert green == {'123', '456'}
+    assert containers_by_barcode['123'] == [1, 2]
+    assert containers_by_barcode['123g'] == [1]
+    assert containers_by_barcode['456'] == [3]
+    assert containers_by_barcode['ab77'] == [4, 5]
+    assert '99999' not in containers_by_barcode
+
+def test_ao_infos_loaded_by_container_id():
+    containers_by_barcode, _ = load_containers_by_barcode(Cursor(TOP_CONTAINERS), ['AB77', '123'])
+    aos = [{'id': 10, 'component_id': 'MS001.001.001', 'top_container_id': 1},
+           {'id': 11, 'component_id': 'MS001.001.002', 'top_container_id': 5},
+           {'id': 12, 'component_id': 'MS001.001.003', 'top_container_id': 2}]
+    db = Cursor(aos)
+    ao_infos = load_ao_infos(db, ['123', 'AB77', 'nothing'], containers_by_barcode)
+    assert sorted(db.queries[0][1][0]) == [1, 2, 4, 5]
+    assert [ao['id'] for ao in ao_infos['123']] == [10, 12]
+    assert [ao['id'] for ao in ao_infos['AB77']] == [11]
+    assert 'nothing' not in ao_infos
+
+def test_only_containers_holding_nothing_but_moved_aos_are_emptied():
+    rows = [{'id': 1, 'lock_version': 3, 'link_id': 100, 'archival_object_id': 10},
+            {'id': 1, 'lock_version': 3, 'link_id': 101, 'archival_object_id': 11},
+            # an AO that wasn't moved
+            {'id': 2, 'lock_version': 0, 'link_id': 102, 'archival_object_id': 10},
+            {'id': 2, 'lock_version': 0, 'link_id': 103, 'archival_object_id': 12},
+            # an accession's instance
+            {'id': 3, 'lock_version': 1, 'link_id': 104, 'archival_object_id': None},
+            # nothing in it at all
+            {'id': 4, 'lock_version': 5, 'link_id': None, 'archival_object_id': None}]
+    db = Cursor(rows)
+    assert emptied_containers(db, {1, 2, 3, 4}, {10, 11}) == {1: 3, 4: 5}
+    assert sorted(db.queries[0][1][0]) == [1, 2, 3, 4]
+
+def test_no_query_without_containers():
+    db = Cursor()
+    assert emptied_containers(db, set(), {10}) == {}
+    assert db.queries == []
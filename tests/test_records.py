@@ -0,0 +1,55 @@
+import json, os
+
+import pytest
+
+from records import CacheWriter, ContainerRow, JSONStore, load_cache
+
+def test_json_store_hands_out_copies():
+    store = JSONStore({1: {'title': 'a', 'instances': []}})
+    store[1]['instances'].append('x')
+    assert store[1] == {'title': 'a', 'instances': []}
+    assert store.get(2) is None and 1 in store and len(store) == 1
+
+def test_cache_round_trip(tmp_path):
+    filename = str(tmp_path / 'cache')
+    cache = CacheWriter(filename)
+    cache.write(JSONStore({1: {'title': 'one'}, 2: {'title': 'two', 'notes': ['é', None]}}))
+    cache.write(JSONStore({3: {'title': 'three'}, 1: {'title': 'one again'}}))
+    assert not os.path.exists(filename)
+    cache.close()
+
+    store = load_cache(filename)
+    assert sorted(store) == [1, 2, 3]
+    assert dict(store.items()) == {1: {'title': 'one again'}, 2: {'title': 'two', 'notes': ['é', None]}, 3: {'title': 'three'}}
+
+def test_empty_cache_round_trip(tmp_path):
+    filename = str(tmp_path / 'cache')
+    CacheWriter(filename).close()
+    assert len(load_cache(filename)) == 0
+
+def test_legacy_json_cache_read(tmp_path):
+    filename = tmp_path / 'cache.json'
+    filename.write_text(json.dumps({'5': {'title': 'five'}}))
+    assert dict(load_cache(str(filename)).items()) == {5: {'title': 'five'}}
+
+@pytest.mark.parametrize('keep', [8, 20, -1])
+def test_truncated_cache_refused(tmp_path, keep):
+    filename = str(tmp_path / 'cache')
+    cache = CacheWriter(filename)
+    cache.write(JSONStore({1: {'title': 'one'}}))
+    cache.close()
+    with open(filename, 'rb') as f:
+        data = f.read()
+    with open(filename, 'wb') as f:
+        f.write(data[:keep])
+    with pytest.raises(ValueError):
+        load_cache(filename)
+
+def test_container_row_acts_like_a_dict():
+    row = ContainerRow(7, '123b', ['MS001.001.002.003'], [10], False)
+    row['proposed_box_number'] = 'Volume 3'
+    assert row['barcode'] == '123b' and row.get('missing', 'default') == 'default'
+    assert dict(row.items()) == {'container_id': 7, 'barcode': '123b', 'component_ids': ('MS001.001.002.003',),
+                                 'ao_ids': (10,), 'shared': False, 'proposed_box_number': 'Volume 3'}
+    with pytest.raises(KeyError):
+        row['nonexistent']
@@ -0,0 +1,55 @@
+from datetime import datetime
+from types import SimpleNamespace as NS
+
+import pytest
+
+import series_index
+from series_index import SeriesIndex
+
+from helpers import Log
+
+@pytest.fixture
+def database(monkeypatch):
+    '''Stands in for the ASpace database: set .mtime and .rows, and .queries keeps the params each refresh queried with'''
+    db = NS(mtime=datetime(2024, 1, 1, 12), rows=[], queries=[])
+    monkeypatch.setattr(series_index, 'latest_system_mtime', lambda cursor: db.mtime)
+    def series_max_indicators(cursor, where='TRUE', params=None):
+        db.queries.append(params)
+        return db.rows
+    monkeypatch.setattr(series_index, 'series_max_indicators', series_max_indicators)
+    return db
+
+def test_first_refresh_builds_index_then_later_ones_catch_up(tmp_path, database):
+    index = SeriesIndex(str(tmp_path / 'index.sqlite'))
+    database.rows = [{'id': 1, 'series': '001', 'max_indicator': 5}, {'id': 2, 'series': '003', 'max_indicator': 9}]
+    index.refresh(None, Log())
+    assert index.load() == {'1.001': 5, '2.003': 9}
+    assert database.queries == [None]
+
+    database.mtime = datetime(2024, 1, 2)
+    database.rows = [{'id': 1, 'series': '001', 'max_indicator': 7}, {'id': 2, 'series': '003', 'max_indicator': 4},
+                     {'id': 2, 'series': '004', 'max_indicator': 1}]
+    log = Log()
+    index.refresh(None, log)
+    # only changes since the last refresh are read, and the index never goes down
+    assert database.queries[-1] == (datetime(2024, 1, 1, 12),) * 2
+    assert index.load() == {'1.001': 7, '2.003': 9, '2.004': 1}
+    assert log.events == [('series_index_refresh', {'since': '2024-01-01T12:00:00', 'series_updated': 3})]
+
+def test_rebuild_starts_over(tmp_path, database):
+    index = SeriesIndex(str(tmp_path / 'index.sqlite'))
+    index.save({'1.001': 50})
+    database.rows = [{'id': 1, 'series': '001', 'max_indicator': 5}]
+    index.refresh(None, Log(), rebuild=True)
+    assert index.load() == {'1.001': 5}
+    assert database.queries == [None]
+
+def test_save_keeps_the_higher_number_and_is_shared(tmp_path):
+    filename = str(tmp_path / 'index.sqlite')
+    index, other = SeriesIndex(filename), SeriesIndex(filename)
+    index.save({'1.001': 5, '12.002': 3})
+    other.save({'1.001': 4, '12.002': 8})
+    assert index.load() == other.load() == {'1.001': 5, '12.002': 8}
+    index.close()
+    other.close()
+    assert SeriesIndex(filename).load() == {'1.001': 5, '12.002': 8}
@@ -0,0 +1,41 @@
+import glob, os
+from argparse import ArgumentTypeError
+
+import pytest
+
+import spreadsheets
+from spreadsheets import barcode_mapping, barcode_set, first_column
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(spreadsheets, 'CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+def write(path, text):
+    path.write_text(text)
+    return str(path)
+
+def test_reads_csv_and_tsv(tmp_path):
+    assert barcode_set(write(tmp_path / 'omit.csv', 'barcode\n123\n\n456\n')) == {'123', '456'}
+    assert barcode_mapping(write(tmp_path / 'map.tsv', 'barcode\tindicator\n123\t7\n')) == {'123': '7'}
+    assert first_column(write(tmp_path / 'list.csv', '123\n,x\n456\n')) == ['123', None, '456']
+
+def test_cached_by_contents(tmp_path, cache_dir, monkeypatch):
+    filename = write(tmp_path / 'omit.csv', 'barcode\n123\n')
+    assert barcode_set(filename) == {'123'}
+    monkeypatch.setattr(spreadsheets, 'sheet_rows', lambda filename: pytest.fail('read despite cache'))
+    assert barcode_set(filename) == {'123'}
+
+def test_corrupt_cache_is_rebuilt(tmp_path, cache_dir):
+    filename = write(tmp_path / 'omit.csv', 'barcode\n123\n')
+    barcode_set(filename)
+    [path] = glob.glob(os.path.join(str(cache_dir), '*.json'))
+    with open(path, 'w') as f:
+        f.write('["12')
+    assert barcode_set(filename) == {'123'}
+    with open(path) as f:
+        assert f.read() == '["123"]'
+
+def test_unreadable_spreadsheet_is_an_argument_error(tmp_path):
+    with pytest.raises(ArgumentTypeError):
+        barcode_set(str(tmp_path / 'missing.xlsx'))